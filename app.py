@@ -1,19 +1,34 @@
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required
-from flask import Flask, render_template, request, redirect, url_for, flash, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, make_response, abort, jsonify, Response
 from datetime import datetime, timedelta
+from markupsafe import Markup
 from flask_restful import Api
-from sqlalchemy import or_
 from dotenv import load_dotenv
+import hashlib
+import json
 import logging
-import base64
 import os
+import time
 
 import book_resources
+import metrics
 from data import db_session
 from data.users import User
 from data.books import Book
 from data.borrowed_book import BorrowedBook
-from helping_functions import optimize_image, load_admin_ids, calculate_max_borrow_days
+from data.search import search_books
+from data.genres import set_book_genres, get_genre_facets, books_in_genres
+from data.user_cache import user_cache
+from data.catalog_version import get_catalog_version
+from data.circulation import get_circulation_report
+from data.loans import ALREADY_BORROWED, UNAVAILABLE, borrow_book as borrow_book_for_user
+from data.queries import get_borrowed_book_ids, get_user_loans, keyset_page, offset_page, query_book_rows
+from data.ratings import LATE_RETURN_DELTA, ON_TIME_RETURN_DELTA, get_borrow_policy, record_rating_event
+from data.waitlist import ALREADY_WAITING, IN_STOCK, JOINED, NOT_ALLOWED, NOT_FOUND, get_last_notice_id, get_notices, \
+    get_user_waitlist, get_waiting_book_ids, join_waitlist, leave_waitlist, notice_bell
+from helping_functions import read_image, load_admin_ids, resize_image, image_hash, image_mimetype
+from fragment_cache import fragment_cache
+from image_pipeline import COVER_SIZES, ORIGINAL, RENDITIONS, WEBP, submit_renditions, get_rendition, store_original
 
 
 logging.basicConfig(
@@ -36,18 +51,51 @@ app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024
 api = Api(app)
 
 api.add_resource(book_resources.BooksListResource, '/api/v1/books')
+api.add_resource(book_resources.BooksBatchResource, '/api/v1/books/batch')
 api.add_resource(book_resources.BookResource, '/api/v1/book/<int:book_id>')
+api.add_resource(book_resources.CirculationReportResource, '/api/v1/reports/circulation')
+api.add_resource(book_resources.CatalogImportResource, '/api/v1/catalog/import')
+api.add_resource(book_resources.CatalogExportResource, '/api/v1/catalog/export')
 
-db_session.global_init("db/library.db")
+db_session.global_init(os.getenv("LIBRARY_DB") or "db/library.db")
+
+metrics.init_app(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-GENRES = ['Все', 'Антиутопия', 'Апокалиптика', 'Басня', 'Военная проза', 'Детектив', 'Детская литература', 'Драма',
-          'Историческая проза', 'Исторический жанр', 'Комедия', 'Криминальный жанр', 'Научная фантастика', 'Повесть',
-          'Политическая фантастика', 'Постапокалиптика', 'Психологический реализм', 'Роман', 'Роман в стихах', 'Сатира',
-          'Фантастика', 'Фикшн', 'Философия']
+BOOKS_PAGE_SIZE = 50
+
+COVER_MAX_AGE = 365 * 24 * 60 * 60
+
+# SSE: как часто поток перепроверяет уведомления без сигнала (записи других процессов)
+# и сколько живет одно соединение, после чего браузер переподключается сам.
+# Открытый поток занимает поток WSGI-сервера, поэтому его открывают только страницы с ожидаемыми
+# книгами (watch_notices), а соединение короткое. Для многих читателей сразу сайт нужно запускать
+# на воркерах gevent/eventlet (gunicorn -k gevent), где ожидание не держит системный поток
+EVENTS_CHECK_SECONDS = 15
+EVENTS_STREAM_SECONDS = 60
+
+# место в закэшированной карточке книги, куда вставляются кнопки текущего пользователя
+CARD_ACTIONS_SLOT = '<!--actions-->'
+
+
+def cover_url(book, size='thumb'):
+    if not book.image_hash:
+        if book.has_image:
+            # хэш старой обложки посчитается при первом запросе к /cover
+            return url_for('cover', book_id=book.id, size=size)
+        return url_for('static', filename='images/no_photo.png')
+    # версия в адресе меняется вместе с картинкой, поэтому браузер может кэшировать ее надолго
+    return url_for('cover', book_id=book.id, size=size, v=book.image_hash[:12])
+
+
+def cover_srcset(book):
+    # та же обложка вдвое крупнее для экранов высокой плотности
+    if not book.image_hash and not book.has_image:
+        return None
+    return f"{cover_url(book, 'thumb')} 1x, {cover_url(book, 'medium')} 2x"
 
 
 def update_rating(user, borrowed_book):
@@ -56,23 +104,56 @@ def update_rating(user, borrowed_book):
         return
 
     is_late = datetime.utcnow() > borrowed_book.return_by
+    delta = LATE_RETURN_DELTA if is_late else ON_TIME_RETURN_DELTA
 
-    if is_late:
-        user.rating -= 30
-    else:
-        user.rating += 20
+    # событие в журнале и изменение считаются в той же транзакции, что и возврат;
+    # прибавка в SQL, чтобы параллельные возвраты не затирали друг друга
+    db_sess = db_session.create_session()
+    record_rating_event(db_sess, user.id, delta, 'late_return' if is_late else 'return', borrowed_book.id)
+    user.rating = User.rating + delta
+    db_sess.flush()
 
-    user.max_borrow_days = calculate_max_borrow_days(user.rating)
+    user.max_borrow_days = get_borrow_policy(db_sess).max_borrow_days(user.rating)
+    user_cache.invalidate_on_commit(db_sess, user.id)
 
-    db_sess = db_session.create_session()
-    db_sess.merge(user)
-    db_sess.commit()
+
+def render_latest_books(db_sess):
+    books_ = query_book_rows(db_sess).order_by(Book.id.desc()).limit(3).all()
+    books_params = []
+    for book in books_:
+        books_params.append({
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'genre': book.genre,
+            'quantity': book.quantity,
+            'image_url': cover_url(book),
+            'image_srcset': cover_srcset(book)})
+    return render_template('_latest_books.html', books=books_params)
+
+
+def book_card(book):
+    # ключ - сами поля строки, то есть версия книги: любая правка или выдача дает новый ключ,
+    # а старая карточка уходит из кэша по LRU
+    key = 'card:' + hashlib.sha1(repr(tuple(book)).encode()).hexdigest()
+    html = fragment_cache.get_or_render(key, lambda: render_template(
+        '_book_card.html', book=book, image_url=cover_url(book), image_srcset=cover_srcset(book),
+        actions_slot=Markup(CARD_ACTIONS_SLOT)))
+    # кнопки читателя или администратора вставляются на место метки при каждом запросе
+    head, tail = html.split(CARD_ACTIONS_SLOT)
+    return Markup(head), Markup(tail)
+
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    db_session.remove_session()
 
 
 @login_manager.user_loader
 def load_user(user_id):
+    # пользователь берется из кэша процесса, запрос к БД - только при промахе или истекшем ttl
     db_sess = db_session.create_session()
-    return db_sess.query(User).get(int(user_id))
+    return user_cache.get(db_sess, int(user_id))
 
 
 @app.route('/')
@@ -80,41 +161,21 @@ def load_user(user_id):
 @login_required
 def home():
     db_sess = db_session.create_session()
-    borrowed_books = (db_sess.query(BorrowedBook).filter_by(user_id=current_user.id).all())
+    loans = get_user_loans(db_sess, current_user.id)
 
     tomorrow = datetime.utcnow() + timedelta(days=1)
-    for borrowed_book in borrowed_books:
+    for borrowed_book, book in loans:
         if borrowed_book.return_by.date() == tomorrow.date():
             if not request.cookies.get(f"reminder_{borrowed_book.id}"):
-                book = db_sess.query(Book).get(borrowed_book.book_id)
-                if book:
-                    flash(f"Напоминание: верните книгу '{book.title}' до {borrowed_book.return_by.strftime('%d.%m.%Y')}","info")
-
-    books_ = (db_sess.query(Book).order_by(Book.id.desc()).limit(3).all())
-    books_params = []
-    for book in books_:
-        if book.image_data:
-            image_base64 = base64.b64encode(book.image_data).decode('utf-8')
-            mimetype = "image/jpeg" if book.image_data.startswith(b'\xff\xd8\xff') else "image/png"
-            image_url = f"data:{mimetype};base64,{image_base64}"
-        else:
-            image_url = url_for('static', filename='images/default-book.png')
-
-        books_params.append({
-            'id': book.id,
-            'title': book.title,
-            'author': book.author,
-            'genre': book.genre,
-            'quantity': book.quantity,
-            'image_url': image_url})
+                flash(f"Напоминание: верните книгу '{book.title}' до {borrowed_book.return_by.strftime('%d.%m.%Y')}","info")
 
-    response = make_response(render_template('home.html', books=books_params))
+    # блок новинок одинаков для всех и меняется только вместе с каталогом
+    latest_books = fragment_cache.get_or_render(f'latest:{get_catalog_version(db_sess)}',
+                                                lambda: render_latest_books(db_sess))
 
-    db_sess = db_session.create_session()
-    borrowed_books = (
-        db_sess.query(BorrowedBook).filter_by(user_id=current_user.id).all())
+    response = make_response(render_template('home.html', latest_books=latest_books))
 
-    for borrowed_book in borrowed_books:
+    for borrowed_book, _ in loans:
         if borrowed_book.return_by.date() == tomorrow.date():
             response.set_cookie(f"reminder_{borrowed_book.id}", "true", max_age=86400)
 
@@ -202,6 +263,7 @@ def register_admin():
 @app.route('/logout')
 @login_required
 def logout():
+    user_cache.invalidate(current_user.id)
     logout_user()
     flash("Вы успешно вышли!", "success")
     return redirect(url_for('login'))
@@ -215,29 +277,16 @@ def borrow_book(book_id):
         return redirect(url_for('home'))
 
     db_sess = db_session.create_session()
-    book = db_sess.query(Book).get(book_id)
+    result = borrow_book_for_user(db_sess, current_user.id, current_user.max_borrow_days, book_id)
 
-    if not book or book.quantity <= 0:
+    if result == UNAVAILABLE:
         flash("Книга недоступна!", "error")
         return redirect(url_for('home'))
 
-    borrowed_book = (db_sess.query(BorrowedBook).filter_by(user_id=current_user.id, book_id=book_id).first())
-
-    if borrowed_book:
+    if result == ALREADY_BORROWED:
         flash("У вас уже есть эта книга!", "error")
         return redirect(url_for('home'))
 
-    book.quantity -= 1
-
-    return_by = datetime.utcnow() + timedelta(days=current_user.max_borrow_days)
-
-    new_borrowed_book = BorrowedBook(
-        user_id=current_user.id,
-        book_id=book_id,
-        return_by=return_by)
-    db_sess.add(new_borrowed_book)
-    db_sess.commit()
-
     flash("Вы успешно взяли книгу!", "success")
     return redirect(url_for('home'))
 
@@ -252,53 +301,118 @@ def return_book(book_id):
         flash("Эта книга не была взята вами!", "error")
         return redirect(url_for('home'))
 
-    book = db_sess.query(Book).get(book_id)
-    if not book:
-        flash("Книга не найдена!", "error")
+    # удаление по id проходит только у одного из параллельных возвратов
+    returned = (db_sess.query(BorrowedBook)
+                .filter(BorrowedBook.id == borrowed_book.id)
+                .delete(synchronize_session=False))
+    if not returned:
+        db_sess.rollback()
+        flash("Эта книга не была взята вами!", "error")
         return redirect(url_for('home'))
 
     # Возвращаем книгу в библиотеку
-    book.quantity += 1  # Увеличиваем количество доступных экземпляров
+    db_sess.query(Book).filter(Book.id == book_id).update(
+        {Book.quantity: Book.quantity + 1}, synchronize_session=False)
 
-    # Обновляем рейтинг пользователя
-    update_rating(current_user, borrowed_book)  # Передаем объект borrowed_book
+    # Обновляем рейтинг пользователя в той же транзакции
+    # current_user - общий объект из кэша, изменения делаются на свежей копии из этой сессии
+    user = db_sess.get(User, current_user.id)
+    update_rating(user, borrowed_book)
 
-    # Удаляем запись о взятой книге
-    db_sess.delete(borrowed_book)
     db_sess.commit()
+    notice_bell.ring()
 
     flash("Вы успешно вернули книгу!", "success")
     return redirect(url_for('home'))
 
 
+@app.route('/waitlist/<int:book_id>')
+@login_required
+def join_book_waitlist(book_id):
+    db_sess = db_session.create_session()
+    result = join_waitlist(db_sess, current_user.id, book_id)
+
+    messages = {NOT_ALLOWED: ("Администраторы не могут брать книги!", "error"),
+                NOT_FOUND: ("Книга не найдена!", "error"),
+                IN_STOCK: ("Книга есть в наличии, ее можно взять сейчас!", "info"),
+                ALREADY_WAITING: ("Вы уже в очереди на эту книгу!", "info"),
+                JOINED: ("Вы в очереди! Мы сообщим, когда книга появится.", "success")}
+    flash(*messages[result])
+    return redirect(url_for('books'))
+
+
+@app.route('/waitlist/<int:book_id>/leave')
+@login_required
+def leave_book_waitlist(book_id):
+    db_sess = db_session.create_session()
+
+    if not leave_waitlist(db_sess, current_user.id, book_id):
+        flash("Вы не стоите в очереди на эту книгу!", "error")
+        return redirect(url_for('my_books'))
+
+    flash("Вы вышли из очереди.", "success")
+    return redirect(url_for('my_books'))
+
+
+@app.route('/events')
+@login_required
+def events():
+    # поток уведомлений о поступлении книг из листа ожидания (Server-Sent Events)
+    user_id = current_user.id
+    after = request.headers.get('Last-Event-ID', type=int)
+    if after is None:
+        after = request.args.get('after', type=int)
+    if after is None:
+        # новое подключение без истории получает только будущие уведомления
+        after = get_last_notice_id(db_session.create_session(), user_id)
+
+    def stream(after):
+        deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+        yield 'retry: 5000\n\n'
+        while time.monotonic() < deadline:
+            # поколение запоминается до запроса, чтобы сигнал во время запроса не потерялся
+            generation = notice_bell.generation
+            with db_session.session_scope() as db_sess:
+                notices = get_notices(db_sess, user_id, after)
+            for notice in notices:
+                after = notice['id']
+                yield f"id: {after}\nevent: available\ndata: {json.dumps(notice, ensure_ascii=False)}\n\n"
+            yield ': ping\n\n'
+            notice_bell.wait(generation, EVENTS_CHECK_SECONDS)
+
+    return Response(stream(after), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/my_books')
 @login_required
 def my_books():
     db_sess = db_session.create_session()
 
-    borrowed_books = (db_sess.query(BorrowedBook).filter_by(user_id=current_user.id).all())
+    loans = get_user_loans(db_sess, current_user.id)
 
     tomorrow = datetime.utcnow() + timedelta(days=1)
     books_info = []
-    for borrowed_book in borrowed_books:
-        book = db_sess.query(Book).get(borrowed_book.book_id)
-        if book:
-            if borrowed_book.return_by.date() == tomorrow.date():
-                if not request.cookies.get(f"reminder_{borrowed_book.id}"):
-                    flash(f"Напоминание: верните книгу '{book.title}' до"
-                          f" {borrowed_book.return_by.strftime('%d.%m.%Y')}","info")
-
-            books_info.append({
-                "id": book.id,
-                "title": book.title,
-                "author": book.author,
-                "genre": book.genre,
-                "return_by": borrowed_book.return_by.strftime('%d.%m.%Y'),
-                "is_late": datetime.utcnow() > borrowed_book.return_by})
-
-    response = make_response(render_template('my_books.html', books=books_info))
-
-    for borrowed_book in borrowed_books:
+    for borrowed_book, book in loans:
+        if borrowed_book.return_by.date() == tomorrow.date():
+            if not request.cookies.get(f"reminder_{borrowed_book.id}"):
+                flash(f"Напоминание: верните книгу '{book.title}' до"
+                      f" {borrowed_book.return_by.strftime('%d.%m.%Y')}","info")
+
+        books_info.append({
+            "id": book.id,
+            "title": book.title,
+            "author": book.author,
+            "genre": book.genre,
+            "return_by": borrowed_book.return_by.strftime('%d.%m.%Y'),
+            "is_late": datetime.utcnow() > borrowed_book.return_by})
+
+    waitlist = get_user_waitlist(db_sess, current_user.id)
+    response = make_response(render_template(
+        'my_books.html', books=books_info, waitlist=waitlist,
+        watch_notices=any(entry['position'] is not None for entry in waitlist)))
+
+    for borrowed_book, _ in loans:
         if borrowed_book.return_by.date() == tomorrow.date():
             response.set_cookie(f"reminder_{borrowed_book.id}", "true", max_age=86400)
 
@@ -321,7 +435,7 @@ def add_book():
         file = request.files.get('image')
         if file and file.filename:
             try:
-                image_data = optimize_image(file)
+                image_data = read_image(file)
             except Exception as e:
                 flash(f"Ошибка чтения изображения: {e}", "error")
                 image_data = None
@@ -334,11 +448,19 @@ def add_book():
             author=author,
             genre=genre,
             quantity=quantity,
-            image_data=image_data
+            image_hash=image_hash(image_data) if image_data else None,
+            image_updated_at=datetime.utcnow() if image_data else None
         )
+        if image_data:
+            # сама картинка хранится один раз на хэш, у книги - только ссылка на нее
+            store_original(db_sess, new_book.image_hash, image_data)
+        set_book_genres(db_sess, new_book, genre)
         db_sess.add(new_book)
         db_sess.commit()
 
+        if image_data:
+            submit_renditions(db_sess, new_book.image_hash, image_data)
+
         flash("Книга успешно добавлена!", "success")
         return redirect(url_for('books'))
 
@@ -363,9 +485,11 @@ def edit_book(book_id):
         book.title = request.form.get('title', book.title)
         book.author = request.form.get('author', book.author)
         book.genre = request.form.get('genre', book.genre)
+        set_book_genres(db_sess, book, book.genre)
         book.quantity = int(request.form.get('quantity', book.quantity))
 
         db_sess.commit()
+        notice_bell.ring()
         flash("Книга успешно отредактирована!", "success")
         return redirect(url_for('books'))
 
@@ -421,43 +545,42 @@ def books():
 
     search_query = request.args.get('search', '').strip()
     selected_genres = request.args.getlist('genre')
+    cursor = request.args.get('cursor', 0, type=int)
 
-    query = db_sess.query(Book)
-
-    if search_query:
-        query = query.filter(
-            (Book.title.ilike(f"%{search_query.capitalize()}%")) |
-            (Book.author.ilike(f"%{search_query.capitalize()}%"))
-        )
+    query = query_book_rows(db_sess)
 
     if selected_genres and "all" not in selected_genres:
-        conditions = [Book.genre.like(f"%{genre}%") for genre in selected_genres]
-        query = query.filter(or_(*conditions))
+        query = query.filter(Book.id.in_(books_in_genres(selected_genres)))
+
+    if search_query:
+        query = search_books(db_sess, search_query, query=query)
+        books_, next_cursor = offset_page(query, cursor, BOOKS_PAGE_SIZE)
+    else:
+        books_, next_cursor = keyset_page(query, cursor, BOOKS_PAGE_SIZE)
 
-    books_ = query.all()
+    borrowed_book_ids = get_borrowed_book_ids(db_sess, current_user.id)
+    # очередь нужна только для книг, которых нет в наличии
+    waiting_book_ids = set()
+    if any(book.quantity <= 0 for book in books_):
+        waiting_book_ids = get_waiting_book_ids(db_sess, current_user.id)
 
     books_params = []
     for book in books_:
-        already_borrowed = (db_sess.query(BorrowedBook).filter_by(user_id=current_user.id, book_id=book.id).first() is not None)
-
-        if book.image_data:
-            image_base64 = base64.b64encode(book.image_data).decode('utf-8')
-            mimetype = "image/jpeg" if book.image_data.startswith(b'\xff\xd8\xff') else "image/png"
-            image_url = f"data:{mimetype};base64,{image_base64}"
-        else:
-            image_url = url_for('static', filename='images/no_photo.png')
-
         books_params.append({
             'id': book.id,
-            'title': book.title,
-            'author': book.author,
-            'genre': book.genre,
             'quantity': book.quantity,
-            'image_url': image_url,
-            'already_borrowed': already_borrowed})
+            'card': book_card(book),
+            'already_borrowed': book.id in borrowed_book_ids,
+            'waiting': book.id in waiting_book_ids})
+
+    next_url = None
+    if next_cursor:
+        next_url = url_for('books', search=search_query or None, genre=selected_genres, cursor=next_cursor)
+    first_url = url_for('books', search=search_query or None, genre=selected_genres) if cursor else None
 
-    return render_template('books.html', books=books_params, search_query=search_query, genres=GENRES,
-                           selected_genres=selected_genres)
+    return render_template('books.html', books=books_params, search_query=search_query, genres=get_genre_facets(db_sess),
+                           selected_genres=selected_genres, next_url=next_url, first_url=first_url,
+                           watch_notices=bool(waiting_book_ids))
 
 
 @app.route('/author/<string:author_name>')
@@ -465,19 +588,14 @@ def books():
 def books_by_author(author_name):
     db_sess = db_session.create_session()
 
-    books_ = (db_sess.query(Book).filter(Book.author.ilike(f"%{author_name}%")).all())
+    books_ = search_books(db_sess, author_name, columns=('author',), query=query_book_rows(db_sess)).all()
 
     if not books_:
         flash("Книги данного автора не найдены!", "info")
 
     books_params = []
     for book in books_:
-        if book.image_data:
-            image_base64 = base64.b64encode(book.image_data).decode('utf-8')
-            mimetype = "image/jpeg" if book.image_data.startswith(b'\xff\xd8\xff') else "image/png"
-            image_url = f"data:{mimetype};base64,{image_base64}"
-        else:
-            image_url = url_for('static', filename='images/default-book.png')
+        image_url = cover_url(book)
 
         books_params.append({
             'id': book.id,
@@ -485,12 +603,126 @@ def books_by_author(author_name):
             'author': book.author,
             'genre': book.genre,
             'quantity': book.quantity,
-            'image_url': image_url
+            'image_url': image_url,
+            'image_srcset': cover_srcset(book)
         })
 
     return render_template('books_by_author.html', books=books_params, author_name=author_name)
 
 
+@app.route('/cover/<int:book_id>')
+@app.route('/cover/<int:book_id>/<string:size>')
+def cover(book_id, size=None):
+    if size is not None and size not in COVER_SIZES:
+        abort(404)
+    # адрес один на размер, формат выбирается по Accept; */* не в счет - его шлют и браузеры без WebP
+    kind = size
+    if size is not None and 'image/webp' in request.accept_mimetypes.values():
+        kind = f'{size}.{WEBP}'
+
+    db_sess = db_session.create_session()
+    row = db_sess.query(Book.image_hash, Book.image_updated_at).filter(Book.id == book_id).first()
+    if not row:
+        abort(404)
+
+    book_image_hash, updated_at = row
+    image_data = None
+    if not book_image_hash:
+        # обложки, сохраненные до появления хэша, хэшируем при первом обращении
+        # и переносим в общее хранилище оригиналов
+        image_data = db_sess.query(Book.image_data).filter(Book.id == book_id).scalar()
+        if not image_data:
+            abort(404)
+        book_image_hash = image_hash(image_data)
+        updated_at = datetime.utcnow()
+        store_original(db_sess, book_image_hash, image_data)
+        db_sess.query(Book).filter(Book.id == book_id).update(
+            {Book.image_hash: book_image_hash, Book.image_updated_at: updated_at, Book.image_data: None})
+        db_sess.commit()
+
+    etag = f"{book_image_hash}-{kind or ORIGINAL}"
+    updated_at = (updated_at or datetime.utcnow()).replace(microsecond=0)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = bool(request.if_modified_since) and \
+                       request.if_modified_since.replace(tzinfo=None) >= updated_at
+
+    if not_modified:
+        response = make_response('', 304)
+    else:
+        rendition = get_rendition(db_sess, book_image_hash, kind or ORIGINAL)
+        if rendition:
+            image_data = rendition
+        else:
+            if image_data is None:
+                image_data = get_rendition(db_sess, book_image_hash, ORIGINAL)
+            if image_data is None:
+                abort(404)
+            if size is not None:
+                # версия еще не готова или обложка старая: отдаем уменьшенную на лету и ставим в очередь
+                submit_renditions(db_sess, book_image_hash, image_data)
+                image_data = resize_image(image_data, *RENDITIONS[kind])
+        response = make_response(image_data)
+        response.mimetype = image_mimetype(image_data)
+
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    if size is not None:
+        response.vary.add('Accept')
+    response.cache_control.public = True
+    response.cache_control.max_age = COVER_MAX_AGE
+    return response
+
+
+@app.route('/admin/cache_stats')
+@login_required
+def cache_stats():
+    if current_user.role != "admin":
+        abort(403)
+    return jsonify({'users': user_cache.stats(), 'fragments': fragment_cache.stats()})
+
+
+@app.route('/admin/circulation')
+@login_required
+def circulation_report():
+    if current_user.role != "admin":
+        flash("У вас нет прав для доступа к этой странице!", "error")
+        return redirect(url_for('home'))
+
+    db_sess = db_session.create_session()
+    return render_template('circulation.html', report=get_circulation_report(db_sess))
+
+
+def cache_metrics():
+    values = []
+    for cache_name, stats in (('users', user_cache.stats()), ('fragments', fragment_cache.stats())):
+        for field in ('hits', 'misses', 'evictions'):
+            values.append((f'library_cache_{field}_total', (('cache', cache_name),), stats[field]))
+        values.append(('library_cache_entries', (('cache', cache_name),), stats['size']))
+    return values
+
+
+metrics.registry.describe('library_cache_hits_total', 'counter', 'Cache hits')
+metrics.registry.describe('library_cache_misses_total', 'counter', 'Cache misses')
+metrics.registry.describe('library_cache_evictions_total', 'counter', 'Entries evicted by LRU')
+metrics.registry.describe('library_cache_entries', 'gauge', 'Entries currently cached')
+metrics.registry.add_collector(cache_metrics)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # METRICS_TOKEN закрывает страницу от посторонних, если сервер доступен снаружи
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+    response = make_response(metrics.registry.render())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
 @app.route('/profile')
 @login_required
 def profile():
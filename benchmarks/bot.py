@@ -0,0 +1,271 @@
+from datetime import datetime
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import sys
+import time
+
+from aiohttp import ClientSession, TCPConnector, web
+
+from benchmarks.dataset import WORDS
+from bot_webhook import WEBHOOK_WORKERS
+from benchmarks.run import DEFAULT_DB, git_revision, percentile, prepare_dataset
+
+BENCH_TOKEN = '123456:benchmark-benchmark-benchmark-bench'
+# чат каждого синтетического апдейта свой, так первый ответ в чат отмечает конец обработки
+FIRST_CHAT_ID = 10 ** 9
+MODES = ['polling', 'webhook']
+BOT_START_TIMEOUT = 60
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tg_bot.py')
+
+
+class StandInAPI:
+    # заглушка Bot API: раздает апдейты через getUpdates или шлет их на вебхук, принимает ответы бота;
+    # каждый вызов отвечает с задержкой сети до Telegram
+    def __init__(self, latency):
+        self.latency = latency
+        self.updates = []
+        self.arrived = asyncio.Condition()
+        self.replied = {}
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.message_ids = itertools.count(1)
+        self.polling = asyncio.Event()
+        self.webhook_url = None
+        self.webhook_set = asyncio.Event()
+
+    def reset(self, expected):
+        self.updates = []
+        self.replied = {}
+        self.done = asyncio.Event()
+        self.expected = expected
+        self.polling = asyncio.Event()
+        self.webhook_set = asyncio.Event()
+
+    async def add_updates(self, updates):
+        async with self.arrived:
+            self.updates.extend(updates)
+            self.arrived.notify_all()
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'getUpdates':
+            result = await self.get_updates(int(data.get('offset') or 0), int(data.get('limit') or 100),
+                                            float(data.get('timeout') or 0))
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self.reply(int(data['chat_id']), data.get('text'))
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method == 'getWebhookInfo':
+            result = {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method == 'setWebhook':
+            self.webhook_url = data['url']
+            self.webhook_set.set()
+            result = True
+        elif method == 'deleteWebhook':
+            self.webhook_url = None
+            result = True
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, offset, limit, timeout):
+        # offset=-1 - это пропуск старых апдейтов при запуске, настоящий опрос начинается после него
+        if offset >= 0:
+            self.polling.set()
+        # длинный опрос, как у Telegram: ответ сразу, если апдейты есть, иначе ждем до timeout
+        async with self.arrived:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            if not self.updates:
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates[:limit]
+
+    def reply(self, chat_id, text):
+        if chat_id not in self.replied:
+            self.replied[chat_id] = time.perf_counter()
+            if len(self.replied) >= self.expected:
+                self.done.set()
+        return {'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+
+def make_updates(count, seed, first_update_id):
+    # смесь команд: без базы (/help), поиск пользователя (/start, /my_books) и полнотекстовый поиск
+    rng = random.Random(seed)
+    commands = [lambda: '/help', lambda: '/start', lambda: '/my_books',
+                lambda: f'/search {rng.choice(WORDS)}', lambda: f'/search {rng.choice(WORDS)}']
+    updates = []
+    for index in range(count):
+        chat_id = FIRST_CHAT_ID + first_update_id + index
+        text = rng.choice(commands)()
+        command_length = len(text.split()[0])
+        updates.append({
+            'update_id': first_update_id + index,
+            'message': {'message_id': index + 1, 'date': int(time.time()), 'text': text,
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Читатель'},
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}]}})
+    return updates
+
+
+async def feed(updates, rate, send):
+    # rate=0 - все апдейты разом, иначе равномерный поток rate апдейтов в секунду
+    sent_at = {}
+    started = time.perf_counter()
+    for index, update in enumerate(updates):
+        if rate:
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sent_at[update['message']['chat']['id']] = time.perf_counter()
+        await send(update)
+    return sent_at
+
+
+async def run_polling(api, updates, rate):
+    async def send(update):
+        await api.add_updates([update])
+
+    return await feed(updates, rate, send)
+
+
+async def run_webhook(api, updates, rate, connections):
+    # Telegram держит не больше max_connections одновременных запросов к вебхуку (по умолчанию 40)
+    async with ClientSession(connector=TCPConnector(limit=connections)) as session:
+        async def post(update):
+            async with session.post(api.webhook_url, json=update) as response:
+                response.raise_for_status()
+
+        posts = []
+
+        async def send(update):
+            posts.append(asyncio.create_task(post(update)))
+
+        sent_at = await feed(updates, rate, send)
+        await asyncio.gather(*posts)
+    return sent_at
+
+
+async def wait_listening(url):
+    # aiohttp вызывает on_startup (и setWebhook) до того, как начинает слушать порт
+    port = int(url.rsplit(':', 1)[1].split('/')[0])
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def start_bot_process(mode, api_url, args):
+    # бот запускается так же, как в работе, отдельным процессом: заглушка не делит с ним процессор
+    port = free_port()
+    env = dict(os.environ, BOT_MODE=mode, TG_API_SERVER=api_url, TG_TOKEN=BENCH_TOKEN, LIBRARY_DB=args.db,
+               WEBHOOK_URL=f'http://127.0.0.1:{port}/webhook', WEBHOOK_PATH='/webhook',
+               WEBHOOK_LISTEN_PORT=str(port), WEBHOOK_WORKERS=str(args.workers))
+    env.pop('WEBHOOK_SECRET', None)
+    return await asyncio.create_subprocess_exec(sys.executable, BOT_SCRIPT, env=env,
+                                                stdout=asyncio.subprocess.DEVNULL)
+
+
+async def run(args):
+    api = StandInAPI(args.api_latency)
+    api_app = web.Application()
+    api_app.router.add_post('/bot{token}/{method}', api.handle)
+    api_runner = web.AppRunner(api_app, access_log=None)
+    await api_runner.setup()
+    await web.TCPSite(api_runner, '127.0.0.1', 0).start()
+    api_url = f'http://127.0.0.1:{api_runner.addresses[0][1]}'
+
+    results = {}
+    first_update_id = 1
+    for mode in args.mode or MODES:
+        updates = make_updates(args.warmup + args.updates, args.seed, first_update_id)
+        first_update_id += len(updates)
+        api.reset(len(updates))
+        bot_process = await start_bot_process(mode, api_url, args)
+        try:
+            ready = api.polling if mode == 'polling' else api.webhook_set
+            await asyncio.wait_for(ready.wait(), BOT_START_TIMEOUT)
+            if mode == 'webhook':
+                await asyncio.wait_for(wait_listening(api.webhook_url), BOT_START_TIMEOUT)
+            started = time.perf_counter()
+            if mode == 'polling':
+                sent_at = await run_polling(api, updates, args.rate)
+            else:
+                sent_at = await run_webhook(api, updates, args.rate, args.connections)
+            await api.done.wait()
+            elapsed = time.perf_counter() - started
+        finally:
+            bot_process.send_signal(signal.SIGINT)
+            await bot_process.wait()
+
+        measured = [update['message']['chat']['id'] for update in updates[args.warmup:]]
+        latencies = [(api.replied[chat_id] - sent_at[chat_id]) * 1000 for chat_id in measured]
+        results[mode] = {
+            'updates': len(measured),
+            'updates_per_second': round(len(updates) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5), 3),
+            'p90_ms': round(percentile(latencies, 0.9), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'max_ms': round(max(latencies), 3)}
+        print(f'{mode}: {results[mode]}', file=sys.stderr)
+
+    await api_runner.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пропускная способность бота: long polling против вебхука')
+    parser.add_argument('--db', default=DEFAULT_DB, help='база для прогона; если ее нет, она будет сгенерирована')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--loans', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--updates', type=int, default=2000, help='замеряемых апдейтов на режим')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0, help='апдейтов в секунду; 0 - все разом')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='задержка ответа заглушки Bot API, секунды')
+    parser.add_argument('--workers', type=int, default=WEBHOOK_WORKERS, help='обработчиков вебхука')
+    parser.add_argument('--connections', type=int, default=40, help='одновременных запросов к вебхуку')
+    parser.add_argument('--mode', action='append', choices=MODES, help='можно указать несколько раз')
+    parser.add_argument('--output', help='файл для JSON с результатами, по умолчанию stdout')
+    args = parser.parse_args()
+
+    dataset = prepare_dataset(args)
+    results = {
+        'meta': {'timestamp': datetime.utcnow().isoformat(timespec='seconds'), 'revision': git_revision(),
+                 'python': platform.python_version(), 'dataset': dataset, 'rate': args.rate,
+                 'api_latency': args.api_latency, 'workers': args.workers, 'connections': args.connections},
+        'modes': asyncio.run(run(args))}
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
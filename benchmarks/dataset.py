@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+import argparse
+import io
+import os
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+from data import db_session
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.genres import DEFAULT_GENRES, Genre
+from data.users import User
+from data.ratings import DEFAULT_POLICY, open_rating_balances
+from helping_functions import image_hash
+from image_pipeline import store_original
+
+WORDS = ['тайна', 'дом', 'ночь', 'город', 'море', 'война', 'мир', 'сад', 'зима', 'дорога', 'звезда', 'тень', 'остров',
+         'письмо', 'сердце', 'лес', 'река', 'север', 'огонь', 'песня', 'время', 'ветер', 'память', 'мост', 'корабль',
+         'замок', 'небо', 'гора', 'свет', 'ключ', 'последний', 'старый', 'белый', 'черный', 'далекий', 'тихий',
+         'потерянный', 'красный', 'забытый', 'золотой', 'долгий', 'чужой', 'великий', 'ночной', 'морской', 'летний']
+FIRST_NAMES = ['Анна', 'Иван', 'Мария', 'Петр', 'Елена', 'Сергей', 'Ольга', 'Алексей', 'Наталья', 'Дмитрий',
+               'Татьяна', 'Михаил', 'Ирина', 'Николай', 'Светлана', 'Андрей', 'Юлия', 'Павел', 'Вера', 'Борис']
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев', 'Козлов', 'Новиков', 'Морозов',
+              'Волков', 'Алексеев', 'Павлов', 'Семенов', 'Голубев', 'Виноградов', 'Богданов', 'Воробьев',
+              'Федоров', 'Михайлов', 'Беляев', 'Тарасов', 'Белов', 'Комаров', 'Орлов', 'Киселев', 'Макаров']
+CHUNK_SIZE = 2000
+
+
+def make_cover(rng, index):
+    image = Image.new('RGB', (120, 180), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y = rng.randrange(120), rng.randrange(180)
+        draw.rectangle((x, y, x + rng.randrange(10, 60), y + rng.randrange(5, 30)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    draw.text((10, 80), f'#{index}', fill=(255, 255, 255))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=80)
+    return buffer.getvalue()
+
+
+def make_title(rng):
+    return ' '.join(rng.sample(WORDS, rng.choice((1, 2, 2, 3)))).capitalize()
+
+
+def generate(db_sess, users=1000, books=10000, loans=2000, covers=200, cover_share=0.5, seed=1, legacy_cover_share=0.0):
+    # одинаковые параметры и seed дают одинаковую базу, так результаты разных запусков сравнимы
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+
+    genres = {genre.name: genre for genre in db_sess.query(Genre)}
+    for name in DEFAULT_GENRES:
+        if name not in genres:
+            genres[name] = Genre(name=name, book_count=0)
+            db_sess.add(genres[name])
+    db_sess.commit()
+
+    # администратор для сценариев API; пароли хранятся так же, как при регистрации
+    db_sess.add(User(name='Бенчмарк', username='bench_admin', password='bench', role='admin'))
+    for i in range(users):
+        rating = rng.randint(40, 180)
+        db_sess.add(User(name=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}', username=f'reader{i}',
+                         password='bench', role='reader', rating=rating,
+                         max_borrow_days=DEFAULT_POLICY.max_borrow_days(rating),
+                         telegram_id=100000 + i if rng.random() < 0.3 else None))
+    db_sess.flush()
+    open_rating_balances(db_sess.connection())
+    db_sess.commit()
+
+    cover_images = [make_cover(rng, i) for i in range(covers)]
+    cover_hashes = [image_hash(data) for data in cover_images]
+    for cover_hash, cover_image in zip(cover_hashes, cover_images):
+        store_original(db_sess, cover_hash, cover_image)
+    authors = [f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}' for _ in range(max(books // 20, 1))]
+
+    for start in range(0, books, CHUNK_SIZE):
+        chunk = []
+        for _ in range(start, min(start + CHUNK_SIZE, books)):
+            names = rng.sample(DEFAULT_GENRES, rng.choice((1, 1, 2, 3)))
+            book = Book(title=make_title(rng), author=rng.choice(authors), genre=', '.join(names),
+                        quantity=rng.randint(1, 6), genres=[genres[name] for name in names])
+            if covers and rng.random() < cover_share:
+                index = rng.randrange(covers)
+                if legacy_cover_share and rng.random() < legacy_cover_share:
+                    # обложка, сохраненная до хэшей: байты лежат в самой книге, /cover перенесет их
+                    book.image_data = cover_images[index]
+                else:
+                    book.image_hash = cover_hashes[index]
+                    book.image_updated_at = now
+            db_sess.add(book)
+            chunk.append(book)
+        db_sess.commit()
+        # книги пачки больше не нужны, identity map не должна расти вместе с каталогом
+        for book in chunk:
+            db_sess.expunge(book)
+
+    user_ids = [user_id for user_id, in db_sess.query(User.id).filter(User.role == 'reader')]
+    book_ids = [book_id for book_id, in db_sess.query(Book.id).filter(Book.quantity > 0)]
+    pairs = set()
+    while user_ids and book_ids and len(pairs) < min(loans, len(user_ids) * len(book_ids)):
+        pairs.add((rng.choice(user_ids), rng.choice(book_ids)))
+
+    pairs = sorted(pairs)
+    for start in range(0, len(pairs), CHUNK_SIZE):
+        for user_id, book_id in pairs[start:start + CHUNK_SIZE]:
+            borrowed_at = now - timedelta(days=rng.randint(0, 40), hours=rng.randint(0, 23))
+            # часть выдач просрочена, часть истекает в ближайшие дни - для напоминаний и отчетов
+            db_sess.add(BorrowedBook(user_id=user_id, book_id=book_id, borrowed_at=borrowed_at,
+                                     return_by=now + timedelta(days=rng.randint(-10, 30), hours=rng.randint(0, 23))))
+            db_sess.query(Book).filter(Book.id == book_id, Book.quantity > 0).update(
+                {Book.quantity: Book.quantity - 1}, synchronize_session=False)
+        db_sess.commit()
+
+    return {'users': users, 'books': books, 'loans': len(pairs), 'covers': covers, 'seed': seed,
+            'legacy_cover_share': legacy_cover_share}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Генерация тестовой базы библиотеки')
+    parser.add_argument('--db', default='bench/library.db')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--loans', type=int, default=2000)
+    parser.add_argument('--covers', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--legacy-covers', type=float, default=0, help='доля обложек в books.image_data, без хэша')
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        parser.error(f'{args.db} already exists')
+    os.makedirs(os.path.dirname(args.db) or '.', exist_ok=True)
+
+    started = time.perf_counter()
+    db_session.global_init(args.db)
+    with db_session.session_scope() as db_sess:
+        summary = generate(db_sess, args.users, args.books, args.loans, args.covers, seed=args.seed,
+                           legacy_cover_share=args.legacy_covers)
+    print(f'{summary} in {time.perf_counter() - started:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
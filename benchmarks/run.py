@@ -0,0 +1,376 @@
+from datetime import datetime
+import argparse
+import json
+import os
+import base64
+import platform
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import undefer
+
+from data import db_session
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.genres import DEFAULT_GENRES
+from data.queries import query_book_rows
+from data.users import User
+from benchmarks.dataset import WORDS, generate
+from helping_functions import image_mimetype
+from image_pipeline import ORIGINAL, get_rendition
+
+DEFAULT_DB = 'bench/library.db'
+# сценарии выполняются в этом порядке: return сдает книги, взятые в borrow
+SCENARIO_ORDER = ['home', 'books', 'books_page_bytes', 'books_search', 'books_genre', 'books_author', 'my_books',
+                  'borrow', 'return', 'api_books', 'api_books_batch', 'api_book', 'books_load']
+# обложка в src карточки; srcset браузер с обычным экраном не загружает
+COVER_SRC = re.compile(r'src="(/cover/(\d+)[^"]*)"')
+
+_query_count = 0
+
+
+def _count_query(*args):
+    global _query_count
+    _query_count += 1
+
+
+class Context:
+    def __init__(self, app, seed):
+        self.rng = random.Random(seed)
+        with db_session.session_scope() as db_sess:
+            self.max_book_id = db_sess.query(func.max(Book.id)).scalar() or 0
+            self.authors = [author for author, in db_sess.query(Book.author).distinct().limit(200)]
+            admin_id = db_sess.query(User.id).filter(User.role == 'admin').order_by(User.id).first()[0]
+            # у самого активного читателя страница "Мои книги" самая тяжелая
+            reader_id = (db_sess.query(BorrowedBook.user_id).group_by(BorrowedBook.user_id)
+                         .order_by(func.count().desc()).first()
+                         or db_sess.query(User.id).filter(User.role == 'reader').first())[0]
+            borrowed = {book_id for book_id, in db_sess.query(BorrowedBook.book_id).filter_by(user_id=reader_id)}
+            self.available = [book_id for book_id, in db_sess.query(Book.id).filter(Book.quantity > 0)
+                              .order_by(Book.id).limit(5000) if book_id not in borrowed]
+        self.rng.shuffle(self.available)
+        self.just_borrowed = []
+        self.reader = login(app, reader_id)
+        self.admin = login(app, admin_id)
+
+    def random_id(self):
+        return self.rng.randint(1, max(self.max_book_id, 1))
+
+
+def login(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    return client
+
+
+# каждый сценарий - генератор пар (клиент, url) для одного запроса
+def home(ctx):
+    while True:
+        yield ctx.reader, '/home'
+
+
+def books(ctx):
+    while True:
+        yield ctx.reader, f'/books?cursor={ctx.random_id()}'
+
+
+def books_search(ctx):
+    while True:
+        yield ctx.reader, f'/books?search={ctx.rng.choice(WORDS)}'
+
+
+def books_genre(ctx):
+    while True:
+        genres = '&'.join(f'genre={name}' for name in ctx.rng.sample(DEFAULT_GENRES, 2))
+        yield ctx.reader, f'/books?{genres}'
+
+
+def books_author(ctx):
+    while True:
+        yield ctx.reader, f'/author/{ctx.rng.choice(ctx.authors)}'
+
+
+def my_books(ctx):
+    while True:
+        yield ctx.reader, '/my_books'
+
+
+def borrow(ctx):
+    while ctx.available:
+        book_id = ctx.available.pop()
+        ctx.just_borrowed.append(book_id)
+        yield ctx.reader, f'/borrow/{book_id}'
+
+
+def return_(ctx):
+    while ctx.just_borrowed:
+        yield ctx.reader, f'/return/{ctx.just_borrowed.pop()}'
+
+
+def api_books(ctx):
+    while True:
+        yield ctx.admin, f'/api/v1/books?cursor={ctx.random_id()}&limit=100'
+
+
+def api_books_batch(ctx):
+    while True:
+        ids = ','.join(str(ctx.random_id()) for _ in range(100))
+        yield ctx.admin, f'/api/v1/books?ids={ids}&fields=id,title,quantity'
+
+
+def api_book(ctx):
+    while True:
+        yield ctx.admin, f'/api/v1/book/{ctx.random_id()}'
+
+
+SCENARIOS = {'home': home, 'books': books, 'books_search': books_search, 'books_genre': books_genre,
+             'books_author': books_author, 'my_books': my_books, 'borrow': borrow, 'return': return_,
+             'api_books': api_books, 'api_books_batch': api_books_batch, 'api_book': api_book}
+
+
+def books_page_bytes(ctx, args):
+    # вес страницы каталога: HTML, обложки по ссылкам при первом визите (при повторном они в кэше
+    # браузера на год) и прежний вариант, где каждая обложка встраивалась в HTML как base64
+    global _query_count
+    html_ms, inline_ms, queries = [], [], []
+    html_bytes, first_visit_bytes, inline_bytes = [], [], []
+
+    for index in range(args.warmup + args.requests):
+        _query_count = 0
+        started = time.perf_counter()
+        response = ctx.reader.get(f'/books?cursor={ctx.random_id()}')
+        elapsed = time.perf_counter() - started
+        html = response.get_data()
+        page_queries = _query_count
+        covers = COVER_SRC.findall(html.decode('utf-8'))
+
+        cover_bytes = sum(len(ctx.reader.get(url).get_data()) for url, _ in covers)
+
+        # встраивание: оригинал каждой обложки читается из базы и кодируется в data URI
+        started = time.perf_counter()
+        data_uris = []
+        with db_session.session_scope() as db_sess:
+            hashes = dict(db_sess.query(Book.id, Book.image_hash)
+                          .filter(Book.id.in_([int(book_id) for _, book_id in covers])))
+            for url, book_id in covers:
+                image_data = get_rendition(db_sess, hashes[int(book_id)], ORIGINAL)
+                data_uris.append((url, f'data:{image_mimetype(image_data)};base64,'
+                                       f'{base64.b64encode(image_data).decode()}'))
+        encode_seconds = time.perf_counter() - started
+
+        if index < args.warmup:
+            continue
+        html_ms.append(elapsed * 1000)
+        inline_ms.append((elapsed + encode_seconds) * 1000)
+        queries.append(page_queries)
+        html_bytes.append(len(html))
+        first_visit_bytes.append(len(html) + cover_bytes)
+        inline_bytes.append(len(html) + sum(len(data_uri) - len(url) for url, data_uri in data_uris))
+
+    if not html_ms:
+        return {'requests': 0}
+    return {
+        'requests': len(html_ms),
+        'p50_ms': round(percentile(html_ms, 0.5), 3),
+        'inline_p50_ms': round(percentile(inline_ms, 0.5), 3),
+        'queries_mean': round(sum(queries) / len(queries), 2),
+        'html_kb_mean': round(sum(html_bytes) / len(html_bytes) / 1024, 1),
+        'first_visit_kb_mean': round(sum(first_visit_bytes) / len(first_visit_bytes) / 1024, 1),
+        'repeat_visit_kb_mean': round(sum(html_bytes) / len(html_bytes) / 1024, 1),
+        'inline_kb_mean': round(sum(inline_bytes) / len(inline_bytes) / 1024, 1)}
+
+
+# способы загрузить каталог целиком: как до отложенной обложки, как грузятся сущности сейчас
+# и строками-кортежами, как его читают списки
+BOOK_LOADS = {
+    'entities_with_blob': lambda db_sess, rows: db_sess.query(Book).options(undefer(Book.image_data)).limit(rows).all(),
+    'entities_deferred': lambda db_sess, rows: db_sess.query(Book).limit(rows).all(),
+    'book_rows': lambda db_sess, rows: query_book_rows(db_sess).limit(rows).all()}
+
+
+def books_load(ctx, args):
+    # разница видна, когда обложки лежат в books.image_data: база с --legacy-covers 1 --books 50000
+    results = {}
+    for name, load in BOOK_LOADS.items():
+        latencies = []
+        for index in range(args.warmup_loads + args.load_repeats):
+            with db_session.session_scope() as db_sess:
+                started = time.perf_counter()
+                rows = len(load(db_sess, args.load_rows))
+                elapsed = time.perf_counter() - started
+            if index >= args.warmup_loads:
+                latencies.append(elapsed * 1000)
+
+        # память отдельным прогоном: под tracemalloc загрузка идет в разы медленнее
+        tracemalloc.start()
+        with db_session.session_scope() as db_sess:
+            load(db_sess, args.load_rows)
+            peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = {'rows': rows, 'p50_ms': round(percentile(latencies, 0.5), 3),
+                         'max_ms': round(max(latencies), 3), 'peak_memory_mb': round(peak / 1024 / 1024, 1)}
+    return results
+
+
+# сценарии со своим циклом замера вместо run_scenario
+MEASUREMENTS = {'books_page_bytes': books_page_bytes, 'books_load': books_load}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def run_scenario(ctx, name, requests, warmup, memory_requests):
+    global _query_count
+    requests_iter = SCENARIOS[name](ctx)
+    latencies = []
+    queries = []
+    statuses = {}
+
+    for index, (client, url) in zip(range(warmup + requests + memory_requests), requests_iter):
+        measure_memory = index >= warmup + requests
+        if measure_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if measure_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+
+        _query_count = 0
+        started = time.perf_counter()
+        response = client.get(url)
+        elapsed = time.perf_counter() - started
+        response.close()
+
+        if measure_memory:
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            ctx.peak_memory = max(ctx.peak_memory, peak)
+        elif index >= warmup:
+            latencies.append(elapsed * 1000)
+            queries.append(_query_count)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    if not latencies:
+        return {'requests': 0}
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p90_ms': round(percentile(latencies, 0.9), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'queries_mean': round(sum(queries) / len(queries), 2),
+        'queries_max': max(queries),
+        'peak_memory_kb': round(ctx.peak_memory / 1024, 1),
+        'status_codes': {str(code): count for code, count in sorted(statuses.items())}}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # регрессия - рост p50 больше допуска или рост числа запросов к БД
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous or not current.get('requests') or not previous.get('requests'):
+            continue
+        if current['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {previous['p50_ms']} -> {current['p50_ms']} ms")
+        if current['queries_mean'] > previous['queries_mean']:
+            regressions.append(f"{name}: queries {previous['queries_mean']} -> {current['queries_mean']}")
+    return regressions
+
+
+def prepare_dataset(args):
+    if os.path.exists(args.db):
+        return {'existing_db': args.db}
+    os.makedirs(os.path.dirname(args.db) or '.', exist_ok=True)
+    db_session.global_init(args.db)
+    with db_session.session_scope() as db_sess:
+        return generate(db_sess, args.users, args.books, args.loans, seed=args.seed,
+                        legacy_cover_share=getattr(args, 'legacy_covers', 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочные сценарии веб-приложения библиотеки')
+    parser.add_argument('--db', default=DEFAULT_DB, help='база для прогона; если ее нет, она будет сгенерирована')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--loans', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help='замеряемых запросов на сценарий')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--memory-requests', type=int, default=20, help='запросов под tracemalloc на сценарий')
+    parser.add_argument('--load-rows', type=int, default=50000, help='строк каталога в сценарии books_load')
+    parser.add_argument('--load-repeats', type=int, default=3)
+    parser.add_argument('--warmup-loads', type=int, default=1)
+    parser.add_argument('--legacy-covers', type=float, default=0,
+                        help='доля обложек в books.image_data при генерации базы')
+    parser.add_argument('--scenario', action='append', choices=SCENARIO_ORDER, help='можно указать несколько раз')
+    parser.add_argument('--output', help='файл для JSON с результатами, по умолчанию stdout')
+    parser.add_argument('--baseline', help='JSON предыдущего прогона для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='допустимый рост p50, доля')
+    args = parser.parse_args()
+
+    dataset = prepare_dataset(args)
+
+    # приложение открывает базу при импорте, поэтому путь задается до него
+    os.environ['LIBRARY_DB'] = args.db
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    from app import app
+
+    event.listen(Engine, 'before_cursor_execute', _count_query)
+    ctx = Context(app, args.seed)
+
+    results = {
+        'meta': {'timestamp': datetime.utcnow().isoformat(timespec='seconds'), 'revision': git_revision(),
+                 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'dataset': dataset,
+                 'requests': args.requests, 'warmup': args.warmup},
+        'scenarios': {}}
+    for name in args.scenario or SCENARIO_ORDER:
+        ctx.peak_memory = 0
+        if name in MEASUREMENTS:
+            results['scenarios'][name] = MEASUREMENTS[name](ctx, args)
+        else:
+            results['scenarios'][name] = run_scenario(ctx, name, args.requests, args.warmup, args.memory_requests)
+        print(f"{name}: {results['scenarios'][name]}", file=sys.stderr)
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
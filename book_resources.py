@@ -1,27 +1,294 @@
-from flask import jsonify
+import hashlib
+import io
+
+from flask import jsonify, request, Response, stream_with_context
+from flask_login import current_user
 from flask_restful import abort, Resource
+from sqlalchemy import bindparam, update
+
+import catalog_io
 
 from data import db_session
 from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.catalog_version import get_catalog_version
+from data.circulation import get_circulation_report
+from data.genres import set_book_genres
+from data.queries import keyset_page
+from data.waitlist import notice_bell
+
+BOOK_FIELDS = ('title', 'author', 'genre')
+# что можно запросить через ?fields=
+API_FIELDS = ('id', 'title', 'author', 'genre', 'quantity')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_OPERATIONS = 5000
+BATCH_OPERATIONS = ('create', 'update', 'delete', 'adjust')
+
+ADJUST_QUANTITY = (update(Book.__table__)
+                   .where(Book.id == bindparam('book_id'), Book.quantity + bindparam('delta') >= 0)
+                   .values(quantity=Book.quantity + bindparam('delta')))
 
 
-def abort_if_not_found(book_id):
-    session = db_session.create_session()
-    book = session.query(Book).get(book_id)
+def book_columns(fields):
+    return [getattr(Book, field) for field in fields]
+
+
+def abort_if_not_found(session, book_id, fields):
+    book = session.query(*book_columns(fields)).filter(Book.id == book_id).first()
     if not book:
         abort(404, message=f"Book {book_id} not found")
+    return book
+
+
+def parse_page_args():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        cursor = int(request.args.get('cursor', 0))
+    except ValueError:
+        abort(400, message="limit and cursor must be integers")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        abort(400, message=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return cursor, limit
+
+
+def parse_fields_arg():
+    if 'fields' not in request.args:
+        return BOOK_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in request.args['fields'].split(',') if field.strip()))
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if not fields or unknown:
+        abort(400, message=f"fields must be a comma separated subset of {', '.join(API_FIELDS)}")
+    return fields
+
+
+def parse_ids_arg():
+    try:
+        ids = list(dict.fromkeys(int(book_id) for book_id in request.args['ids'].split(',') if book_id.strip()))
+    except ValueError:
+        abort(400, message="ids must be comma separated integers")
+    if not 1 <= len(ids) <= MAX_PAGE_SIZE:
+        abort(400, message=f"ids must contain from 1 to {MAX_PAGE_SIZE} values")
+    return ids
+
+
+def catalog_etag(session):
+    # версия каталога меняется при любой записи в books, путь с параметрами различает представления
+    digest = hashlib.sha1(request.full_path.encode()).hexdigest()[:12]
+    return f'{get_catalog_version(session)}-{digest}'
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    # клиент может хранить ответ, но перед использованием обязан его перепроверить
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def validate_book_data(data, partial):
+    # partial - обновление: проверяются только переданные поля
+    values = {}
+    for field in ('title', 'author', 'genre'):
+        if field in data or not partial:
+            value = data.get(field)
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError(f"{field} must be a non-empty string")
+            values[field] = value.strip()
+    if 'quantity' in data or not partial:
+        quantity = data.get('quantity', 1)
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+            raise ValueError("quantity must be a non-negative integer")
+        values['quantity'] = quantity
+    return values
+
+
+def apply_operation(session, operation, books, borrowed_ids, known_genres):
+    op = operation.get('op')
+    if op not in BATCH_OPERATIONS:
+        raise ValueError(f"op must be one of {', '.join(BATCH_OPERATIONS)}")
+
+    if op == 'create':
+        book = Book(**validate_book_data(operation, partial=False))
+        set_book_genres(session, book, book.genre, known_genres)
+        session.add(book)
+        return book
+
+    book_id = operation.get('id')
+    if book_id not in books:
+        raise LookupError(f"Book {book_id} not found")
+    book = books[book_id]
+
+    if op == 'update':
+        values = validate_book_data(operation, partial=True)
+        for field, value in values.items():
+            setattr(book, field, value)
+        if 'genre' in values:
+            set_book_genres(session, book, book.genre, known_genres)
+    elif op == 'delete':
+        if book_id in borrowed_ids:
+            raise ValueError(f"Book {book_id} has borrowed copies")
+        session.delete(book)
+        del books[book_id]
+    else:
+        delta = operation.get('delta')
+        if not isinstance(delta, int) or isinstance(delta, bool):
+            raise ValueError("delta must be an integer")
+        # изменение считается в SQL с условием, как при выдаче книги: остаток не уйдет в минус
+        # даже если читатель взял экземпляр после загрузки пачки
+        updated = session.execute(ADJUST_QUANTITY, {'book_id': book_id, 'delta': delta}).rowcount
+        if not updated:
+            raise ValueError(f"quantity of book {book_id} can not become negative")
+        # запрос идет мимо ORM, загруженная книга перечитает остаток при обращении
+        session.expire(book, ['quantity'])
+    return book
+
+
+def serialize(row, fields):
+    return {field: getattr(row, field) for field in fields}
+
+
+def abort_if_not_admin():
+    if not current_user.is_authenticated or current_user.role != "admin":
+        abort(403, message="Admin rights required")
+
+
+def export_response(file_format, cursor=0):
+    # одна выгрузка для API и админки; сессия живет, пока клиент читает поток, и строки приходят из БД пачками
+    def generate():
+        session = db_session.create_session()
+        try:
+            yield from catalog_io.export_books(session, file_format, cursor)
+        finally:
+            session.close()
+
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
 
 
 class BookResource(Resource):
     def get(self, book_id):
-        abort_if_not_found(book_id)
+        fields = parse_fields_arg()
         session = db_session.create_session()
-        book = session.query(Book).get(book_id)
-        return jsonify({'book': book.to_dict(only=('title', 'author', 'genre'))})
+        etag = catalog_etag(session)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+
+        book = abort_if_not_found(session, book_id, fields)
+        return with_etag(jsonify({'book': serialize(book, fields)}), etag)
 
 
 class BooksListResource(Resource):
     def get(self):
+        cursor, limit = parse_page_args()
+
+        if request.args.get('format') == 'ndjson':
+            return export_response('jsonl', cursor)
+
+        fields = parse_fields_arg()
+        ids = parse_ids_arg() if 'ids' in request.args else None
+        session = db_session.create_session()
+        # проверка версии - один запрос к строке catalog_version, до выборки и сериализации книг
+        etag = catalog_etag(session)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+
+        if ids is not None:
+            # пачка книг одним запросом; id в ответе всегда есть, чтобы сопоставить результат с запросом
+            rows = session.query(Book.id, *book_columns(fields)).filter(Book.id.in_(ids)).all()
+            found = {row.id: dict(serialize(row, fields), id=row.id) for row in rows}
+            return with_etag(jsonify({'books': [found[book_id] for book_id in ids if book_id in found],
+                                      'missing': [book_id for book_id in ids if book_id not in found]}), etag)
+
+        query = session.query(Book.id, *book_columns(fields))
+        books, next_cursor = keyset_page(query, cursor, limit)
+        return with_etag(jsonify({'books': [serialize(row, fields) for row in books],
+                                  'next_cursor': next_cursor}), etag)
+
+
+class BooksBatchResource(Resource):
+    def post(self):
+        abort_if_not_admin()
+        payload = request.get_json(silent=True) or {}
+        operations = payload.get('operations')
+        if not isinstance(operations, list) or not 1 <= len(operations) <= MAX_BATCH_OPERATIONS:
+            abort(400, message=f"operations must be a list of 1 to {MAX_BATCH_OPERATIONS} items")
+        if not all(isinstance(operation, dict) for operation in operations):
+            abort(400, message="every operation must be an object")
+        # atomic: при любой ошибке не применяется ничего, иначе ошибочные операции просто пропускаются
+        atomic = bool(payload.get('atomic'))
+
+        session = db_session.create_session()
+        # все затронутые книги и их выдачи грузятся двумя запросами на всю пачку
+        ids = {operation.get('id') for operation in operations if operation.get('op') in ('update', 'delete', 'adjust')}
+        ids = {book_id for book_id in ids if isinstance(book_id, int) and not isinstance(book_id, bool)}
+        books = {book.id: book for book in session.query(Book).filter(Book.id.in_(ids))} if ids else {}
+        borrowed_ids = {book_id for book_id, in session.query(BorrowedBook.book_id)
+                        .filter(BorrowedBook.book_id.in_(ids)).distinct()} if ids else set()
+        known_genres = {}
+
+        applied = []
+        results = []
+        for index, operation in enumerate(operations):
+            try:
+                book = apply_operation(session, operation, books, borrowed_ids, known_genres)
+            except (ValueError, LookupError) as e:
+                results.append({'index': index, 'status': 'error', 'error': str(e)})
+                continue
+            applied.append((len(results), book))
+            results.append({'index': index, 'status': 'ok'})
+
+        failed = sum(result['status'] == 'error' for result in results)
+        if atomic and failed:
+            session.rollback()
+            response = jsonify({'applied': 0, 'failed': failed, 'results': results})
+            response.status_code = 409
+            return response
+
+        # одна транзакция на всю пачку; id новых книг известны после flush
+        session.flush()
+        for position, book in applied:
+            results[position]['id'] = book.id
+        session.commit()
+        # прибавка экземпляров могла создать уведомления листа ожидания
+        notice_bell.ring()
+        return jsonify({'applied': len(applied), 'failed': failed, 'results': results})
+
+
+class CirculationReportResource(Resource):
+    def get(self):
+        abort_if_not_admin()
+        limit = request.args.get('limit', 20, type=int)
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            abort(400, message=f"limit must be between 1 and {MAX_PAGE_SIZE}")
         session = db_session.create_session()
-        books = session.query(Book).all()
-        return jsonify({'books': [item.to_dict(only=('title', 'author', 'genre')) for item in books]})
\ No newline at end of file
+        return jsonify(get_circulation_report(session, limit))
+
+
+class CatalogImportResource(Resource):
+    def post(self):
+        abort_if_not_admin()
+        file_format = request.args.get('format') or ('jsonl' if 'json' in (request.mimetype or '') else 'csv')
+        if file_format not in ('csv', 'jsonl'):
+            abort(400, message="format must be csv or jsonl")
+
+        # тело читается потоком, без загрузки файла в память целиком
+        request.max_content_length = catalog_io.IMPORT_MAX_BYTES
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+        session = db_session.create_session()
+        report = catalog_io.import_books(session, catalog_io.iter_records(stream, file_format))
+        return jsonify(report)
+
+
+class CatalogExportResource(Resource):
+    def get(self):
+        abort_if_not_admin()
+        file_format = request.args.get('format', 'jsonl')
+        if file_format not in ('csv', 'jsonl'):
+            abort(400, message="format must be csv or jsonl")
+        return export_response(file_format)
@@ -0,0 +1,110 @@
+import asyncio
+import hmac
+import logging
+import os
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+import metrics
+
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or '/telegram/webhook'
+# сервер слушает только локальный адрес: TLS и внешний адрес остаются на обратном прокси
+WEBHOOK_LISTEN_HOST = os.getenv('WEBHOOK_LISTEN_HOST') or '127.0.0.1'
+WEBHOOK_LISTEN_PORT = int(os.getenv('WEBHOOK_LISTEN_PORT') or 8081)
+# обработчики в основном ждут ответа Bot API, параллельность запросов к базе ограничивает DB_WORKERS
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS') or 32)
+# апдейтов в очереди одного обработчика; при переполнении ответ Telegram задерживается, и он шлет медленнее
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE') or 100)
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def chat_key(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        query = update.callback_query
+        return query.message.chat.id if query.message else query.from_user.id
+    return update.update_id
+
+
+class UpdateWorkers:
+    # фиксированное число обработчиков, у каждого своя очередь. Апдейты одного чата всегда попадают
+    # к одному обработчику, поэтому шаги регистрации и входа не обгоняют друг друга
+    def __init__(self, dp, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.dp = dp
+        self.queues = [asyncio.Queue(queue_size) for _ in range(workers)]
+        self._tasks = []
+        self.processed = 0
+
+    def start(self):
+        # обработчики наследуют контекст, в котором созданы
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        self._tasks = [asyncio.create_task(self._work(queue)) for queue in self.queues]
+
+    async def put(self, update, key):
+        await self.queues[key % len(self.queues)].put(update)
+
+    def pending(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def _work(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                # своя задача на каждый апдейт, как при polling: StateFilter кэширует состояние
+                # в contextvar, и в общем контексте второй апдейт увидел бы состояние первого
+                await asyncio.create_task(self.dp.process_update(update))
+            except Exception:
+                logging.exception(f'failed to process update {update.update_id}')
+            finally:
+                self.processed += 1
+                queue.task_done()
+
+    async def stop(self):
+        # принятые апдейты Telegram уже не пришлет повторно, поэтому очереди дорабатываются до конца
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def make_webhook_app(dp, path=WEBHOOK_PATH, secret=None, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+    update_workers = UpdateWorkers(dp, workers, queue_size)
+
+    async def receive_update(request):
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            raise web.HTTPForbidden()
+        try:
+            payload = await request.json()
+            # тело должно быть объектом апдейта: список, число или объект без update_id - ошибка клиента, а не 500
+            if not isinstance(payload, dict) or not isinstance(payload.get('update_id'), int):
+                raise ValueError('update object expected')
+            update = types.Update(**payload)
+            # aiogram не проверяет типы вложенных полей, их впервые читает chat_key
+            key = chat_key(update)
+            if not isinstance(key, int):
+                raise ValueError('chat id must be an integer')
+        except (ValueError, TypeError, AttributeError):
+            raise web.HTTPBadRequest()
+        # ответ сразу после постановки в очередь: Telegram не ждет обработки и шлет следующий апдейт
+        await update_workers.put(update, key)
+        return web.Response()
+
+    async def on_startup(app):
+        update_workers.start()
+
+    async def on_shutdown(app):
+        await update_workers.stop()
+
+    app = web.Application()
+    app['update_workers'] = update_workers
+    app.router.add_post(path, receive_update)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    metrics.registry.add_collector(lambda: [('library_bot_webhook_queue', (), update_workers.pending())])
+    return app
+
+
+metrics.registry.describe('library_bot_webhook_queue', 'gauge', 'Webhook updates waiting for a worker')
@@ -0,0 +1,218 @@
+from datetime import datetime
+import argparse
+import csv
+import io
+import json
+import os
+import time
+
+from data import db_session
+from data.books import Book
+from data.genres import Genre, parse_genres
+from data.search import pause_search_index, resume_search_index
+from helping_functions import image_hash
+from image_pipeline import ORIGINAL
+
+CATALOG_FIELDS = ('id', 'title', 'author', 'genre', 'quantity')
+IMPORT_CHUNK_SIZE = 5000
+EXPORT_BATCH_SIZE = 1000
+BOOK_IMPORT_COLUMNS = ('title', 'author', 'genre', 'quantity', 'image_hash', 'image_updated_at')
+# предел тела запроса для импорта через API; общий MAX_CONTENT_LENGTH сайта рассчитан на обложки
+IMPORT_MAX_BYTES = int(os.getenv('CATALOG_IMPORT_MAX_MB') or 512) * 1024 * 1024
+
+
+def iter_records(stream, file_format):
+    # stream - текстовый поток, строки читаются по одной и не копятся в памяти
+    if file_format == 'csv':
+        for line_number, record in enumerate(csv.DictReader(stream), start=2):
+            yield line_number, record
+    elif file_format == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_number, {'_error': f'bad json: {e}'}
+    else:
+        raise ValueError(f'unknown format {file_format}')
+
+
+def _text_field(record, field):
+    # в JSONL поле может оказаться числом или списком; это ошибка строки, а не падение всего импорта
+    value = record.get(field)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be a string')
+    return value.strip()
+
+
+def validate_record(record, genre_ids, covers_dir=None):
+    if not isinstance(record, dict):
+        raise ValueError('record must be an object')
+    if '_error' in record:
+        raise ValueError(record['_error'])
+
+    title = _text_field(record, 'title')
+    author = _text_field(record, 'author')
+    if not title or not author:
+        raise ValueError('title and author are required')
+
+    names = parse_genres(_text_field(record, 'genre'))
+    if not names:
+        raise ValueError('genre is required')
+    unknown = [name for name in names if name not in genre_ids]
+    if unknown:
+        raise ValueError(f"unknown genre: {', '.join(unknown)}")
+
+    # 0 - законное значение (книги нет в наличии), по умолчанию 1 только для пустого поля.
+    # Из CSV число приходит строкой; дробные числа и true/false, как и в API, не принимаются
+    quantity = record.get('quantity')
+    if quantity is None or quantity == '':
+        quantity = 1
+    elif isinstance(quantity, str) and quantity.strip().isdigit():
+        quantity = int(quantity)
+    elif not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+        raise ValueError('quantity must be a non-negative integer')
+
+    row = {'title': title, 'author': author, 'genre': ', '.join(names), 'quantity': quantity,
+           'image_data': None, 'image_hash': None, 'image_updated_at': None}
+
+    cover = _text_field(record, 'cover')
+    if cover and covers_dir:
+        with open(os.path.join(covers_dir, os.path.basename(cover)), 'rb') as f:
+            row['image_data'] = f.read()
+        row['image_hash'] = image_hash(row['image_data'])
+        # строка в формате, в котором колонку DateTime хранит SQLAlchemy
+        row['image_updated_at'] = datetime.utcnow().isoformat(' ')
+
+    return row, [genre_ids[name] for name in names]
+
+
+def _insert_chunk(db_sess, chunk):
+    # первая строка вставляется отдельно и берет блокировку записи; до коммита никто другой
+    # не пишет в books, поэтому следующие id свободны и их можно назначить заранее -
+    # так остальная пачка уходит одним executemany без RETURNING.
+    # Параметры передаются драйверу напрямую: на сотнях тысяч строк их сборка в SQLAlchemy дороже самой вставки
+    conn = db_sess.connection()
+    columns = ', '.join(BOOK_IMPORT_COLUMNS)
+    placeholders = ', '.join('?' * len(BOOK_IMPORT_COLUMNS))
+
+    (first_row, _), rest = chunk[0], chunk[1:]
+    first_id = conn.exec_driver_sql(
+        f'INSERT INTO books ({columns}) VALUES ({placeholders}) RETURNING id',
+        tuple(first_row[column] for column in BOOK_IMPORT_COLUMNS)).scalar_one()
+    if rest:
+        # поисковый индекс для пачки заполняется одним запросом, а не триггером на каждую строку
+        pause_search_index(db_sess)
+        conn.exec_driver_sql(
+            f'INSERT INTO books (id, {columns}) VALUES (?, {placeholders})',
+            [(first_id + i, *(row[column] for column in BOOK_IMPORT_COLUMNS)) for i, (row, _) in enumerate(rest, start=1)])
+        resume_search_index(db_sess, first_id + 1, first_id + len(rest))
+
+    # одна и та же обложка у многих книг пачки сохраняется один раз
+    covers = {row['image_hash']: row['image_data'] for row, _ in chunk if row['image_data'] is not None}
+    if covers:
+        conn.exec_driver_sql(
+            f"INSERT OR IGNORE INTO cover_renditions (image_hash, kind, image_data) VALUES (?, '{ORIGINAL}', ?)",
+            list(covers.items()))
+
+    conn.exec_driver_sql(
+        'INSERT INTO book_genres (book_id, genre_id) VALUES (?, ?)',
+        [(first_id + i, genre_id) for i, (_, genre_ids) in enumerate(chunk) for genre_id in genre_ids])
+    db_sess.commit()
+
+
+def import_books(db_sess, records, covers_dir=None, chunk_size=IMPORT_CHUNK_SIZE, max_errors=100):
+    # каждая пачка - отдельная транзакция; ошибочные строки пропускаются и попадают в отчет
+    genre_ids = dict(db_sess.query(Genre.name, Genre.id))
+    imported = 0
+    errors = []
+    chunk = []
+
+    for line_number, record in records:
+        try:
+            chunk.append(validate_record(record, genre_ids, covers_dir))
+        except (ValueError, TypeError, OSError) as e:
+            if len(errors) < max_errors:
+                errors.append({'line': line_number, 'error': str(e)})
+            continue
+
+        if len(chunk) >= chunk_size:
+            _insert_chunk(db_sess, chunk)
+            imported += len(chunk)
+            chunk = []
+
+    if chunk:
+        _insert_chunk(db_sess, chunk)
+        imported += len(chunk)
+
+    return {'imported': imported, 'errors': errors}
+
+
+def export_books(db_sess, file_format, after_id=0):
+    # after_id - курсор API: прерванную выгрузку можно продолжить с последнего полученного id
+    columns = [getattr(Book, field) for field in CATALOG_FIELDS]
+    rows = db_sess.query(*columns).filter(Book.id > after_id).order_by(Book.id).yield_per(EXPORT_BATCH_SIZE)
+
+    if file_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(row._asdict(), ensure_ascii=False) + '\n'
+    elif file_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CATALOG_FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        raise ValueError(f'unknown format {file_format}')
+
+
+def guess_format(path, file_format=None):
+    if file_format:
+        return file_format
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Импорт и экспорт каталога книг')
+    parser.add_argument('--db', default='db/library.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=('csv', 'jsonl'))
+    import_parser.add_argument('--covers', help='папка с файлами обложек из колонки cover')
+    import_parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--format', choices=('csv', 'jsonl'))
+
+    args = parser.parse_args()
+    db_session.global_init(args.db)
+    file_format = guess_format(args.path, args.format)
+
+    with db_session.session_scope() as db_sess:
+        if args.command == 'import':
+            started = time.perf_counter()
+            with open(args.path, encoding='utf-8', newline='') as f:
+                report = import_books(db_sess, iter_records(f, file_format), args.covers, args.chunk_size)
+            elapsed = time.perf_counter() - started
+            print(f"imported {report['imported']} books in {elapsed:.1f} s "
+                  f"({report['imported'] / max(elapsed, 1e-9):.0f} rows/s)")
+            for error in report['errors']:
+                print(f"line {error['line']}: {error['error']}")
+        else:
+            with open(args.path, 'w', encoding='utf-8', newline='') as f:
+                for chunk in export_books(db_sess, file_format):
+                    f.write(chunk)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,12 @@
 from . import users
 from . import books
-from . import borrowed_book
\ No newline at end of file
+from . import borrowed_book
+from . import sent_reminder
+from . import genres
+from . import cover_renditions
+from . import catalog_version
+from . import circulation
+from . import ratings
+from . import waitlist
+from . import bot_states
+from . import search_cache
@@ -0,0 +1,26 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from data.db_session import session_scope
+
+# размер пула не должен превышать пул соединений движка (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+DB_WORKERS = int(os.getenv('DB_WORKERS') or 4)
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+def _call_with_session(func, args, kwargs):
+    with session_scope() as db_sess:
+        return func(db_sess, *args, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    # синхронный запрос уходит в отдельный поток, event loop бота не блокируется;
+    # func получает свежую сессию первым аргументом и должна вернуть уже загруженные данные
+    # контекст копируется, чтобы SQL в потоке учитывался в метриках того апдейта, который его вызвал
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, context.run, partial(_call_with_session, func, args, kwargs))
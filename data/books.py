@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, BLOB
+from sqlalchemy import Column, Integer, String, BLOB, DateTime
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy_serializer import SerializerMixin
 
 from data.db_session import SqlAlchemyBase
@@ -9,7 +10,13 @@ class Book(SqlAlchemyBase, SerializerMixin):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String, nullable=False)
-    author = Column(String, nullable=False)
-    genre = Column(String, nullable=False)
+    author = Column(String, nullable=False, index=True)
+    genre = Column(String, nullable=False, index=True)
     quantity = Column(Integer, default=1)
-    image_data = Column(BLOB, nullable=True)
\ No newline at end of file
+    # обложка грузится только при явном обращении, списки книг ее не читают
+    image_data = deferred(Column(BLOB, nullable=True))
+    image_hash = Column(String, nullable=True)
+    image_updated_at = Column(DateTime, nullable=True)
+
+    # genre остается строкой для показа и поиска, genres - нормализованные жанры для фильтра
+    genres = relationship('Genre', secondary='book_genres', lazy='selectin')
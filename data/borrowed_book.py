@@ -1,13 +1,14 @@
-from sqlalchemy import Column, Integer, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index
 from data.db_session import SqlAlchemyBase
 from datetime import datetime
 
 
 class BorrowedBook(SqlAlchemyBase):
     __tablename__ = 'borrowed_books'
+    __table_args__ = (Index('ix_borrowed_books_user_book', 'user_id', 'book_id', unique=True),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False, index=True)
     borrowed_at = Column(DateTime, default=datetime.utcnow)
-    return_by = Column(DateTime, nullable=False)
\ No newline at end of file
+    return_by = Column(DateTime, nullable=False, index=True)
\ No newline at end of file
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+import copy
+import json
+
+from sqlalchemy import Column, String, Text, DateTime, text
+
+from data.db_session import SqlAlchemyBase
+
+EMPTY_RECORD = {'state': None, 'data': {}, 'bucket': {}}
+
+
+class BotState(SqlAlchemyBase):
+    __tablename__ = 'bot_fsm_states'
+
+    chat = Column(String, primary_key=True)
+    user = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=False, default='{}')
+    bucket = Column(Text, nullable=False, default='{}')
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+def load_record(db_sess, chat, user, ttl):
+    row = (db_sess.query(BotState.state, BotState.data, BotState.bucket)
+           .filter(BotState.chat == chat, BotState.user == user,
+                   BotState.updated_at >= datetime.utcnow() - timedelta(seconds=ttl))
+           .first())
+    if row is None:
+        return copy.deepcopy(EMPTY_RECORD)
+    return {'state': row.state, 'data': json.loads(row.data), 'bucket': json.loads(row.bucket)}
+
+
+def save_records(db_sess, records):
+    # пустая запись - диалог закончен, строка удаляется, так таблица не растет от завершенных диалогов
+    now = datetime.utcnow()
+    upserts = []
+    deletes = []
+    for (chat, user), record in records.items():
+        if record == EMPTY_RECORD:
+            deletes.append({'chat': chat, 'user': user})
+        else:
+            upserts.append({'chat': chat, 'user': user, 'state': record['state'],
+                            'data': json.dumps(record['data'], ensure_ascii=False),
+                            'bucket': json.dumps(record['bucket'], ensure_ascii=False), 'updated_at': now})
+    if upserts:
+        db_sess.execute(text("""
+            INSERT INTO bot_fsm_states (chat, user, state, data, bucket, updated_at)
+            VALUES (:chat, :user, :state, :data, :bucket, :updated_at)
+            ON CONFLICT (chat, user) DO UPDATE SET state = excluded.state, data = excluded.data,
+                bucket = excluded.bucket, updated_at = excluded.updated_at"""), upserts)
+    if deletes:
+        db_sess.execute(text('DELETE FROM bot_fsm_states WHERE chat = :chat AND user = :user'), deletes)
+    db_sess.commit()
+
+
+def purge_expired(db_sess, ttl):
+    deleted = (db_sess.query(BotState)
+               .filter(BotState.updated_at < datetime.utcnow() - timedelta(seconds=ttl))
+               .delete(synchronize_session=False))
+    db_sess.commit()
+    return deleted
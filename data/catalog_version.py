@@ -0,0 +1,29 @@
+from sqlalchemy import Column, Integer
+
+from data.db_session import SqlAlchemyBase
+
+
+class CatalogVersion(SqlAlchemyBase):
+    __tablename__ = 'catalog_version'
+
+    # одна строка; номер растет при любой записи в books, на нем держатся ETag ответов API
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# триггеры ловят и записи в обход ORM: импорт каталога, выдачу и возврат через UPDATE
+CATALOG_VERSION_TRIGGERS_SQL = [
+    """INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)""",
+    """CREATE TRIGGER IF NOT EXISTS books_version_insert AFTER INSERT ON books BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_version_update AFTER UPDATE ON books BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_version_delete AFTER DELETE ON books BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+    END"""]
+
+
+def get_catalog_version(db_sess):
+    return db_sess.query(CatalogVersion.version).filter(CatalogVersion.id == 1).scalar() or 0
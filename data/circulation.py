@@ -0,0 +1,258 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Integer, DateTime, Date, Boolean, Index, func, text
+
+from data.db_session import SqlAlchemyBase
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.users import User
+
+
+class LoanHistory(SqlAlchemyBase):
+    # закрытые выдачи; строку пишет триггер при удалении из borrowed_books
+    __tablename__ = 'loan_history'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    loan_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False, index=True)
+    book_id = Column(Integer, nullable=False, index=True)
+    borrowed_at = Column(DateTime)
+    return_by = Column(DateTime, nullable=False)
+    returned_at = Column(DateTime, nullable=False, index=True)
+    is_late = Column(Boolean, nullable=False)
+
+
+# сводки ниже обновляют триггеры на каждую выдачу и возврат, отчет читает их, а не все выдачи
+class BookCirculation(SqlAlchemyBase):
+    __tablename__ = 'book_circulation'
+    __table_args__ = (Index('ix_book_circulation_on_loan', 'on_loan'),)
+
+    book_id = Column(Integer, primary_key=True)
+    on_loan = Column(Integer, nullable=False, default=0)
+    loans_total = Column(Integer, nullable=False, default=0)
+    returns_total = Column(Integer, nullable=False, default=0)
+    late_returns = Column(Integer, nullable=False, default=0)
+
+
+class UserCirculation(SqlAlchemyBase):
+    __tablename__ = 'user_circulation'
+    __table_args__ = (Index('ix_user_circulation_on_loan', 'on_loan'),
+                      Index('ix_user_circulation_overdue', 'overdue'))
+
+    user_id = Column(Integer, primary_key=True)
+    on_loan = Column(Integer, nullable=False, default=0)
+    loans_total = Column(Integer, nullable=False, default=0)
+    returns_total = Column(Integer, nullable=False, default=0)
+    late_returns = Column(Integer, nullable=False, default=0)
+    # просроченные на момент circulation_state.overdue_as_of, см. refresh_overdue
+    overdue = Column(Integer, nullable=False, default=0)
+
+
+class CirculationState(SqlAlchemyBase):
+    __tablename__ = 'circulation_state'
+
+    id = Column(Integer, primary_key=True)
+    overdue_as_of = Column(DateTime, nullable=True)
+
+
+class DailyCirculation(SqlAlchemyBase):
+    __tablename__ = 'daily_circulation'
+
+    day = Column(Date, primary_key=True)
+    loans = Column(Integer, nullable=False, default=0)
+    returns = Column(Integer, nullable=False, default=0)
+    late_returns = Column(Integer, nullable=False, default=0)
+
+
+# datetime('now') - UTC без долей секунды, сравнивается со строками utcnow() из SQLAlchemy.
+# Выдачи со сроком раньше overdue_as_of уже учтены в user_circulation.overdue, поэтому триггеры
+# поправляют счетчик, когда такая выдача появляется, закрывается или меняет срок
+OVERDUE_AS_OF = "(SELECT overdue_as_of FROM circulation_state WHERE id = 1)"
+
+CIRCULATION_TRIGGERS_SQL = [
+    """INSERT OR IGNORE INTO circulation_state (id, overdue_as_of) VALUES (1, NULL)""",
+    """CREATE TRIGGER IF NOT EXISTS borrowed_books_circulation_insert AFTER INSERT ON borrowed_books BEGIN
+        INSERT INTO book_circulation (book_id, on_loan, loans_total, returns_total, late_returns)
+        VALUES (new.book_id, 1, 1, 0, 0)
+        ON CONFLICT (book_id) DO UPDATE SET on_loan = on_loan + 1, loans_total = loans_total + 1;
+        INSERT INTO user_circulation (user_id, on_loan, loans_total, returns_total, late_returns, overdue)
+        VALUES (new.user_id, 1, 1, 0, 0, 0)
+        ON CONFLICT (user_id) DO UPDATE SET on_loan = on_loan + 1, loans_total = loans_total + 1;
+        UPDATE user_circulation SET overdue = overdue + 1
+        WHERE user_id = new.user_id AND new.return_by < """ + OVERDUE_AS_OF + """;
+        INSERT INTO daily_circulation (day, loans, returns, late_returns)
+        VALUES (coalesce(date(new.borrowed_at), date('now')), 1, 0, 0)
+        ON CONFLICT (day) DO UPDATE SET loans = loans + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS borrowed_books_circulation_delete AFTER DELETE ON borrowed_books BEGIN
+        INSERT INTO loan_history (loan_id, user_id, book_id, borrowed_at, return_by, returned_at, is_late)
+        VALUES (old.id, old.user_id, old.book_id, old.borrowed_at, old.return_by, datetime('now'),
+                datetime('now') > old.return_by);
+        UPDATE book_circulation SET on_loan = on_loan - 1, returns_total = returns_total + 1,
+            late_returns = late_returns + (datetime('now') > old.return_by)
+        WHERE book_id = old.book_id;
+        UPDATE user_circulation SET on_loan = on_loan - 1, returns_total = returns_total + 1,
+            late_returns = late_returns + (datetime('now') > old.return_by),
+            overdue = overdue - (old.return_by < coalesce(""" + OVERDUE_AS_OF + """, ''))
+        WHERE user_id = old.user_id;
+        INSERT INTO daily_circulation (day, loans, returns, late_returns)
+        VALUES (date('now'), 0, 1, datetime('now') > old.return_by)
+        ON CONFLICT (day) DO UPDATE SET returns = returns + 1, late_returns = late_returns + excluded.late_returns;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS borrowed_books_circulation_update AFTER UPDATE OF user_id, return_by
+    ON borrowed_books BEGIN
+        UPDATE user_circulation SET overdue = overdue - 1
+        WHERE user_id = old.user_id AND old.return_by < """ + OVERDUE_AS_OF + """;
+        UPDATE user_circulation SET overdue = overdue + 1
+        WHERE user_id = new.user_id AND new.return_by < """ + OVERDUE_AS_OF + """;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_circulation_delete AFTER DELETE ON books BEGIN
+        DELETE FROM book_circulation WHERE book_id = old.id;
+    END"""]
+
+# полный пересчет сводок из выдач и истории: для существующих баз и для проверки расхождений
+REBUILD_SQL = [
+    "DELETE FROM book_circulation",
+    """INSERT INTO book_circulation (book_id, on_loan, loans_total, returns_total, late_returns)
+    SELECT book_id, sum(active), count(*), sum(1 - active), sum(late) FROM (
+        SELECT book_id, 1 AS active, 0 AS late FROM borrowed_books
+        UNION ALL SELECT book_id, 0, is_late FROM loan_history)
+    WHERE book_id IN (SELECT id FROM books)
+    GROUP BY book_id""",
+    "DELETE FROM user_circulation",
+    # просрочка посчитается заново при следующем refresh_overdue
+    "UPDATE circulation_state SET overdue_as_of = NULL",
+    """INSERT INTO user_circulation (user_id, on_loan, loans_total, returns_total, late_returns, overdue)
+    SELECT user_id, sum(active), count(*), sum(1 - active), sum(late), 0 FROM (
+        SELECT user_id, 1 AS active, 0 AS late FROM borrowed_books
+        UNION ALL SELECT user_id, 0, is_late FROM loan_history)
+    GROUP BY user_id""",
+    "DELETE FROM daily_circulation",
+    """INSERT INTO daily_circulation (day, loans, returns, late_returns)
+    SELECT day, sum(loans), sum(returns), sum(late) FROM (
+        SELECT date(borrowed_at) AS day, 1 AS loans, 0 AS returns, 0 AS late FROM borrowed_books
+        UNION ALL SELECT date(borrowed_at), 1, 0, 0 FROM loan_history
+        UNION ALL SELECT date(returned_at), 0, 1, is_late FROM loan_history)
+    WHERE day IS NOT NULL
+    GROUP BY day"""]
+
+
+def rebuild_circulation(conn):
+    for statement in REBUILD_SQL:
+        conn.execute(text(statement))
+
+
+def refresh_overdue(db_sess, now=None):
+    # счетчики просрочки догоняют текущий момент: просматриваются только выдачи,
+    # срок которых истек после прошлого обновления (диапазон по индексу return_by)
+    now = now or datetime.utcnow()
+    # сначала запись: блокировка берется до чтения, параллельный возврат не проскочит между шагами
+    db_sess.query(CirculationState).filter(CirculationState.id == 1).update(
+        {CirculationState.id: CirculationState.id}, synchronize_session=False)
+    as_of = db_sess.query(CirculationState.overdue_as_of).filter(CirculationState.id == 1).scalar()
+    if as_of is not None and as_of >= now:
+        db_sess.rollback()
+        return
+
+    query = db_sess.query(BorrowedBook.user_id, func.count(BorrowedBook.id)).filter(BorrowedBook.return_by < now)
+    if as_of is None:
+        db_sess.query(UserCirculation).update({UserCirculation.overdue: 0}, synchronize_session=False)
+    else:
+        query = query.filter(BorrowedBook.return_by >= as_of)
+    changes = [{'user_id': user_id, 'count': count} for user_id, count in query.group_by(BorrowedBook.user_id)]
+
+    if changes:
+        db_sess.execute(text('UPDATE user_circulation SET overdue = overdue + :count WHERE user_id = :user_id'),
+                        changes)
+    db_sess.query(CirculationState).filter(CirculationState.id == 1).update(
+        {CirculationState.overdue_as_of: now}, synchronize_session=False)
+    db_sess.commit()
+
+
+def rate(part, total):
+    return round(part / total, 4) if total else None
+
+
+def get_circulation_overview(db_sess, now=None, days=30):
+    now = now or datetime.utcnow()
+    loans, returns, late = db_sess.query(
+        func.coalesce(func.sum(DailyCirculation.loans), 0),
+        func.coalesce(func.sum(DailyCirculation.returns), 0),
+        func.coalesce(func.sum(DailyCirculation.late_returns), 0)).one()
+    overdue = db_sess.query(func.coalesce(func.sum(UserCirculation.overdue), 0)).scalar()
+
+    since = (now - timedelta(days=days - 1)).date()
+    daily = (db_sess.query(DailyCirculation)
+             .filter(DailyCirculation.day >= since)
+             .order_by(DailyCirculation.day).all())
+    recent_returns = sum(day.returns for day in daily)
+    recent_late = sum(day.late_returns for day in daily)
+
+    return {
+        'active_loans': loans - returns,
+        'overdue_loans': overdue,
+        'loans_total': loans,
+        'returns_total': returns,
+        'late_return_rate': rate(late, returns),
+        'late_return_rate_recent': rate(recent_late, recent_returns),
+        'recent_days': days,
+        'daily': [{'day': day.day.isoformat(), 'loans': day.loans, 'returns': day.returns,
+                   'late_returns': day.late_returns, 'late_return_rate': rate(day.late_returns, day.returns)}
+                  for day in daily]}
+
+
+def get_overdue_loans(db_sess, now=None, limit=50):
+    now = now or datetime.utcnow()
+    rows = (db_sess.query(BorrowedBook.id, BorrowedBook.return_by, User.id, User.username, Book.id, Book.title)
+            .join(User, User.id == BorrowedBook.user_id)
+            .join(Book, Book.id == BorrowedBook.book_id)
+            .filter(BorrowedBook.return_by < now)
+            .order_by(BorrowedBook.return_by)
+            .limit(limit).all())
+    return [{'loan_id': loan_id, 'user_id': user_id, 'username': username, 'book_id': book_id, 'title': title,
+             'return_by': return_by.isoformat(), 'days_overdue': (now - return_by).days}
+            for loan_id, return_by, user_id, username, book_id, title in rows]
+
+
+def get_overdue_by_user(db_sess, limit=20):
+    rows = (db_sess.query(User.id, User.username, UserCirculation.overdue)
+            .join(UserCirculation, UserCirculation.user_id == User.id)
+            .filter(UserCirculation.overdue > 0)
+            .order_by(UserCirculation.overdue.desc())
+            .limit(limit).all())
+    return [{'user_id': user_id, 'username': username, 'overdue': count} for user_id, username, count in rows]
+
+
+def get_loans_per_user(db_sess, limit=20):
+    rows = (db_sess.query(User.id, User.username, User.rating, UserCirculation)
+            .join(UserCirculation, UserCirculation.user_id == User.id)
+            .order_by(UserCirculation.on_loan.desc())
+            .limit(limit).all())
+    return [{'user_id': user_id, 'username': username, 'rating': rating, 'on_loan': stats.on_loan,
+             'loans_total': stats.loans_total, 'late_returns': stats.late_returns,
+             'late_return_rate': rate(stats.late_returns, stats.returns_total)}
+            for user_id, username, rating, stats in rows]
+
+
+def get_title_stock(db_sess, limit=20):
+    rows = (db_sess.query(Book.id, Book.title, Book.author, Book.quantity, BookCirculation)
+            .join(BookCirculation, BookCirculation.book_id == Book.id)
+            .order_by(BookCirculation.on_loan.desc())
+            .limit(limit).all())
+    # quantity - экземпляры на полке, всего у библиотеки quantity + on_loan
+    return [{'book_id': book_id, 'title': title, 'author': author, 'available': quantity,
+             'on_loan': stats.on_loan, 'total': quantity + stats.on_loan, 'loans_total': stats.loans_total,
+             'late_return_rate': rate(stats.late_returns, stats.returns_total)}
+            for book_id, title, author, quantity, stats in rows]
+
+
+def get_circulation_report(db_sess, limit=20, now=None):
+    now = now or datetime.utcnow()
+    refresh_overdue(db_sess, now)
+    return {
+        'generated_at': now.isoformat(timespec='seconds'),
+        'overview': get_circulation_overview(db_sess, now),
+        'overdue_loans': get_overdue_loans(db_sess, now, limit),
+        'overdue_by_user': get_overdue_by_user(db_sess, limit),
+        'loans_per_user': get_loans_per_user(db_sess, limit),
+        'titles': get_title_stock(db_sess, limit)}
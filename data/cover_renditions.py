@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, BLOB
+
+from data.db_session import SqlAlchemyBase
+
+
+class CoverRendition(SqlAlchemyBase):
+    __tablename__ = 'cover_renditions'
+
+    # одинаковые загрузки дают один хэш, поэтому версии обложки хранятся один раз на содержимое
+    image_hash = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    image_data = Column(BLOB, nullable=False)
@@ -1,16 +1,90 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
 
 SqlAlchemyBase = declarative_base()
 
+# включаются через global_init(tune_sqlite=True) или переменную окружения DB_SQLITE_TUNING=1
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'busy_timeout': 5000}
+
+# веб-запрос живет в своем потоке, а апдейты бота - в своих asyncio-задачах одного потока,
+# поэтому область сессии определяется парой (поток, контекст)
+_session_scope = ContextVar('session_scope', default=None)
+
+Session = None
+
+
+def _scope_key():
+    return threading.get_ident(), _session_scope.get()
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def global_init(db_file, pool_size=None, max_overflow=None, pool_timeout=None, tune_sqlite=None):
+    if tune_sqlite is None:
+        tune_sqlite = os.getenv('DB_SQLITE_TUNING') == '1'
 
-def global_init(db_file):
-    engine = create_engine(f'sqlite:///{db_file}?check_same_thread=False')
+    engine = create_engine(
+        f'sqlite:///{db_file}?check_same_thread=False',
+        pool_size=pool_size or _env_int('DB_POOL_SIZE', 5),
+        max_overflow=max_overflow if max_overflow is not None else _env_int('DB_MAX_OVERFLOW', 10),
+        pool_timeout=pool_timeout or _env_int('DB_POOL_TIMEOUT', 30))
+    if tune_sqlite:
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+
+    from . import __all_models
     SqlAlchemyBase.metadata.create_all(engine)
+
+    from data.migrations import migrate
+    migrate(engine)
+
+    from data.search import create_search_index
+    create_search_index(engine)
+
     global Session
-    Session = sessionmaker(bind=engine)
+    Session = scoped_session(sessionmaker(bind=engine), scopefunc=_scope_key)
 
 
 def create_session():
-    return Session()
\ No newline at end of file
+    # в пределах одного запроса или апдейта бота возвращается одна и та же сессия
+    return Session()
+
+
+def begin_scope():
+    return _session_scope.set(object())
+
+
+def remove_session(scope_token=None):
+    Session.remove()
+    if scope_token is not None:
+        _session_scope.reset(scope_token)
+
+
+@contextmanager
+def session_scope():
+    # для фоновых задач вне запроса: своя сессия, которая закрывается на выходе
+    scope_token = begin_scope()
+    try:
+        yield create_session()
+    finally:
+        remove_session(scope_token)
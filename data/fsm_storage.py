@@ -0,0 +1,153 @@
+import asyncio
+import copy
+import logging
+import os
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from data.async_db import run_db
+from data.bot_states import load_record, purge_expired, save_records
+
+# брошенные диалоги (регистрация, вход) удаляются через FSM_STATE_TTL секунд без изменений
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL') or 24 * 60 * 60)
+# смена состояния записывается сразу, вместе со всеми накопленными изменениями; остальные записи
+# (данные без смены состояния, bucket) уходят раз в FSM_FLUSH_INTERVAL секунд или когда накопилось FSM_MAX_PENDING чатов
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL') or 0.1)
+FSM_MAX_PENDING = int(os.getenv('FSM_MAX_PENDING') or 500)
+FSM_PURGE_INTERVAL = 10 * 60
+
+
+class SQLiteStorage(BaseStorage):
+    # состояния диалогов в таблице bot_fsm_states: переживают перезапуск и видны другим процессам бота.
+    # Чтение всегда идет в базу (кроме еще не записанных изменений этого процесса),
+    # поэтому диалог можно продолжить в любом процессе
+    def __init__(self, ttl=FSM_STATE_TTL, flush_interval=FSM_FLUSH_INTERVAL, max_pending=FSM_MAX_PENDING):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._writing = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._last_purge = None
+        self.flushes = 0
+        self.written = 0
+
+    @classmethod
+    def _key(cls, chat, user):
+        chat, user = cls.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def _load(self, key):
+        # незаписанное изменение этого процесса новее того, что лежит в базе
+        record = self._pending.get(key) or self._writing.get(key)
+        if record is None:
+            record = await run_db(load_record, *key, self.ttl)
+        return record
+
+    async def _store(self, key, record, sync=False):
+        self._pending[key] = record
+        if sync or len(self._pending) >= self.max_pending:
+            # следующий апдейт диалога может попасть в другой процесс бота, поэтому новое состояние
+            # должно быть в базе до ответа. Одновременные записи ждут flush и уходят одной транзакцией
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        try:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+        except Exception:
+            # пачка осталась в памяти и уйдет со следующей записью
+            logging.exception('failed to save bot states')
+        finally:
+            self._flush_task = None
+
+    async def flush(self):
+        async with self._flush_lock:
+            # пока идет запись, новые изменения копятся в следующей пачке
+            batch, self._pending = self._pending, {}
+            if batch:
+                self._writing = batch
+                try:
+                    await run_db(save_records, batch)
+                except Exception:
+                    # запись не удалась: возвращаем пачку, более новые изменения важнее
+                    self._pending = {**batch, **self._pending}
+                    raise
+                finally:
+                    self._writing = {}
+                self.flushes += 1
+                self.written += len(batch)
+
+            loop = asyncio.get_running_loop()
+            if self._last_purge is None or loop.time() - self._last_purge > FSM_PURGE_INTERVAL:
+                self._last_purge = loop.time()
+                deleted = await run_db(purge_expired, self.ttl)
+                if deleted:
+                    logging.info(f'purged {deleted} expired bot states')
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return copy.deepcopy(record['data']) if record['data'] else (default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user)
+        record = dict(await self._load(key))
+        state = self.resolve_state(state)
+        changed = record['state'] != state
+        record['state'] = state
+        await self._store(key, record, sync=changed)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        # состояние и данные сбрасываются одной записью: иначе другой процесс увидел бы
+        # законченный диалог со старыми данными, а отложенная запись данных затерла бы его новое состояние
+        key = self._key(chat, user)
+        record = dict(await self._load(key))
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        await self._store(key, record, sync=True)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key = self._key(chat, user)
+        record = dict(await self._load(key))
+        record['data'] = copy.deepcopy(data or {})
+        await self._store(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=current)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return copy.deepcopy(record['bucket']) if record['bucket'] else (default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key = self._key(chat, user)
+        record = dict(await self._load(key))
+        record['bucket'] = copy.deepcopy(bucket or {})
+        await self._store(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        current = await self.get_bucket(chat=chat, user=user)
+        current.update(bucket or {}, **kwargs)
+        await self.set_bucket(chat=chat, user=user, bucket=current)
@@ -0,0 +1,66 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, Table, Index, select
+
+from data.db_session import SqlAlchemyBase
+
+DEFAULT_GENRES = ['Антиутопия', 'Апокалиптика', 'Басня', 'Военная проза', 'Детектив', 'Детская литература', 'Драма',
+                  'Историческая проза', 'Исторический жанр', 'Комедия', 'Криминальный жанр', 'Научная фантастика',
+                  'Повесть', 'Политическая фантастика', 'Постапокалиптика', 'Психологический реализм', 'Роман',
+                  'Роман в стихах', 'Сатира', 'Фантастика', 'Фикшн', 'Философия']
+
+book_genres = Table(
+    'book_genres', SqlAlchemyBase.metadata,
+    Column('book_id', Integer, ForeignKey('books.id'), primary_key=True),
+    Column('genre_id', Integer, ForeignKey('genres.id'), primary_key=True),
+    Index('ix_book_genres_genre_book', 'genre_id', 'book_id'))
+
+
+class Genre(SqlAlchemyBase):
+    __tablename__ = 'genres'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, unique=True, nullable=False)
+    # число книг жанра для фильтра каталога, его ведут триггеры на book_genres
+    book_count = Column(Integer, nullable=False, default=0)
+
+
+FACET_TRIGGERS_SQL = [
+    """CREATE TRIGGER IF NOT EXISTS book_genres_count_insert AFTER INSERT ON book_genres BEGIN
+        UPDATE genres SET book_count = book_count + 1 WHERE id = new.genre_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_genres_count_delete AFTER DELETE ON book_genres BEGIN
+        UPDATE genres SET book_count = book_count - 1 WHERE id = old.genre_id;
+    END"""]
+
+
+def parse_genres(genre):
+    names = []
+    for name in (genre or '').split(','):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def set_book_genres(db_sess, book, genre, known=None):
+    # known - общий словарь имя -> Genre для пачки книг, чтобы не искать одни и те же жанры заново
+    names = parse_genres(genre)
+    existing = known if known is not None else {}
+    missing = [name for name in names if name not in existing]
+    if missing:
+        existing.update((item.name, item) for item in db_sess.query(Genre).filter(Genre.name.in_(missing)))
+    for name in names:
+        if name not in existing:
+            existing[name] = Genre(name=name, book_count=0)
+            db_sess.add(existing[name])
+    book.genres = [existing[name] for name in names]
+
+
+def get_genre_facets(db_sess):
+    return db_sess.query(Genre.name, Genre.book_count).order_by(Genre.name).all()
+
+
+def books_in_genres(names):
+    # id книг хотя бы с одним из жанров: поиск по индексу (genre_id, book_id), без сканирования books
+    return (select(book_genres.c.book_id)
+            .join(Genre, Genre.id == book_genres.c.genre_id)
+            .where(Genre.name.in_(names)))
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+
+BORROWED = 'borrowed'
+UNAVAILABLE = 'unavailable'
+ALREADY_BORROWED = 'already_borrowed'
+
+
+def borrow_book(db_sess, user_id, max_borrow_days, book_id):
+    # общая выдача для сайта и бота; результат - одна из констант выше
+    # списываем экземпляр условным UPDATE: при одновременных запросах последний экземпляр получит только один
+    taken = (db_sess.query(Book)
+             .filter(Book.id == book_id, Book.quantity > 0)
+             .update({Book.quantity: Book.quantity - 1}, synchronize_session=False))
+
+    if not taken:
+        db_sess.rollback()
+        return UNAVAILABLE
+
+    db_sess.add(BorrowedBook(
+        user_id=user_id,
+        book_id=book_id,
+        return_by=datetime.utcnow() + timedelta(days=max_borrow_days)))
+
+    try:
+        db_sess.commit()
+    except IntegrityError:
+        # уникальный индекс (user_id, book_id): откат вернет и списанный экземпляр
+        db_sess.rollback()
+        return ALREADY_BORROWED
+    return BORROWED
@@ -0,0 +1,189 @@
+from sqlalchemy import text
+
+# create_all создает только недостающие таблицы, а колонки и индексы в уже существующих
+# базах добавляют миграции. Номер последней примененной хранится в PRAGMA user_version,
+# все шаги идемпотентны, так что на свежей базе они просто ничего не меняют.
+
+
+def add_column(table, column, column_type):
+    def step(conn):
+        existing = {row[1] for row in conn.execute(text(f'PRAGMA table_info({table})'))}
+        if column not in existing:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}'))
+    return step
+
+
+def execute(statement):
+    def step(conn):
+        conn.execute(text(statement))
+    return step
+
+
+def merge_duplicate_loans(conn):
+    # до уникального индекса читатель мог взять одну книгу дважды. Остается самая ранняя запись
+    # с самым поздним сроком, а лишние экземпляры возвращаются в books.quantity
+    conn.execute(text("""
+        UPDATE books SET quantity = quantity + d.extra
+        FROM (SELECT book_id, count(*) - count(DISTINCT user_id) AS extra
+              FROM borrowed_books GROUP BY book_id) AS d
+        WHERE books.id = d.book_id AND d.extra > 0"""))
+    conn.execute(text("""
+        UPDATE borrowed_books SET return_by = (
+            SELECT max(b.return_by) FROM borrowed_books b
+            WHERE b.user_id = borrowed_books.user_id AND b.book_id = borrowed_books.book_id)
+        WHERE id IN (SELECT min(id) FROM borrowed_books GROUP BY user_id, book_id HAVING count(*) > 1)"""))
+    conn.execute(text("""
+        DELETE FROM borrowed_books
+        WHERE id NOT IN (SELECT min(id) FROM borrowed_books GROUP BY user_id, book_id)"""))
+
+
+def create_catalog_version(conn):
+    from data.catalog_version import CATALOG_VERSION_TRIGGERS_SQL
+
+    for statement in CATALOG_VERSION_TRIGGERS_SQL:
+        conn.execute(text(statement))
+
+
+def create_circulation(conn):
+    from data.circulation import CIRCULATION_TRIGGERS_SQL, rebuild_circulation
+
+    for statement in CIRCULATION_TRIGGERS_SQL:
+        conn.execute(text(statement))
+    rebuild_circulation(conn)
+
+
+def create_rating_ledger(conn):
+    from data.ratings import open_rating_balances, seed_borrow_limits
+
+    seed_borrow_limits(conn)
+    open_rating_balances(conn)
+
+
+def create_waitlist(conn):
+    from data.waitlist import WAITLIST_TRIGGERS_SQL
+
+    for statement in WAITLIST_TRIGGERS_SQL:
+        conn.execute(text(statement))
+
+
+def rebuild_waitlist_autoincrement(conn):
+    # без AUTOINCREMENT повторная запись в очередь получала id удаленной, и триггер уведомлений
+    # упирался в уникальный waitlist_id старого уведомления. SQLite не меняет это у готовой
+    # таблицы, поэтому она пересоздается вместе с индексами и триггерами, которые на нее ссылаются
+    from data.waitlist import WaitlistEntry
+
+    schema = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'waitlist'")).scalar()
+    if 'AUTOINCREMENT' in schema.upper():
+        return
+    for trigger in ('books_waitlist_notify', 'borrowed_books_waitlist_leave', 'books_waitlist_delete'):
+        conn.execute(text(f'DROP TRIGGER IF EXISTS {trigger}'))
+    conn.execute(text("""
+        CREATE TABLE waitlist_rebuilt (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            book_id INTEGER NOT NULL REFERENCES books (id),
+            created_at DATETIME,
+            notified_at DATETIME)"""))
+    conn.execute(text('INSERT INTO waitlist_rebuilt (id, user_id, book_id, created_at, notified_at) '
+                      'SELECT id, user_id, book_id, created_at, notified_at FROM waitlist'))
+    conn.execute(text('DROP TABLE waitlist'))
+    conn.execute(text('ALTER TABLE waitlist_rebuilt RENAME TO waitlist'))
+    for index in WaitlistEntry.__table__.indexes:
+        index.create(conn)
+    # новые id идут после всех, что когда-либо встречались, в том числе в уведомлениях
+    conn.execute(text("""
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT 'waitlist', max(coalesce((SELECT max(id) FROM waitlist), 0),
+                               coalesce((SELECT max(waitlist_id) FROM availability_notices), 0))"""))
+    # уведомления, чей id уже заняла чужая или снова ожидающая запись, отвязываются от нее:
+    # отрицательный id уникален и не совпадет ни с одной записью очереди
+    conn.execute(text("""
+        UPDATE availability_notices SET waitlist_id = -id
+        WHERE EXISTS (SELECT 1 FROM waitlist w WHERE w.id = availability_notices.waitlist_id
+                      AND (w.notified_at IS NULL OR w.user_id != availability_notices.user_id
+                           OR w.book_id != availability_notices.book_id))"""))
+    create_waitlist(conn)
+
+
+def move_cover_originals(conn):
+    # оригиналы обложек хранятся один раз на хэш в cover_renditions, а не копией в каждой книге;
+    # обложки без хэша перенесет /cover при первом обращении
+    conn.execute(text("""
+        INSERT OR IGNORE INTO cover_renditions (image_hash, kind, image_data)
+        SELECT image_hash, 'original', image_data FROM books
+        WHERE image_hash IS NOT NULL AND image_data IS NOT NULL"""))
+    conn.execute(text('UPDATE books SET image_data = NULL WHERE image_hash IS NOT NULL AND image_data IS NOT NULL'))
+
+
+def populate_genres(conn):
+    from data.genres import DEFAULT_GENRES, FACET_TRIGGERS_SQL, parse_genres
+
+    for statement in FACET_TRIGGERS_SQL:
+        conn.execute(text(statement))
+
+    names = list(DEFAULT_GENRES)
+    book_genres = []
+    for book_id, genre in conn.execute(text('SELECT id, genre FROM books')):
+        for name in parse_genres(genre):
+            book_genres.append((book_id, name))
+            names.append(name)
+
+    conn.execute(text('INSERT OR IGNORE INTO genres (name, book_count) VALUES (:name, 0)'),
+                 [{'name': name} for name in dict.fromkeys(names)])
+    if book_genres:
+        # счетчики жанров заполнят триггеры
+        conn.execute(text('INSERT OR IGNORE INTO book_genres (book_id, genre_id) '
+                          'SELECT :book_id, id FROM genres WHERE name = :name'),
+                     [{'book_id': book_id, 'name': name} for book_id, name in book_genres])
+
+
+MIGRATIONS = [
+    # 1: хэш и время обновления обложки для /cover
+    [add_column('books', 'image_hash', 'VARCHAR'),
+     add_column('books', 'image_updated_at', 'DATETIME')],
+    # 2: одна запись о выдаче на пару читатель-книга
+    [merge_duplicate_loans,
+     execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_borrowed_books_user_book ON borrowed_books (user_id, book_id)')],
+    # 3: индексы для частых запросов
+    [execute('CREATE INDEX IF NOT EXISTS ix_borrowed_books_book_id ON borrowed_books (book_id)'),
+     execute('CREATE INDEX IF NOT EXISTS ix_borrowed_books_return_by ON borrowed_books (return_by)'),
+     execute('CREATE INDEX IF NOT EXISTS ix_users_telegram_id ON users (telegram_id)'),
+     execute('CREATE INDEX IF NOT EXISTS ix_books_author ON books (author)'),
+     execute('CREATE INDEX IF NOT EXISTS ix_books_genre ON books (genre)')],
+    # 4: жанры из строки books.genre переезжают в genres/book_genres со счетчиками книг
+    [populate_genres],
+    # 5: триггер индекса поиска можно приостановить на время массового импорта,
+    # create_search_index создаст его заново уже с условием
+    [execute('DROP TRIGGER IF EXISTS books_fts_insert')],
+    # 6: версия каталога для ETag в API
+    [create_catalog_version],
+    # 7: история возвратов и сводки выдач для отчетов администратора
+    [create_circulation],
+    # 8: журнал изменений рейтинга и таблица сроков выдачи
+    [create_rating_ledger],
+    # 9: лист ожидания и уведомления о поступлении книг
+    [create_waitlist],
+    # 10: оригиналы обложек - один раз на содержимое
+    [move_cover_originals],
+    # 11: выдача книги гасит неотправленные уведомления о ней
+    [execute('DROP TRIGGER IF EXISTS borrowed_books_waitlist_leave'),
+     create_waitlist],
+    # 12: id записей очереди не переиспользуются
+    [rebuild_waitlist_autoincrement],
+]
+
+
+def get_schema_version(conn):
+    return conn.execute(text('PRAGMA user_version')).scalar()
+
+
+def migrate(engine):
+    with engine.connect() as conn:
+        version = get_schema_version(conn)
+
+    for number, steps in enumerate(MIGRATIONS[version:], start=version + 1):
+        # каждая миграция - отдельная транзакция вместе с новым номером версии
+        with engine.begin() as conn:
+            for step in steps:
+                step(conn)
+            conn.execute(text(f'PRAGMA user_version = {number}'))
@@ -0,0 +1,44 @@
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+
+
+# колонки для списков книг: без BLOB обложки, только признак ее наличия
+BOOK_ROW_COLUMNS = (
+    Book.id, Book.title, Book.author, Book.genre, Book.quantity, Book.image_hash,
+    Book.image_data.isnot(None).label('has_image'))
+
+
+def query_book_rows(db_sess):
+    # строки-кортежи вместо ORM-объектов: без identity map и инструментирования атрибутов
+    return db_sess.query(*BOOK_ROW_COLUMNS)
+
+
+def get_borrowed_book_ids(db_sess, user_id):
+    rows = db_sess.query(BorrowedBook.book_id).filter(BorrowedBook.user_id == user_id)
+    return {book_id for book_id, in rows}
+
+
+def get_user_loans(db_sess, user_id):
+    # пары (BorrowedBook, Book) одним запросом вместо get() на каждую взятую книгу
+    return (
+        db_sess.query(BorrowedBook, Book)
+        .join(Book, Book.id == BorrowedBook.book_id)
+        .filter(BorrowedBook.user_id == user_id)
+        .order_by(BorrowedBook.return_by)
+        .all())
+
+
+def keyset_page(query, cursor=None, limit=50):
+    # страница по возрастанию id: следующая начинается после последнего id текущей
+    if cursor:
+        query = query.filter(Book.id > cursor)
+    items = query.order_by(Book.id).limit(limit + 1).all()
+    next_cursor = items[limit - 1].id if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+def offset_page(query, offset=0, limit=50):
+    # для результатов поиска, отсортированных по релевантности, а не по id
+    items = query.offset(offset or 0).limit(limit + 1).all()
+    next_cursor = (offset or 0) + limit if len(items) > limit else None
+    return items[:limit], next_cursor
@@ -0,0 +1,115 @@
+from bisect import bisect_right
+from datetime import datetime
+import os
+import threading
+import time
+
+from sqlalchemy import Column, Integer, String, DateTime, Index, text
+
+from data.db_session import SqlAlchemyBase
+
+BASE_RATING = 100
+ON_TIME_RETURN_DELTA = 20
+LATE_RETURN_DELTA = -30
+
+# нижняя граница рейтинга -> срок выдачи в днях; первая строка действует и для рейтинга ниже нее
+DEFAULT_BORROW_LIMITS = ((0, 28), (20, 35), (50, 42), (80, 49), (100, 56), (150, 63), (200, 70), (250, 77),
+                         (300, 84), (350, 91), (400, 98), (450, 105))
+
+# политика читается из базы; другие процессы увидят изменение не позже чем через TTL секунд
+BORROW_POLICY_TTL = float(os.getenv('BORROW_POLICY_TTL') or 60)
+
+
+class RatingEvent(SqlAlchemyBase):
+    # журнал только дописывается: users.rating - сумма дельт поверх BASE_RATING
+    __tablename__ = 'rating_events'
+    __table_args__ = (Index('ix_rating_events_user_delta', 'user_id', 'delta'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)
+    delta = Column(Integer, nullable=False)
+    reason = Column(String, nullable=False)
+    borrowed_book_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class BorrowLimit(SqlAlchemyBase):
+    __tablename__ = 'borrow_limits'
+
+    min_rating = Column(Integer, primary_key=True)
+    max_borrow_days = Column(Integer, nullable=False)
+
+
+class BorrowPolicy:
+    def __init__(self, limits):
+        limits = sorted((int(min_rating), int(days)) for min_rating, days in limits)
+        if not limits:
+            raise ValueError('empty borrow policy')
+        self.limits = tuple(limits)
+        self.bounds = [min_rating for min_rating, _ in limits[1:]]
+        self.days = [days for _, days in limits]
+
+    def max_borrow_days(self, rating):
+        return self.days[bisect_right(self.bounds, rating)]
+
+    def case_sql(self, column):
+        # та же таблица порогов в виде выражения SQL для пересчета пачкой
+        whens = ' '.join(f'WHEN {column} < {bound} THEN {days}' for bound, days in zip(self.bounds, self.days))
+        return f'CASE {whens} ELSE {self.days[-1]} END' if whens else str(self.days[0])
+
+
+DEFAULT_POLICY = BorrowPolicy(DEFAULT_BORROW_LIMITS)
+
+_policy_lock = threading.Lock()
+_policy_cache = None
+
+
+def load_borrow_policy(db_sess):
+    limits = db_sess.query(BorrowLimit.min_rating, BorrowLimit.max_borrow_days).all()
+    return BorrowPolicy(limits) if limits else DEFAULT_POLICY
+
+
+def get_borrow_policy(db_sess):
+    global _policy_cache
+    cached = _policy_cache
+    if cached is not None and time.monotonic() - cached[0] < BORROW_POLICY_TTL:
+        return cached[1]
+    policy = load_borrow_policy(db_sess)
+    with _policy_lock:
+        _policy_cache = (time.monotonic(), policy)
+    return policy
+
+
+def set_borrow_limits(db_sess, limits):
+    policy = BorrowPolicy(limits)
+    db_sess.query(BorrowLimit).delete(synchronize_session=False)
+    db_sess.add_all(BorrowLimit(min_rating=min_rating, max_borrow_days=days) for min_rating, days in policy.limits)
+    db_sess.commit()
+    invalidate_borrow_policy()
+    return policy
+
+
+def invalidate_borrow_policy():
+    global _policy_cache
+    with _policy_lock:
+        _policy_cache = None
+
+
+def record_rating_event(db_sess, user_id, delta, reason, borrowed_book_id=None):
+    # запись попадает в транзакцию вызывающего кода вместе с изменением users.rating
+    db_sess.add(RatingEvent(user_id=user_id, delta=delta, reason=reason, borrowed_book_id=borrowed_book_id))
+
+
+def open_rating_balances(conn):
+    # начальная запись для пользователей, чей рейтинг появился до журнала, иначе пересчет его потеряет
+    conn.execute(text("""
+        INSERT INTO rating_events (user_id, delta, reason, created_at)
+        SELECT id, coalesce(rating, :base) - :base, 'opening', datetime('now') FROM users
+        WHERE coalesce(rating, :base) != :base
+          AND NOT EXISTS (SELECT 1 FROM rating_events e WHERE e.user_id = users.id)"""), {'base': BASE_RATING})
+
+
+def seed_borrow_limits(conn):
+    if not conn.execute(text('SELECT 1 FROM borrow_limits LIMIT 1')).first():
+        conn.execute(text('INSERT INTO borrow_limits (min_rating, max_borrow_days) VALUES (:min_rating, :days)'),
+                     [{'min_rating': min_rating, 'days': days} for min_rating, days in DEFAULT_BORROW_LIMITS])
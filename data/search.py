@@ -0,0 +1,83 @@
+import re
+
+from sqlalchemy import text, Integer, Float
+
+from data.books import Book
+
+SEARCH_COLUMNS = ('title', 'author', 'genre')
+
+# unicode61 приводит к нижнему регистру и кириллицу, так что capitalize() больше не нужен
+CREATE_INDEX_SQL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, genre,
+        content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    # строка в books_fts_paused означает, что пишущая транзакция сама проиндексирует вставленные книги
+    """CREATE TABLE IF NOT EXISTS books_fts_paused (id INTEGER PRIMARY KEY)""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books
+    WHEN NOT EXISTS (SELECT 1 FROM books_fts_paused) BEGIN
+        INSERT INTO books_fts(rowid, title, author, genre) VALUES (new.id, new.title, new.author, new.genre);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, genre)
+        VALUES ('delete', old.id, old.title, old.author, old.genre);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, genre ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, genre)
+        VALUES ('delete', old.id, old.title, old.author, old.genre);
+        INSERT INTO books_fts(rowid, title, author, genre) VALUES (new.id, new.title, new.author, new.genre);
+    END"""]
+
+
+def create_search_index(engine):
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'")).first()
+        for statement in CREATE_INDEX_SQL:
+            conn.execute(text(statement))
+        if not exists:
+            # индекс создан впервые - заполняем его уже имеющимися книгами
+            conn.execute(text("INSERT INTO books_fts(books_fts) VALUES ('rebuild')"))
+
+
+def pause_search_index(db_sess):
+    # флаг виден только внутри текущей транзакции записи, другие писатели в это время ждут блокировку
+    db_sess.execute(text("INSERT INTO books_fts_paused DEFAULT VALUES"))
+
+
+def resume_search_index(db_sess, first_id, last_id):
+    db_sess.execute(text("DELETE FROM books_fts_paused"))
+    db_sess.execute(
+        text("INSERT INTO books_fts(rowid, title, author, genre) "
+             "SELECT id, title, author, genre FROM books WHERE id BETWEEN :first_id AND :last_id"),
+        {'first_id': first_id, 'last_id': last_id})
+
+
+def build_match_query(search_query, columns=None):
+    tokens = re.findall(r'\w+', search_query)
+    if not tokens:
+        return None
+
+    # каждое слово ищем по префиксу, все слова должны встретиться
+    match_query = ' '.join(f'"{token}"*' for token in tokens)
+    if columns:
+        match_query = f"{{{' '.join(columns)}}} : ({match_query})"
+    return match_query
+
+
+# если передан query, поиск накладывается на него (например, на запрос с фильтром по жанрам)
+def search_books(db_sess, search_query, columns=None, query=None):
+    if query is None:
+        query = db_sess.query(Book)
+
+    match_query = build_match_query(search_query, columns)
+    if match_query is None:
+        return query.filter(False)
+
+    matches = (
+        text("SELECT rowid, bm25(books_fts) AS rank FROM books_fts WHERE books_fts MATCH :match_query")
+        .bindparams(match_query=match_query)
+        .columns(rowid=Integer, rank=Float)
+        .subquery('matches'))
+
+    return query.join(matches, Book.id == matches.c.rowid).order_by(matches.c.rank, Book.id)
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+import json
+import os
+import random
+
+from sqlalchemy import Column, Integer, Text, DateTime, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from data.db_session import SqlAlchemyBase
+
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL') or 900)
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE') or 1000)
+
+
+class BotSearchResult(SqlAlchemyBase):
+    # последний поиск чата: id найденных книг в порядке релевантности. Лежит в базе, поэтому
+    # кнопки листания работают в любом процессе бота; кнопки старых поисков узнаются по номеру
+    __tablename__ = 'bot_search_results'
+
+    chat_id = Column(Integer, primary_key=True)
+    token = Column(Integer, nullable=False)
+    book_ids = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+def save_search(db_sess, chat_id, book_ids, ttl=SEARCH_CACHE_TTL, max_size=SEARCH_CACHE_SIZE):
+    # номер случайный: общего счетчика у процессов нет, а совпасть должен только с последним поиском чата
+    token = random.randrange(1, 2 ** 31)
+    now = datetime.utcnow()
+    statement = insert(BotSearchResult).values(chat_id=chat_id, token=token, book_ids=json.dumps(list(book_ids)),
+                                               expires_at=now + timedelta(seconds=ttl))
+    db_sess.execute(statement.on_conflict_do_update(index_elements=['chat_id'], set_={
+        'token': statement.excluded.token, 'book_ids': statement.excluded.book_ids,
+        'expires_at': statement.excluded.expires_at}))
+    # строка на чат; просроченные убираем попутно. Всплеск поисков из множества чатов за время TTL
+    # ограничен max_size: лишними считаются строки с самым ранним сроком, то есть давно не листавшиеся
+    db_sess.query(BotSearchResult).filter(BotSearchResult.expires_at < now).delete(synchronize_session=False)
+    oldest = (select(BotSearchResult.chat_id).order_by(BotSearchResult.expires_at.desc())
+              .limit(-1).offset(max_size).scalar_subquery())
+    db_sess.query(BotSearchResult).filter(BotSearchResult.chat_id.in_(oldest)).delete(synchronize_session=False)
+    db_sess.commit()
+    return token
+
+
+def load_search(db_sess, chat_id, token, ttl=SEARCH_CACHE_TTL):
+    # листание продлевает жизнь результатам; чтение и продление - один запрос
+    now = datetime.utcnow()
+    book_ids = db_sess.execute(
+        update(BotSearchResult)
+        .where(BotSearchResult.chat_id == chat_id, BotSearchResult.token == token, BotSearchResult.expires_at >= now)
+        .values(expires_at=now + timedelta(seconds=ttl))
+        .returning(BotSearchResult.book_ids)).scalar()
+    db_sess.commit()
+    return tuple(json.loads(book_ids)) if book_ids is not None else None
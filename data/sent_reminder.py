@@ -0,0 +1,12 @@
+from sqlalchemy import Column, Integer, Date, ForeignKey, Index
+from data.db_session import SqlAlchemyBase
+
+
+class SentReminder(SqlAlchemyBase):
+    __tablename__ = 'sent_reminders'
+    __table_args__ = (Index('ix_sent_reminders_loan_day', 'borrowed_book_id', 'sent_on', unique=True),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    borrowed_book_id = Column(Integer, ForeignKey('borrowed_books.id'), nullable=False)
+    sent_on = Column(Date, nullable=False)
+    days_left = Column(Integer, nullable=False)
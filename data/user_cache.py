@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from data.users import User
+
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL') or 60)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE') or 1024)
+
+
+class UserCache:
+    # id пользователя -> (срок годности, отсоединенный от сессии User).
+    # Объекты только читаются: для изменений пользователя его нужно заново загрузить в свою сессию
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, db_sess, user_id):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(user_id)
+            if item and item[0] > now:
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+
+        user = db_sess.get(User, user_id)
+        if user is None:
+            return None
+        # после expunge коммиты сессии не сбросят загруженные поля, и объект переживет запрос
+        db_sess.expunge(user)
+
+        with self._lock:
+            self._items[user_id] = (now + self.ttl, user)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+        return user
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(user_id, None)
+
+    def invalidate_on_commit(self, db_sess, user_id):
+        # сброс после коммита: иначе параллельный запрос успеет закэшировать еще старую строку
+        event.listen(db_sess, 'after_commit', lambda session: self.invalidate(user_id), once=True)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# кэш свой у каждого процесса, invalidate сбрасывает только его. Изменения из другого процесса (бота)
+# сайт увидит не позже чем через ttl, поэтому бот кэш не трогает: telegram_id на сайте не читается
+user_cache = UserCache()
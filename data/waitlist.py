@@ -0,0 +1,168 @@
+from datetime import datetime
+import threading
+
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index, func, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from data.db_session import SqlAlchemyBase
+from data.books import Book
+from data.users import User
+
+JOINED = 'joined'
+ALREADY_WAITING = 'already_waiting'
+IN_STOCK = 'in_stock'
+NOT_FOUND = 'not_found'
+NOT_ALLOWED = 'not_allowed'
+
+
+class WaitlistEntry(SqlAlchemyBase):
+    # очередь на книгу, которой нет в наличии; порядок - по id. AUTOINCREMENT не дает занять id
+    # удаленной записи: на него может ссылаться уведомление в availability_notices
+    __tablename__ = 'waitlist'
+    __table_args__ = (Index('ix_waitlist_user_book', 'user_id', 'book_id', unique=True),
+                      Index('ix_waitlist_book_pending', 'book_id', 'notified_at', 'id'),
+                      {'sqlite_autoincrement': True})
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    notified_at = Column(DateTime, nullable=True)
+
+
+class AvailabilityNotice(SqlAlchemyBase):
+    # исходящие уведомления: сайт отдает их по SSE, бот рассылает неотправленные
+    __tablename__ = 'availability_notices'
+    __table_args__ = (Index('ix_availability_notices_user', 'user_id', 'id'),
+                      Index('ix_availability_notices_bot_pending', 'id', sqlite_where=text('bot_sent_at IS NULL')))
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    waitlist_id = Column(Integer, nullable=False, unique=True)
+    user_id = Column(Integer, nullable=False)
+    book_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    bot_sent_at = Column(DateTime, nullable=True)
+
+
+# рост quantity любым путем (возврат, редактирование, API, импорт) уведомляет столько первых
+# ожидающих, сколько экземпляров прибавилось; выдача книги снимает читателя с очереди
+WAITLIST_TRIGGERS_SQL = [
+    """CREATE TRIGGER IF NOT EXISTS books_waitlist_notify AFTER UPDATE OF quantity ON books
+    WHEN new.quantity > old.quantity BEGIN
+        INSERT INTO availability_notices (waitlist_id, user_id, book_id, created_at)
+        SELECT id, user_id, book_id, datetime('now') FROM waitlist
+        WHERE book_id = new.id AND notified_at IS NULL
+        ORDER BY id LIMIT new.quantity - old.quantity;
+        UPDATE waitlist SET notified_at = datetime('now')
+        WHERE book_id = new.id AND notified_at IS NULL
+          AND EXISTS (SELECT 1 FROM availability_notices n WHERE n.waitlist_id = waitlist.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS borrowed_books_waitlist_leave AFTER INSERT ON borrowed_books BEGIN
+        DELETE FROM waitlist WHERE user_id = new.user_id AND book_id = new.book_id;
+        -- книга уже у читателя: неотправленное уведомление о ней боту больше не рассылать
+        UPDATE availability_notices SET bot_sent_at = datetime('now')
+        WHERE user_id = new.user_id AND book_id = new.book_id AND bot_sent_at IS NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_waitlist_delete AFTER DELETE ON books BEGIN
+        DELETE FROM waitlist WHERE book_id = old.id;
+    END"""]
+
+
+class NoticeBell:
+    # будит SSE-потоки этого процесса сразу после коммита, который мог создать уведомления;
+    # изменения из других процессов потоки увидят при периодической проверке
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def ring(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self._generation != generation, timeout)
+            return self._generation
+
+
+notice_bell = NoticeBell()
+
+
+def join_waitlist(db_sess, user_id, book_id):
+    # общая запись в очередь для сайта и бота; результат - одна из констант выше
+    if db_sess.query(User.role).filter(User.id == user_id).scalar() == "admin":
+        return NOT_ALLOWED
+    quantity = db_sess.query(Book.quantity).filter(Book.id == book_id).scalar()
+    if quantity is None:
+        return NOT_FOUND
+    if quantity > 0:
+        return IN_STOCK
+
+    entry = db_sess.query(WaitlistEntry).filter_by(user_id=user_id, book_id=book_id).first()
+    if entry is not None and entry.notified_at is None:
+        return ALREADY_WAITING
+    if entry is not None:
+        # уведомление уже было, но книгу не взяли: встаем в конец очереди заново
+        db_sess.query(AvailabilityNotice).filter(AvailabilityNotice.waitlist_id == entry.id).update(
+            {AvailabilityNotice.bot_sent_at: func.coalesce(AvailabilityNotice.bot_sent_at, datetime.utcnow())},
+            synchronize_session=False)
+        db_sess.delete(entry)
+        db_sess.flush()
+    db_sess.add(WaitlistEntry(user_id=user_id, book_id=book_id))
+    try:
+        db_sess.commit()
+    except IntegrityError:
+        # двойное нажатие: вторая запись упирается в уникальный индекс (user_id, book_id)
+        db_sess.rollback()
+        return ALREADY_WAITING
+    return JOINED
+
+
+def leave_waitlist(db_sess, user_id, book_id):
+    left = db_sess.query(WaitlistEntry).filter_by(user_id=user_id, book_id=book_id).delete(
+        synchronize_session=False)
+    db_sess.commit()
+    return bool(left)
+
+
+def get_waiting_book_ids(db_sess, user_id):
+    return {book_id for book_id, in db_sess.query(WaitlistEntry.book_id)
+            .filter(WaitlistEntry.user_id == user_id, WaitlistEntry.notified_at.is_(None))}
+
+
+def get_user_waitlist(db_sess, user_id):
+    # место в очереди - число еще не уведомленных до нас; считается в том же запросе
+    # по индексу (book_id, notified_at, id), а не отдельным запросом на каждую запись
+    ahead = aliased(WaitlistEntry)
+    position = (select(func.count(ahead.id))
+                .where(ahead.book_id == WaitlistEntry.book_id, ahead.notified_at.is_(None),
+                       ahead.id <= WaitlistEntry.id)
+                .correlate(WaitlistEntry)
+                .scalar_subquery())
+    rows = (db_sess.query(WaitlistEntry, Book.title, Book.author, Book.quantity, position)
+            .join(Book, Book.id == WaitlistEntry.book_id)
+            .filter(WaitlistEntry.user_id == user_id)
+            .order_by(WaitlistEntry.id).all())
+    return [{'book_id': entry.book_id, 'title': title, 'author': author, 'quantity': quantity,
+             'position': position if entry.notified_at is None else None, 'notified_at': entry.notified_at}
+            for entry, title, author, quantity, position in rows]
+
+
+def get_notices(db_sess, user_id, after_id=0, limit=50):
+    rows = (db_sess.query(AvailabilityNotice.id, AvailabilityNotice.book_id, Book.title, Book.author, Book.quantity)
+            .join(Book, Book.id == AvailabilityNotice.book_id)
+            .filter(AvailabilityNotice.user_id == user_id, AvailabilityNotice.id > after_id)
+            .order_by(AvailabilityNotice.id)
+            .limit(limit).all())
+    return [{'id': notice_id, 'book_id': book_id, 'title': title, 'author': author, 'quantity': quantity}
+            for notice_id, book_id, title, author, quantity in rows]
+
+
+def get_last_notice_id(db_sess, user_id):
+    return db_sess.query(func.max(AvailabilityNotice.id)).filter(AvailabilityNotice.user_id == user_id).scalar() or 0
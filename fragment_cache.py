@@ -0,0 +1,154 @@
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+from markupsafe import Markup
+
+# memory - словарь в процессе, file - файлы в FRAGMENT_CACHE_DIR (общие для всех процессов сервера), off - без кэша
+FRAGMENT_CACHE_BACKEND = os.getenv('FRAGMENT_CACHE') or 'memory'
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE') or 5000)
+FRAGMENT_CACHE_DIR = os.getenv('FRAGMENT_CACHE_DIR') or 'cache/fragments'
+
+
+class MemoryBackend:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            evicted = 0
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class FileBackend:
+    # время изменения файла - время последнего обращения, по нему вытесняются самые старые
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._count = len(os.listdir(directory))
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        # запись через временный файл: параллельный читатель не увидит половину фрагмента
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._count += 1
+            # каталог просматривается, только когда файлов заметно больше лимита
+            if self._count <= self.max_size * 1.1:
+                return 0
+            return self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.tmp'):
+                entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        evicted = 0
+        for _, path in entries[:max(len(entries) - self.max_size, 0)]:
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+        self._count = len(entries) - evicted
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                os.remove(entry.path)
+            self._count = 0
+
+    def __len__(self):
+        return self._count
+
+
+class FragmentCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_render(self, key, render):
+        # render - функция без аргументов, возвращающая готовый HTML
+        if self.backend is None:
+            return Markup(render())
+
+        value = self.backend.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return Markup(value)
+
+        value = str(render())
+        evicted = self.backend.set(key, value)
+        with self._lock:
+            self.misses += 1
+            self.evictions += evicted
+        return Markup(value)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        backend = type(self.backend).__name__ if self.backend is not None else 'off'
+        return {'backend': backend, 'size': len(self.backend) if self.backend is not None else 0,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def create_backend(name=FRAGMENT_CACHE_BACKEND):
+    if name == 'memory':
+        return MemoryBackend(FRAGMENT_CACHE_SIZE)
+    if name == 'file':
+        return FileBackend(FRAGMENT_CACHE_DIR, FRAGMENT_CACHE_SIZE)
+    if name == 'off':
+        return None
+    raise ValueError(f'unknown fragment cache backend {name}')
+
+
+fragment_cache = FragmentCache(create_backend())
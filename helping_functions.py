@@ -1,16 +1,42 @@
+import hashlib
 import os
 from io import BytesIO
 from PIL import Image
 
 
-def optimize_image(file):
-    img = Image.open(file)
-    img.thumbnail((300, 300))
+def read_image(file):
+    # проверяем только заголовок, полное декодирование делает конвейер обложек
+    image_data = file.read()
+    Image.open(BytesIO(image_data)).verify()
+    return image_data
+
+
+def resize_image(image_data, size, image_format=None):
+    img = Image.open(BytesIO(image_data))
+    image_format = image_format or img.format
+    if image_format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+        # WebP не хранит CMYK и палитру
+        img = img.convert('RGBA')
+    img.thumbnail(size)
     output = BytesIO()
-    img.save(output, format=img.format)
+    img.save(output, format=image_format)
     return output.getvalue()
 
 
+def image_hash(image_data):
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def image_mimetype(image_data):
+    if image_data.startswith(b'\xff\xd8\xff'):
+        return "image/jpeg"
+    if image_data.startswith(b'RIFF') and image_data[8:12] == b'WEBP':
+        return "image/webp"
+    if image_data.startswith(b'GIF8'):
+        return "image/gif"
+    return "image/png"
+
+
 def load_admin_ids():
     admin_ids = []
     file_path = os.path.join(os.path.dirname(__file__), 'admin_ids.txt')
@@ -21,29 +47,3 @@ def load_admin_ids():
 
     return admin_ids
 
-
-def calculate_max_borrow_days(rating):
-    if rating < 20:
-        return 28
-    elif rating < 50:
-        return 35
-    elif rating < 80:
-        return 42
-    elif rating < 100:
-        return 49
-    elif rating < 150:
-        return 56
-    elif rating < 200:
-        return 63
-    elif rating < 250:
-        return 70
-    elif rating < 300:
-        return 77
-    elif rating < 350:
-        return 84
-    elif rating < 400:
-        return 91
-    elif rating < 450:
-        return 98
-    else:
-        return 105
\ No newline at end of file
@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from threading import Lock
+import logging
+import multiprocessing
+import os
+
+from sqlalchemy.dialects.sqlite import insert
+
+from data.cover_renditions import CoverRendition
+from data.db_session import session_scope
+from helping_functions import resize_image
+
+# вид -> (размер, формат); формат None - как у исходной картинки.
+# medium - та же миниатюра для экранов с плотностью 2x (srcset).
+# Для каждого размера есть WebP: /cover отдает его браузерам, которые пишут image/webp в Accept
+COVER_SIZES = ('thumb', 'medium')
+WEBP = 'webp'
+RENDITIONS = {
+    'thumb': ((80, 80), None),
+    'medium': ((160, 160), None),
+    'thumb.webp': ((80, 80), 'WEBP'),
+    'medium.webp': ((160, 160), 'WEBP')}
+# исходная загрузка лежит в той же таблице: одна строка на содержимое, сколько бы книг ее ни использовали
+ORIGINAL = 'original'
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS') or 2)
+
+_executor = None
+_pending = {}
+_lock = Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # fork из многопоточного сервера копирует чужие захваченные блокировки, поэтому spawn
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def get_rendition(db_sess, image_hash, kind):
+    return (db_sess.query(CoverRendition.image_data)
+            .filter(CoverRendition.image_hash == image_hash, CoverRendition.kind == kind)
+            .scalar())
+
+
+def store_original(db_sess, image_hash, image_data):
+    # попадает в транзакцию вызывающего кода
+    db_sess.execute(insert(CoverRendition).on_conflict_do_nothing(), [
+        {'image_hash': image_hash, 'kind': ORIGINAL, 'image_data': image_data}])
+
+
+def _store_rendition(image_hash, kind, future):
+    try:
+        image_data = future.result()
+        with session_scope() as db_sess:
+            db_sess.execute(insert(CoverRendition).on_conflict_do_nothing(), [
+                {'image_hash': image_hash, 'kind': kind, 'image_data': image_data}])
+            db_sess.commit()
+    except Exception:
+        logging.exception(f'failed to render {kind} cover {image_hash}')
+    finally:
+        with _lock:
+            _pending[image_hash] -= 1
+            if not _pending[image_hash]:
+                del _pending[image_hash]
+
+
+def submit_renditions(db_sess, image_hash, image_data):
+    # не ждет результата: запрос возвращается сразу, версии появляются по мере готовности
+    with _lock:
+        if image_hash in _pending:
+            return
+        _pending[image_hash] = len(RENDITIONS)
+
+    existing = {kind for kind, in db_sess.query(CoverRendition.kind).filter(CoverRendition.image_hash == image_hash)}
+    missing = [kind for kind in RENDITIONS if kind not in existing]
+
+    with _lock:
+        _pending[image_hash] = len(missing)
+        if not missing:
+            del _pending[image_hash]
+            return
+
+    executor = get_executor()
+    for kind in missing:
+        size, image_format = RENDITIONS[kind]
+        future = executor.submit(resize_image, image_data, size, image_format)
+        future.add_done_callback(partial(_store_rendition, image_hash, kind))
@@ -0,0 +1,209 @@
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# пороги в миллисекундах; запросы и SQL дольше порога пишутся в лог с подробностями
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS') or 500)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS') or 100)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+slow_log = logging.getLogger('slow')
+
+# счетчики текущего запроса или апдейта бота: {'queries': ..., 'sql_seconds': ...}
+_current = ContextVar('metrics_current', default=None)
+
+
+class Registry:
+    # простые счетчики и гистограммы в формате Prometheus, без внешних зависимостей
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(DURATION_BUCKETS), 0, 0.0]
+            buckets, _, _ = histogram
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    buckets[index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def add_collector(self, collector):
+        # collector() -> [(имя, метки, значение)] для значений, которые считаются в других модулях
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+            seen.add(name)
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(buckets), count, total))
+                                for key, (buckets, count, total) in self._histograms.items())
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for (name, labels), (buckets, count, total) in histograms:
+            header(name)
+            for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {bucket_count}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                header(name)
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+registry = Registry()
+registry.describe('library_http_requests_total', 'counter', 'HTTP requests by endpoint, method and status')
+registry.describe('library_http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint')
+registry.describe('library_http_response_bytes_total', 'counter', 'Response body bytes by endpoint')
+registry.describe('library_sql_queries_total', 'counter', 'SQL statements by endpoint or bot handler')
+registry.describe('library_sql_seconds_total', 'counter', 'Time spent in SQL by endpoint or bot handler')
+registry.describe('library_sql_slow_queries_total', 'counter', 'SQL statements slower than SLOW_QUERY_MS')
+registry.describe('library_bot_updates_total', 'counter', 'Bot updates by handler')
+registry.describe('library_bot_handler_duration_seconds', 'histogram', 'Bot handler latency')
+registry.describe('library_bot_errors_total', 'counter', 'Bot handlers that raised an exception')
+
+
+def begin():
+    return _current.set({'queries': 0, 'sql_seconds': 0.0})
+
+
+def finish(token):
+    stats = _current.get()
+    _current.reset(token)
+    return stats
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats['queries'] += 1
+        stats['sql_seconds'] += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        registry.inc('library_sql_slow_queries_total')
+        slow_log.warning('slow query %.1f ms: %s %s', elapsed * 1000, ' '.join(statement.split())[:500],
+                         repr(parameters)[:200] if not executemany else f'executemany x{len(parameters)}')
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # упавший запрос не доходит до after_cursor_execute, его время старта нужно убрать здесь
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def record_request(endpoint, method, status, seconds, stats, response_bytes=None):
+    registry.inc('library_http_requests_total', (('endpoint', endpoint), ('method', method), ('status', status)))
+    registry.observe('library_http_request_duration_seconds', seconds, (('endpoint', endpoint),))
+    if response_bytes is not None:
+        registry.inc('library_http_response_bytes_total', (('endpoint', endpoint),), response_bytes)
+    registry.inc('library_sql_queries_total', (('endpoint', endpoint),), stats['queries'])
+    registry.inc('library_sql_seconds_total', (('endpoint', endpoint),), stats['sql_seconds'])
+    if seconds * 1000 >= SLOW_REQUEST_MS:
+        slow_log.warning('slow request %s %s %s: %.1f ms, %d queries, %.1f ms in SQL', method, endpoint, status,
+                         seconds * 1000, stats['queries'], stats['sql_seconds'] * 1000)
+
+
+def record_bot_update(handler, seconds, stats):
+    registry.inc('library_bot_updates_total', (('handler', handler),))
+    registry.observe('library_bot_handler_duration_seconds', seconds, (('handler', handler),))
+    registry.inc('library_sql_queries_total', (('endpoint', f'bot:{handler}'),), stats['queries'])
+    registry.inc('library_sql_seconds_total', (('endpoint', f'bot:{handler}'),), stats['sql_seconds'])
+    if seconds * 1000 >= SLOW_REQUEST_MS:
+        slow_log.warning('slow bot handler %s: %.1f ms, %d queries, %.1f ms in SQL', handler, seconds * 1000,
+                         stats['queries'], stats['sql_seconds'] * 1000)
+
+
+def init_app(app):
+    from flask import request
+
+    @app.before_request
+    def start_request_metrics():
+        request.environ['metrics.started'] = time.perf_counter()
+        request.environ['metrics.token'] = begin()
+
+    @app.after_request
+    def record_request_metrics(response):
+        token = request.environ.pop('metrics.token', None)
+        if token is None:
+            return response
+        stats = finish(token)
+        seconds = time.perf_counter() - request.environ['metrics.started']
+        # для потоковых ответов размер заранее неизвестен и не учитывается
+        response_bytes = None if response.is_streamed else response.calculate_content_length()
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        record_request(endpoint, request.method, str(response.status_code), seconds, stats, response_bytes)
+        return response
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+    # отдельный /metrics для процессов без своего HTTP-сервера (бот в режиме polling)
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,89 @@
+import argparse
+import time
+
+from sqlalchemy import func, text
+
+from data import db_session
+from data.ratings import BASE_RATING, get_borrow_policy, invalidate_borrow_policy, set_borrow_limits
+from data.users import User
+
+RECOMPUTE_CHUNK_SIZE = 5000
+# без паузы ожидающий писатель SQLite не успевает взять блокировку между пачками и ждет весь пересчет
+RECOMPUTE_PAUSE = 0.02
+
+
+def recompute_chunk_sql(policy):
+    # одна инструкция на пачку: сумма журнала по каждому пользователю и срок по порогам политики,
+    # переписываются только строки, где что-то поменялось
+    days = policy.case_sql('t.rating')
+    return text(f"""
+        UPDATE users SET rating = t.rating, max_borrow_days = {days}
+        FROM (SELECT u.id, :base + coalesce(sum(e.delta), 0) AS rating
+              FROM users u LEFT JOIN rating_events e ON e.user_id = u.id
+              WHERE u.id > :after AND u.id <= :last
+              GROUP BY u.id) AS t
+        WHERE users.id = t.id AND (users.rating IS NOT t.rating OR users.max_borrow_days IS NOT {days})""")
+
+
+def recompute_ratings(db_sess, chunk_size=RECOMPUTE_CHUNK_SIZE, pause=RECOMPUTE_PAUSE):
+    # каждая пачка - отдельная короткая транзакция, между ними выдачи и возвраты проходят без ожидания
+    invalidate_borrow_policy()
+    statement = recompute_chunk_sql(get_borrow_policy(db_sess))
+    last_id = db_sess.query(func.max(User.id)).scalar() or 0
+    db_sess.rollback()
+
+    report = {'users': 0, 'updated': 0, 'chunks': 0, 'max_chunk_ms': 0.0}
+    for after in range(0, last_id, chunk_size):
+        started = time.perf_counter()
+        result = db_sess.execute(statement, {'base': BASE_RATING, 'after': after, 'last': after + chunk_size})
+        db_sess.commit()
+        report['updated'] += result.rowcount
+        report['chunks'] += 1
+        report['max_chunk_ms'] = max(report['max_chunk_ms'], (time.perf_counter() - started) * 1000)
+        if pause:
+            time.sleep(pause)
+    report['users'] = db_sess.query(func.count(User.id)).scalar()
+    report['max_chunk_ms'] = round(report['max_chunk_ms'], 1)
+    return report
+
+
+def parse_limits(spec):
+    # "0:28,20:35,50:42" -> [(0, 28), (20, 35), (50, 42)]
+    limits = []
+    for item in spec.split(','):
+        min_rating, _, days = item.partition(':')
+        limits.append((int(min_rating), int(days)))
+    return limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Политика сроков выдачи и пересчет рейтингов')
+    parser.add_argument('--db', default='db/library.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    limits_parser = commands.add_parser('limits', help='показать или заменить пороги рейтинга')
+    limits_parser.add_argument('--set', dest='spec', help='пороги вида "0:28,20:35,50:42"')
+
+    recompute_parser = commands.add_parser('recompute', help='пересчитать рейтинг и сроки всех пользователей')
+    recompute_parser.add_argument('--chunk-size', type=int, default=RECOMPUTE_CHUNK_SIZE)
+    recompute_parser.add_argument('--pause', type=float, default=RECOMPUTE_PAUSE, help='пауза между пачками, секунды')
+
+    args = parser.parse_args()
+    db_session.global_init(args.db)
+
+    with db_session.session_scope() as db_sess:
+        if args.command == 'limits':
+            policy = set_borrow_limits(db_sess, parse_limits(args.spec)) if args.spec else get_borrow_policy(db_sess)
+            for min_rating, days in policy.limits:
+                print(f'{min_rating:>6} {days}')
+            if args.spec:
+                print('run "recompute" to apply the new limits to existing users')
+        else:
+            started = time.perf_counter()
+            report = recompute_ratings(db_sess, args.chunk_size, args.pause)
+            print(f"recomputed {report['users']} users in {time.perf_counter() - started:.1f} s: "
+                  f"{report['updated']} changed, {report['chunks']} chunks, longest {report['max_chunk_ms']} ms")
+
+
+if __name__ == '__main__':
+    main()
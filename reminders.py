@@ -0,0 +1,171 @@
+from datetime import datetime, timedelta, time
+import asyncio
+import logging
+import os
+
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated, RetryAfter
+from sqlalchemy import and_, or_, exists
+from sqlalchemy.dialects.sqlite import insert
+
+from data.async_db import run_db
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.sent_reminder import SentReminder
+from data.users import User
+from data.waitlist import AvailabilityNotice
+
+REMINDER_DAYS = (1, 3)
+# Telegram допускает около 30 сообщений в секунду от одного бота
+REMINDER_RATE = float(os.getenv('REMINDER_RATE') or 25)
+REMINDER_CONCURRENCY = int(os.getenv('REMINDER_CONCURRENCY') or 10)
+NOTICE_BATCH_SIZE = 500
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next_slot = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def find_due_reminders(db_sess, today, days_ahead=REMINDER_DAYS):
+    # return_by хранит время, поэтому сравниваем с диапазоном суток, а не с датой
+    day_ranges = []
+    for days in days_ahead:
+        day_start = datetime.combine(today + timedelta(days=days), time.min)
+        day_ranges.append(and_(BorrowedBook.return_by >= day_start,
+                               BorrowedBook.return_by < day_start + timedelta(days=1)))
+
+    already_sent = exists().where(SentReminder.borrowed_book_id == BorrowedBook.id, SentReminder.sent_on == today)
+
+    rows = (
+        db_sess.query(BorrowedBook.id, User.telegram_id, Book.title, BorrowedBook.return_by)
+        .join(User, User.id == BorrowedBook.user_id)
+        .join(Book, Book.id == BorrowedBook.book_id)
+        .filter(or_(*day_ranges), User.telegram_id.isnot(None), ~already_sent)
+        .order_by(BorrowedBook.id)
+        .all())
+    return [(loan_id, telegram_id, title, (return_by.date() - today).days)
+            for loan_id, telegram_id, title, return_by in rows]
+
+
+def claim_reminder(db_sess, loan_id, days_left, today):
+    # строка пишется до отправки: процесс, упавший посреди рассылки, после перезапуска не пришлет
+    # напоминание второй раз, а одновременный второй запуск пропустит уже занятое
+    statement = (insert(SentReminder)
+                 .values(borrowed_book_id=loan_id, sent_on=today, days_left=days_left)
+                 .on_conflict_do_nothing(index_elements=['borrowed_book_id', 'sent_on']))
+    claimed = db_sess.execute(statement).rowcount
+    db_sess.commit()
+    return claimed > 0
+
+
+def release_reminder(db_sess, loan_id, today):
+    db_sess.query(SentReminder).filter_by(borrowed_book_id=loan_id, sent_on=today).delete(synchronize_session=False)
+    db_sess.commit()
+
+
+async def send_with_retry(bot, telegram_id, message):
+    try:
+        await bot.send_message(chat_id=telegram_id, text=message)
+    except RetryAfter as e:
+        await asyncio.sleep(e.timeout)
+        await bot.send_message(chat_id=telegram_id, text=message)
+
+
+async def send_reminder(bot, telegram_id, title, days_left):
+    await send_with_retry(bot, telegram_id, f"Напоминание: вам нужно вернуть книгу '{title}' через {days_left} дней.")
+
+
+async def dispatch_reminders(bot, today=None, rate=REMINDER_RATE, concurrency=REMINDER_CONCURRENCY):
+    today = today or datetime.utcnow().date()
+    reminders = await run_db(find_due_reminders, today)
+    logging.info(f'sending {len(reminders)} reminders')
+
+    limiter = RateLimiter(rate)
+    queue = iter(reminders)
+    sent_total = 0
+
+    async def worker():
+        nonlocal sent_total
+        for loan_id, telegram_id, title, days_left in queue:
+            if not await run_db(claim_reminder, loan_id, days_left, today):
+                continue
+            await limiter.wait()
+            try:
+                await send_reminder(bot, telegram_id, title, days_left)
+            except (BotBlocked, ChatNotFound, UserDeactivated):
+                # повторная отправка не поможет, напоминание остается обработанным
+                logging.warning(f'reminder for loan {loan_id} not delivered')
+            except Exception:
+                # снимаем отметку: напоминание уйдет при следующем запуске
+                logging.exception(f'failed to send reminder for loan {loan_id}')
+                await run_db(release_reminder, loan_id, today)
+                continue
+            sent_total += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    logging.info(f'sent {sent_total} reminders')
+    return sent_total
+
+
+def find_pending_notices(db_sess, limit=NOTICE_BATCH_SIZE):
+    # уведомления из листа ожидания, которые бот еще не разослал, в порядке очереди
+    return (db_sess.query(AvailabilityNotice.id, User.telegram_id, Book.title)
+            .join(User, User.id == AvailabilityNotice.user_id)
+            .outerjoin(Book, Book.id == AvailabilityNotice.book_id)
+            .filter(AvailabilityNotice.bot_sent_at.is_(None))
+            .order_by(AvailabilityNotice.id)
+            .limit(limit).all())
+
+
+def record_sent_notices(db_sess, notice_ids):
+    db_sess.query(AvailabilityNotice).filter(AvailabilityNotice.id.in_(notice_ids)).update(
+        {AvailabilityNotice.bot_sent_at: datetime.utcnow()}, synchronize_session=False)
+    db_sess.commit()
+
+
+async def dispatch_availability_notices(bot, rate=REMINDER_RATE, concurrency=REMINDER_CONCURRENCY):
+    limiter = RateLimiter(rate)
+    sent_total = 0
+
+    while True:
+        notices = await run_db(find_pending_notices)
+        # без привязанного Telegram или для удаленной книги отправлять нечего, такие просто отмечаем
+        done = [notice_id for notice_id, telegram_id, title in notices if telegram_id is None or title is None]
+        queue = iter([notice for notice in notices if notice[1] is not None and notice[2] is not None])
+
+        async def worker():
+            nonlocal sent_total
+            for notice_id, telegram_id, title in queue:
+                await limiter.wait()
+                try:
+                    await send_with_retry(bot, telegram_id, f"Книга '{title}' снова в наличии, ее можно взять.")
+                except (BotBlocked, ChatNotFound, UserDeactivated):
+                    logging.warning(f'availability notice {notice_id} not delivered')
+                except Exception:
+                    # не отмечаем: уведомление уйдет при следующем запуске
+                    logging.exception(f'failed to send availability notice {notice_id}')
+                    continue
+                else:
+                    sent_total += 1
+                done.append(notice_id)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        if done:
+            await run_db(record_sent_notices, done)
+        if not done or len(notices) < NOTICE_BATCH_SIZE:
+            break
+
+    if sent_total:
+        logging.info(f'sent {sent_total} availability notices')
+    return sent_total
@@ -0,0 +1,51 @@
+from contextlib import asynccontextmanager
+import asyncio
+
+from aiogram import Bot, Dispatcher
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.types import Update
+from aiohttp import web
+
+
+class StandInAPI:
+    # заглушка Bot API: запоминает ответы бота по чатам, каждый вызов отвечает с задержкой сети
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.replies = {}
+
+    async def handle(self, request):
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.match_info['method'] != 'sendMessage':
+            return web.json_response({'ok': True, 'result': True})
+        chat_id = int(data['chat_id'])
+        self.replies.setdefault(chat_id, []).append(data.get('text'))
+        return web.json_response({'ok': True, 'result': {
+            'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text')}})
+
+
+@asynccontextmanager
+async def serve(tg_bot, api):
+    # бот из tg_bot ходит в заглушку вместо api.telegram.org
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    tg_bot.bot.server = TelegramAPIServer.from_base(f'http://127.0.0.1:{runner.addresses[0][1]}')
+    Bot.set_current(tg_bot.bot)
+    Dispatcher.set_current(tg_bot.dp)
+    try:
+        yield api
+    finally:
+        await (await tg_bot.bot.get_session()).close()
+        await runner.cleanup()
+
+
+def message_update(update_id, chat_id, text, user_id=None):
+    message = {'message_id': update_id, 'date': 0, 'text': text, 'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': user_id or chat_id, 'is_bot': False, 'first_name': 'Читатель'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return Update(update_id=update_id, message=message)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# app и tg_bot открывают базу при импорте; в тестах это временная база, а не db/library.db
+TEST_DIR = tempfile.mkdtemp(prefix='library-tests-')
+os.environ['LIBRARY_DB'] = os.path.join(TEST_DIR, 'import.db')
+
+from benchmarks.dataset import generate
+from data import db_session
+
+
+@pytest.fixture(scope='session')
+def template_db():
+    # небольшой каталог генерируется один раз, каждый тест получает свою копию
+    path = os.path.join(TEST_DIR, 'template.db')
+    db_session.global_init(path)
+    with db_session.session_scope() as db_sess:
+        generate(db_sess, users=100, books=500, loans=200, covers=10)
+    yield path
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def db_path(template_db, tmp_path):
+    path = str(tmp_path / 'library.db')
+    shutil.copy(template_db, path)
+    db_session.global_init(path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def flask_app():
+    # импорт app открывает базу из LIBRARY_DB, поэтому он идет раньше копии для теста
+    from app import app
+    app.config.update(TESTING=True, SECRET_KEY='test')
+    return app
+
+
+@pytest.fixture(scope='session')
+def tg_bot():
+    # tg_bot при импорте создает бота и открывает базу из LIBRARY_DB, поэтому импорт идет раньше копии базы теста
+    os.environ.setdefault('TG_TOKEN', '123456:library-test-token')
+    import tg_bot
+    return tg_bot
+
+
+@pytest.fixture
+def login(flask_app, db_path):
+    from data.user_cache import user_cache
+    from fragment_cache import fragment_cache
+
+    # кэши процесса могли остаться от базы предыдущего теста
+    user_cache.invalidate()
+    fragment_cache.clear()
+
+    def login_as(user_id):
+        client = flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)
+            sess['_fresh'] = True
+        return client
+    return login_as
@@ -0,0 +1,81 @@
+import asyncio
+import random
+import threading
+import time
+
+from sqlalchemy import event
+
+from benchmarks.dataset import WORDS
+from data import db_session
+from data.async_db import DB_WORKERS
+from data.users import User
+from tests.bot_api import StandInAPI, message_update, serve
+
+CHATS = 1000
+FIRST_CHAT_ID = 800000
+# задержка ответа заглушки Bot API, как у сети до Telegram
+API_LATENCY = 0.01
+
+
+def make_updates(telegram_ids):
+    # каждый чат шлет одну команду; часть отправителей привязана к читателям из базы
+    rng = random.Random(1)
+    commands = [lambda: '/start', lambda: '/my_books', lambda: f'/search {rng.choice(WORDS)}']
+    updates = []
+    for index in range(CHATS):
+        chat_id = FIRST_CHAT_ID + index
+        user_id = telegram_ids[index % len(telegram_ids)] if index % 2 else chat_id
+        updates.append(message_update(index + 1, chat_id, rng.choice(commands)(), user_id))
+    return updates
+
+
+class PoolWatch:
+    # сколько соединений пула занято одновременно и не ушел ли SQL в поток event loop
+    def __init__(self, engine, loop_thread):
+        self.loop_thread = loop_thread
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.queries_on_loop = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'checkout', self.checkout)
+        event.listen(engine, 'checkin', self.checkin)
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def checkout(self, *args):
+        with self._lock:
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def checkin(self, *args):
+        with self._lock:
+            self.checked_out -= 1
+
+    def before_cursor_execute(self, *args):
+        if threading.current_thread() is self.loop_thread:
+            self.queries_on_loop += 1
+
+
+async def run_chats(tg_bot, updates, watch_engine):
+    async with serve(tg_bot, StandInAPI(API_LATENCY)) as api:
+        watch = PoolWatch(watch_engine, threading.current_thread())
+        # все чаты разом, каждый апдейт в своей задаче, как при polling
+        started = time.perf_counter()
+        await asyncio.gather(*(asyncio.create_task(tg_bot.dp.process_update(update)) for update in updates))
+        elapsed = time.perf_counter() - started
+    return api, watch, elapsed
+
+
+def test_thousand_chats_keep_db_work_bounded(tg_bot, db_path):
+    with db_session.session_scope() as db_sess:
+        telegram_ids = [telegram_id for telegram_id, in db_sess.query(User.telegram_id)
+                        .filter(User.telegram_id.isnot(None))]
+    engine = db_session.Session.session_factory.kw['bind']
+
+    api, watch, elapsed = asyncio.run(run_chats(tg_bot, make_updates(telegram_ids), engine))
+
+    # каждый чат получил ответ, а с базой одновременно работало не больше DB_WORKERS потоков:
+    # пул соединений не исчерпывается, и ни один запрос не выполнялся в потоке event loop
+    assert len(api.replies) == CHATS
+    assert watch.max_checked_out <= DB_WORKERS
+    assert watch.queries_on_loop == 0
+    print(f'{CHATS} chats answered in {elapsed:.2f} s, at most {watch.max_checked_out} connections in use')
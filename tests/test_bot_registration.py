@@ -0,0 +1,36 @@
+import asyncio
+
+from data import db_session
+from data.bot_states import BotState
+from data.users import User
+from tests.bot_api import StandInAPI, message_update, serve
+
+CHAT = 900001
+PASSWORD = 'very-secret-password'
+
+
+def stored_dialogs():
+    with db_session.session_scope() as db_sess:
+        return [(state, data) for state, data in db_sess.query(BotState.state, BotState.data)]
+
+
+async def register(tg_bot, steps):
+    snapshots = []
+    async with serve(tg_bot, StandInAPI()) as api:
+        for update_id, text in enumerate(steps, start=1):
+            # своя задача на апдейт, как при polling: StateFilter кэширует состояние в contextvar
+            await asyncio.create_task(tg_bot.dp.process_update(message_update(update_id, CHAT, text)))
+            snapshots.append(stored_dialogs())
+    return api.replies[CHAT], snapshots
+
+
+def test_password_never_reaches_dialog_state(tg_bot, db_path):
+    replies, snapshots = asyncio.run(register(tg_bot, ['/register', 'Анна', 'anna_bot', 'Подтвердить', PASSWORD]))
+
+    assert replies[-1] == 'Вы успешно зарегистрировались и вошли в систему!'
+    assert all(PASSWORD not in data for snapshot in snapshots for _, data in snapshot)
+    # диалог закончен, его строка удалена
+    assert snapshots[-1] == []
+    with db_session.session_scope() as db_sess:
+        user = db_sess.query(User).filter_by(username='anna_bot').one()
+        assert (user.name, user.password, user.telegram_id) == ('Анна', PASSWORD, CHAT)
@@ -0,0 +1,24 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from bot_webhook import make_webhook_app
+
+BAD_BODIES = ['not json', '[1, 2]', '42', '"update"', 'null', '{}', '{"update_id": "1"}',
+              '{"update_id": 1, "message": 5}', '{"update_id": 1, "message": {"chat": {"id": "42"}}}']
+
+
+async def post_all(tg_bot, bodies):
+    async with TestClient(TestServer(make_webhook_app(tg_bot.dp, workers=1))) as client:
+        return [(await client.post('/telegram/webhook', data=body)).status for body in bodies]
+
+
+@pytest.mark.parametrize('body', BAD_BODIES)
+def test_malformed_update_is_rejected(tg_bot, body):
+    assert asyncio.run(post_all(tg_bot, [body])) == [400]
+
+
+def test_update_object_is_accepted(tg_bot):
+    # апдейт без сообщения: обработчиков для него нет, бот не обращается к Bot API
+    assert asyncio.run(post_all(tg_bot, ['{"update_id": 7}'])) == [200]
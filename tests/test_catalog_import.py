@@ -0,0 +1,25 @@
+import io
+import json
+
+from catalog_io import import_books, iter_records
+from data import db_session
+from data.books import Book
+
+GOOD = {'title': 'Новая книга', 'author': 'Автор', 'genre': 'Роман', 'quantity': 2}
+# каждая из этих строк должна попасть в отчет об ошибках, а не оборвать импорт
+BAD = [{**GOOD, 'title': 5}, {**GOOD, 'author': ['Автор']}, {**GOOD, 'genre': {'name': 'Роман'}},
+       {**GOOD, 'cover': 1}, {**GOOD, 'quantity': True}, {**GOOD, 'quantity': 1.5}, {**GOOD, 'quantity': -1}, [1, 2]]
+
+
+def test_bad_rows_are_reported_not_raised(db_path):
+    lines = [GOOD, *BAD, GOOD]
+    stream = io.StringIO(''.join(json.dumps(line) + '\n' for line in lines))
+    with db_session.session_scope() as db_sess:
+        before = db_sess.query(Book).count()
+        # пачка по одной строке: первая хорошая строка уже закоммичена, когда дойдет до плохих
+        report = import_books(db_sess, iter_records(stream, 'jsonl'), chunk_size=1)
+        after = db_sess.query(Book).count()
+
+    assert report['imported'] == 2
+    assert [error['line'] for error in report['errors']] == list(range(2, len(BAD) + 2))
+    assert after == before + 2
@@ -0,0 +1,29 @@
+from data import db_session
+from data.books import Book
+
+BROWSER_ACCEPT = 'image/avif,image/webp,*/*;q=0.8'
+
+
+def covered_book_id():
+    with db_session.session_scope() as db_sess:
+        return db_sess.query(Book.id).filter(Book.image_hash.isnot(None)).order_by(Book.id).first()[0]
+
+
+def test_cover_size_is_negotiated_by_accept(flask_app, db_path, monkeypatch):
+    import app
+
+    # версии рендерит пул процессов; здесь достаточно ответа, уменьшенного на лету
+    monkeypatch.setattr(app, 'submit_renditions', lambda *args: None)
+    client = flask_app.test_client()
+    url = f'/cover/{covered_book_id()}/thumb'
+
+    webp = client.get(url, headers={'Accept': BROWSER_ACCEPT})
+    plain = client.get(url, headers={'Accept': '*/*'})
+
+    assert (webp.status_code, webp.mimetype) == (200, 'image/webp')
+    assert (plain.status_code, plain.mimetype) == (200, 'image/jpeg')
+    assert 'Accept' in webp.vary and 'Accept' in plain.vary
+    assert webp.get_etag() != plain.get_etag()
+    # кэш браузера не получит WebP по ETag JPEG-версии
+    assert client.get(url, headers={'Accept': BROWSER_ACCEPT, 'If-None-Match': plain.headers['ETag']}).status_code == 200
+    assert client.get(url, headers={'Accept': BROWSER_ACCEPT, 'If-None-Match': webp.headers['ETag']}).status_code == 304
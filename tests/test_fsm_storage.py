@@ -0,0 +1,33 @@
+import asyncio
+
+from data.fsm_storage import SQLiteStorage
+
+CHAT = 42
+
+
+async def two_processes_dialog():
+    # два экземпляра хранилища - как два процесса бота над одной базой
+    first, second = SQLiteStorage(flush_interval=0.05), SQLiteStorage(flush_interval=0.05)
+
+    await first.update_data(chat=CHAT, user=CHAT, data={'name': 'Анна'})
+    await first.set_state(chat=CHAT, user=CHAT, state='Registration:waiting_for_username')
+    # следующий апдейт диалога пришел во второй процесс
+    seen_state = await second.get_state(chat=CHAT, user=CHAT)
+    seen_data = await second.get_data(chat=CHAT, user=CHAT)
+
+    await first.finish(chat=CHAT, user=CHAT)
+    await second.set_state(chat=CHAT, user=CHAT, state='Login:waiting_for_username')
+    # отложенная запись первого процесса не должна затереть новый диалог
+    await asyncio.sleep(0.2)
+    final_state = await SQLiteStorage().get_state(chat=CHAT, user=CHAT)
+
+    await first.close()
+    await second.close()
+    return seen_state, seen_data, final_state
+
+
+def test_state_change_is_visible_to_other_processes(db_path):
+    seen_state, seen_data, final_state = asyncio.run(two_processes_dialog())
+    assert seen_state == 'Registration:waiting_for_username'
+    assert seen_data == {'name': 'Анна'}
+    assert final_state == 'Login:waiting_for_username'
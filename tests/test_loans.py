@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from data import db_session
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.loans import BORROWED, UNAVAILABLE, borrow_book
+from data.users import User
+
+THREADS = 16
+
+
+def add_readers(count):
+    with db_session.session_scope() as db_sess:
+        users = [User(name='Читатель', username=f'stress{index}', password='test', role='reader', max_borrow_days=14)
+                 for index in range(count)]
+        db_sess.add_all(users)
+        db_sess.commit()
+        return [user.id for user in users]
+
+
+def add_book(quantity):
+    with db_session.session_scope() as db_sess:
+        book = Book(title='Последний экземпляр', author='Автор', genre='Роман', quantity=quantity)
+        db_sess.add(book)
+        db_sess.commit()
+        return book.id
+
+
+def book_state(book_id):
+    with db_session.session_scope() as db_sess:
+        quantity = db_sess.query(Book.quantity).filter(Book.id == book_id).scalar()
+        loans = db_sess.query(BorrowedBook).filter(BorrowedBook.book_id == book_id).count()
+        return quantity, loans
+
+
+def run_together(func, args):
+    # барьер выпускает все потоки разом, чтобы запросы действительно пересекались
+    barrier = threading.Barrier(len(args))
+
+    def call(arg):
+        barrier.wait()
+        return func(arg)
+
+    with ThreadPoolExecutor(len(args)) as executor:
+        return list(executor.map(call, args))
+
+
+def test_last_copy_is_borrowed_once(db_path):
+    book_id = add_book(quantity=1)
+
+    def borrow(user_id):
+        with db_session.session_scope() as db_sess:
+            return borrow_book(db_sess, user_id, 14, book_id)
+
+    results = run_together(borrow, add_readers(THREADS))
+    assert results.count(BORROWED) == 1
+    assert results.count(UNAVAILABLE) == THREADS - 1
+    assert book_state(book_id) == (0, 1)
+
+
+def test_concurrent_borrows_and_returns_conserve_copies(login, db_path):
+    copies = 3
+    book_id = add_book(quantity=copies)
+    clients = [login(user_id) for user_id in add_readers(THREADS // 2)]
+
+    def borrow_and_return(client):
+        # двойное нажатие на "взять", затем возврат; экземпляров меньше, чем читателей
+        for _ in range(10):
+            client.get(f'/borrow/{book_id}')
+            client.get(f'/borrow/{book_id}')
+            client.get(f'/return/{book_id}')
+        return client
+
+    # у каждого читателя два потока: запросы одного пользователя тоже идут параллельно
+    run_together(borrow_and_return, clients + clients)
+    quantity, loans = book_state(book_id)
+    assert quantity >= 0
+    assert quantity + loans == copies
@@ -0,0 +1,49 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from data.migrations import MIGRATIONS, get_schema_version, migrate
+
+# индексы миграций 2 и 3: в базы, созданные до них, их добавляет только migrate
+MIGRATED_INDEXES = ['ix_borrowed_books_user_book', 'ix_borrowed_books_book_id', 'ix_borrowed_books_return_by',
+                    'ix_users_telegram_id', 'ix_books_author', 'ix_books_genre']
+
+# частые запросы сайта, бота и рассылки напоминаний и индекс, по которому каждый должен идти
+HOT_LOOKUPS = [
+    ('SELECT id FROM users WHERE telegram_id = 100001', 'ix_users_telegram_id'),
+    ('SELECT * FROM borrowed_books WHERE user_id = 5', 'ix_borrowed_books_user_book'),
+    ('SELECT * FROM borrowed_books WHERE user_id = 5 AND book_id = 7', 'ix_borrowed_books_user_book'),
+    ('SELECT count(*) FROM borrowed_books WHERE book_id = 7', 'ix_borrowed_books_book_id'),
+    ("SELECT id FROM borrowed_books WHERE return_by >= '2026-01-02' AND return_by < '2026-01-03'",
+     'ix_borrowed_books_return_by'),
+    ("SELECT id, title FROM books WHERE author = 'Анна Иванова' ORDER BY id", 'ix_books_author'),
+    ("SELECT id, title FROM books WHERE genre = 'Роман'", 'ix_books_genre'),
+    ("SELECT 1 FROM sent_reminders WHERE borrowed_book_id = 3 AND sent_on = '2026-01-01'",
+     'ix_sent_reminders_loan_day')]
+
+
+@pytest.fixture
+def upgraded_engine(db_path):
+    # база до миграции 2: без индексов, которые добавили миграции, и с тем же номером версии
+    engine = create_engine(f'sqlite:///{db_path}')
+    with engine.begin() as conn:
+        for name in MIGRATED_INDEXES:
+            conn.execute(text(f'DROP INDEX {name}'))
+        conn.execute(text('PRAGMA user_version = 1'))
+    migrate(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_migrations_reach_latest_version(upgraded_engine):
+    with upgraded_engine.connect() as conn:
+        assert get_schema_version(conn) == len(MIGRATIONS)
+        indexes = {name for name, in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    assert set(MIGRATED_INDEXES) <= indexes
+
+
+@pytest.mark.parametrize('statement, index', HOT_LOOKUPS)
+def test_hot_lookups_use_indexes(upgraded_engine, statement, index):
+    with upgraded_engine.connect() as conn:
+        plan = [row[-1] for row in conn.execute(text(f'EXPLAIN QUERY PLAN {statement}'))]
+    assert any(index in step for step in plan), plan
+    assert not any(step.startswith('SCAN') and 'INDEX' not in step for step in plan), plan
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import metrics
+from data import db_session
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.users import User
+from data.waitlist import WaitlistEntry
+
+# SQL-запросов на страницу при прогретом кэше пользователей; число не должно зависеть от числа выдач
+QUERY_BUDGETS = {
+    '/home': 3,
+    '/books': 4,
+    '/books?cursor=100': 4,
+    '/books?search=книга': 3,
+    '/my_books': 3,
+    '/api/v1/books': 2}
+
+
+def add_reader(username, loans, waiting):
+    with db_session.session_scope() as db_sess:
+        user = User(name='Читатель', username=username, password='test', role='reader', max_borrow_days=14)
+        db_sess.add(user)
+        db_sess.flush()
+        book_ids = [book_id for book_id, in db_sess.query(Book.id).order_by(Book.id).limit(loans + waiting)]
+        for book_id in book_ids[:loans]:
+            db_sess.add(BorrowedBook(user_id=user.id, book_id=book_id, return_by=datetime.utcnow() + timedelta(days=7)))
+        for book_id in book_ids[loans:]:
+            db_sess.add(WaitlistEntry(user_id=user.id, book_id=book_id))
+        db_sess.commit()
+        return user.id
+
+
+@pytest.fixture
+def count_queries(monkeypatch):
+    # тот же счетчик cursor-событий, что пишет library_sql_queries_total
+    recorded = []
+    monkeypatch.setattr(metrics, 'record_request',
+                        lambda endpoint, method, status, seconds, stats, response_bytes=None:
+                        recorded.append(stats['queries']))
+
+    def count(client, url):
+        # первый запрос прогревает кэш пользователей и блок новинок
+        client.get(url)
+        response = client.get(url)
+        assert response.status_code == 200
+        return recorded[-1]
+    return count
+
+
+@pytest.mark.parametrize('url', list(QUERY_BUDGETS))
+def test_queries_per_page_do_not_grow_with_loans(login, count_queries, url):
+    light = login(add_reader('light_reader', loans=1, waiting=0))
+    heavy = login(add_reader('heavy_reader', loans=20, waiting=10))
+
+    light_queries = count_queries(light, url)
+    heavy_queries = count_queries(heavy, url)
+    assert heavy_queries == light_queries
+    assert heavy_queries <= QUERY_BUDGETS[url]
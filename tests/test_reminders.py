@@ -0,0 +1,116 @@
+from datetime import datetime, time, timedelta
+import asyncio
+
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+
+from data import db_session
+from data.books import Book
+from data.borrowed_book import BorrowedBook
+from data.sent_reminder import SentReminder
+from data.users import User
+from reminders import dispatch_reminders
+
+TOKEN = '123456:reminders-test-token'
+FIRST_CHAT_ID = 700000
+BLOCKED_CHAT_ID = FIRST_CHAT_ID + 1
+FLAKY_CHAT_ID = FIRST_CHAT_ID + 2
+HANGING_CHAT_ID = FIRST_CHAT_ID + 3
+
+
+class StandInAPI:
+    # заглушка Bot API: запоминает, кому ушли сообщения; один чат заблокировал бота,
+    # второй получает ошибку сервера на первую попытку, на четвертом можно "уронить" рассылку
+    def __init__(self, hang=False):
+        self.hang = hang
+        self.delivered = []
+        self.failed_once = False
+        self.hanging = asyncio.Event()
+
+    async def handle(self, request):
+        if request.match_info['method'] != 'sendMessage':
+            return web.json_response({'ok': True, 'result': True})
+        chat_id = int((await request.post())['chat_id'])
+        if chat_id == BLOCKED_CHAT_ID:
+            return web.json_response({'ok': False, 'error_code': 403,
+                                      'description': 'Forbidden: bot was blocked by the user'}, status=403)
+        if chat_id == FLAKY_CHAT_ID and not self.failed_once:
+            self.failed_once = True
+            return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'},
+                                     status=500)
+        if chat_id == HANGING_CHAT_ID and self.hang:
+            self.hanging.set()
+            await asyncio.Event().wait()
+        self.delivered.append(chat_id)
+        return web.json_response({'ok': True, 'result': {
+            'message_id': len(self.delivered), 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': ''}})
+
+
+def add_due_loans(count, today):
+    # выдачи, срок которых истекает завтра, у читателей с привязанным Telegram
+    return_by = datetime.combine(today + timedelta(days=1), time(12))
+    with db_session.session_scope() as db_sess:
+        db_sess.query(BorrowedBook).update({BorrowedBook.return_by: return_by + timedelta(days=30)})
+        book_id = db_sess.query(Book.id).order_by(Book.id).first()[0]
+        for index in range(count):
+            user = User(name='Читатель', username=f'reminded{index}', password='test', role='reader',
+                        telegram_id=FIRST_CHAT_ID + index)
+            db_sess.add(user)
+            db_sess.flush()
+            db_sess.add(BorrowedBook(user_id=user.id, book_id=book_id, return_by=return_by))
+        db_sess.commit()
+
+
+async def dispatch(api, today):
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    bot = Bot(TOKEN, server=TelegramAPIServer.from_base(f'http://127.0.0.1:{runner.addresses[0][1]}'))
+    task = asyncio.create_task(dispatch_reminders(bot, today, rate=1000, concurrency=1))
+    try:
+        if api.hang:
+            # процесс падает, пока сообщение четвертому читателю еще в пути
+            await api.hanging.wait()
+            task.cancel()
+        return await asyncio.gather(task, return_exceptions=True)
+    finally:
+        await (await bot.get_session()).close()
+        await runner.cleanup()
+
+
+def test_failed_send_is_retried_and_delivered_is_not(db_path):
+    today = datetime.utcnow().date()
+    add_due_loans(6, today)
+
+    first = StandInAPI()
+    asyncio.run(dispatch(first, today))
+    assert sorted(first.delivered) == [FIRST_CHAT_ID, FIRST_CHAT_ID + 3, FIRST_CHAT_ID + 4, FIRST_CHAT_ID + 5]
+
+    # заблокированный чат отмечен как обработанный, неудачная попытка - нет
+    second = StandInAPI()
+    second.failed_once = True
+    asyncio.run(dispatch(second, today))
+    assert second.delivered == [FLAKY_CHAT_ID]
+
+    with db_session.session_scope() as db_sess:
+        assert db_sess.query(SentReminder).filter(SentReminder.sent_on == today).count() == 6
+
+
+def test_crash_mid_dispatch_does_not_resend(db_path):
+    today = datetime.utcnow().date()
+    add_due_loans(6, today)
+
+    crashed = StandInAPI(hang=True)
+    crashed.failed_once = True
+    asyncio.run(dispatch(crashed, today))
+    assert crashed.delivered == [FIRST_CHAT_ID, FLAKY_CHAT_ID]
+
+    restarted = StandInAPI()
+    restarted.failed_once = True
+    asyncio.run(dispatch(restarted, today))
+    # уже доставленные не приходят повторно; напоминание, прерванное падением, теряется, а не дублируется
+    assert restarted.delivered == [FIRST_CHAT_ID + 4, FIRST_CHAT_ID + 5]
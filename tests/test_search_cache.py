@@ -0,0 +1,36 @@
+from data import db_session
+from data.search_cache import load_search, save_search
+
+CHAT = 42
+
+
+def test_search_pages_survive_across_sessions(db_path):
+    # каждый вызов - своя сессия, как у разных процессов бота
+    with db_session.session_scope() as db_sess:
+        old_token = save_search(db_sess, CHAT, [5, 3, 9])
+    with db_session.session_scope() as db_sess:
+        token = save_search(db_sess, CHAT, [7, 1])
+
+    with db_session.session_scope() as db_sess:
+        assert load_search(db_sess, CHAT, token) == (7, 1)
+        # кнопки предыдущего поиска устарели
+        assert old_token == token or load_search(db_sess, CHAT, old_token) is None
+        assert load_search(db_sess, CHAT + 1, token) is None
+
+
+def test_expired_search_is_gone(db_path):
+    with db_session.session_scope() as db_sess:
+        token = save_search(db_sess, CHAT, [5, 3, 9], ttl=-1)
+        assert load_search(db_sess, CHAT, token) is None
+
+
+def test_oldest_searches_are_evicted(db_path):
+    with db_session.session_scope() as db_sess:
+        tokens = {chat: save_search(db_sess, chat, [chat], max_size=3) for chat in range(1, 5)}
+        # чат 2 листал страницы позже остальных и поэтому пережил вытеснение чата 3
+        assert load_search(db_sess, 2, tokens[2]) == (2,)
+        tokens[5] = save_search(db_sess, 5, [5], max_size=3)
+
+        assert load_search(db_sess, 1, tokens[1]) is None
+        assert load_search(db_sess, 3, tokens[3]) is None
+        assert [load_search(db_sess, chat, tokens[chat]) for chat in (2, 4, 5)] == [(2,), (4,), (5,)]
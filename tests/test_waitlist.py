@@ -0,0 +1,101 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from data import db_session
+from data.books import Book
+from data.loans import BORROWED, borrow_book
+from data.migrations import create_waitlist, get_schema_version, migrate
+from data.users import User
+from data.waitlist import JOINED, AvailabilityNotice, WaitlistEntry, join_waitlist
+
+
+def add_readers(count):
+    with db_session.session_scope() as db_sess:
+        users = [User(name='Читатель', username=f'waiting{index}', password='test', role='reader', max_borrow_days=14)
+                 for index in range(count)]
+        db_sess.add_all(users)
+        db_sess.commit()
+        return [user.id for user in users]
+
+
+def add_book():
+    with db_session.session_scope() as db_sess:
+        book = Book(title='Редкая книга', author='Автор', genre='Роман', quantity=0)
+        db_sess.add(book)
+        db_sess.commit()
+        return book.id
+
+
+def add_copy(book_id):
+    with db_session.session_scope() as db_sess:
+        db_sess.query(Book).filter(Book.id == book_id).update({Book.quantity: Book.quantity + 1})
+        db_sess.commit()
+
+
+def miss_notice(reader, other, book_id):
+    # читателя уведомили, но экземпляр взял другой, и читатель снова встает в очередь
+    with db_session.session_scope() as db_sess:
+        assert join_waitlist(db_sess, reader, book_id) == JOINED
+    add_copy(book_id)
+    with db_session.session_scope() as db_sess:
+        assert borrow_book(db_sess, other, 14, book_id) == BORROWED
+        assert join_waitlist(db_sess, reader, book_id) == JOINED
+
+
+def notified_entries(book_id):
+    with db_session.session_scope() as db_sess:
+        return (db_sess.query(WaitlistEntry).filter(WaitlistEntry.book_id == book_id,
+                                                    WaitlistEntry.notified_at.isnot(None)).count(),
+                db_sess.query(AvailabilityNotice).filter(AvailabilityNotice.book_id == book_id).count())
+
+
+@pytest.fixture
+def legacy_waitlist(db_path):
+    # очередь в том виде, как ее создавала миграция 9: без AUTOINCREMENT
+    engine = create_engine(f'sqlite:///{db_path}')
+    with engine.begin() as conn:
+        for trigger in ('books_waitlist_notify', 'borrowed_books_waitlist_leave', 'books_waitlist_delete'):
+            conn.execute(text(f'DROP TRIGGER {trigger}'))
+        conn.execute(text('DROP TABLE waitlist'))
+        conn.execute(text('CREATE TABLE waitlist (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL, '
+                          'book_id INTEGER NOT NULL, created_at DATETIME, notified_at DATETIME)'))
+        conn.execute(text('CREATE UNIQUE INDEX ix_waitlist_user_book ON waitlist (user_id, book_id)'))
+        create_waitlist(conn)
+        conn.execute(text('PRAGMA user_version = 11'))
+    yield engine
+    engine.dispose()
+
+
+def test_rejoined_reader_is_notified_again(db_path):
+    reader, other = add_readers(2)
+    book_id = add_book()
+    miss_notice(reader, other, book_id)
+
+    add_copy(book_id)
+    assert notified_entries(book_id) == (1, 2)
+
+
+def test_migration_unblocks_reused_waitlist_ids(legacy_waitlist):
+    reader, other = add_readers(2)
+    book_id = add_book()
+    # в старой таблице новая запись получает id удаленной, и на него уже ссылается уведомление
+    miss_notice(reader, other, book_id)
+
+    migrate(legacy_waitlist)
+    with legacy_waitlist.connect() as conn:
+        assert get_schema_version(conn) == 12
+    add_copy(book_id)
+    assert notified_entries(book_id) == (1, 2)
+
+
+def test_only_pages_with_awaited_books_open_the_stream(login):
+    reader, = add_readers(1)
+    client = login(reader)
+    assert b'EventSource' not in client.get('/my_books').data
+
+    book_id = add_book()
+    with db_session.session_scope() as db_sess:
+        assert join_waitlist(db_sess, reader, book_id) == JOINED
+    # SSE держит поток сервера, поэтому главная его не открывает, а список ожидаемых книг - да
+    assert b'EventSource' not in client.get('/').data
+    assert b'EventSource' in client.get('/my_books').data
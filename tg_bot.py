@@ -1,19 +1,34 @@
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, \
+    InlineKeyboardButton
+from aiogram.dispatcher.handler import current_handler, ctx_data
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+from data.db_session import global_init
+from data.fsm_storage import SQLiteStorage
+from data.async_db import run_db
+from reminders import dispatch_reminders, dispatch_availability_notices
+from data.search import search_books
+from data.search_cache import load_search, save_search
+from data.queries import get_user_loans
 from data.books import Book
-from data.borrowed_book import BorrowedBook
-from data.db_session import create_session, global_init
+from data.loans import BORROWED, UNAVAILABLE, borrow_book
+from data.waitlist import ALREADY_WAITING, IN_STOCK, JOINED, NOT_ALLOWED, NOT_FOUND, join_waitlist
 from aiogram.utils.executor import start_polling
+from aiohttp import web
+from bot_webhook import make_webhook_app, WEBHOOK_PATH, WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT
 from data.users import User
-from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
 import logging
 import os
+import time
+
+import metrics
 
 logging.basicConfig(
     filename='tg_bot.log',
@@ -23,19 +38,74 @@ logging.basicConfig(
 load_dotenv()
 
 TG_TOKEN = os.getenv("TG_TOKEN")
-global_init("db/library.db")
+# свой сервер Bot API (локальный telegram-bot-api или заглушка бенчмарка) вместо api.telegram.org
+TG_API_SERVER = os.getenv("TG_API_SERVER")
+# polling - бот сам опрашивает Telegram; webhook - Telegram присылает апдейты на WEBHOOK_URL за обратным прокси
+BOT_MODE = os.getenv("BOT_MODE") or "polling"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+global_init(os.getenv("LIBRARY_DB") or "db/library.db")
+
+# состояния диалогов хранятся в базе: переживают перезапуск и общие для нескольких процессов бота
+storage = SQLiteStorage()
+
+bot = Bot(token=TG_TOKEN, server=TelegramAPIServer.from_base(TG_API_SERVER) if TG_API_SERVER else TELEGRAM_PRODUCTION)
+dp = Dispatcher(bot, storage=storage)
 
-storage = MemoryStorage()
+BOT_METRICS_PORT = os.getenv("BOT_METRICS_PORT")
+# как часто бот проверяет уведомления листа ожидания, которые пишет сайт
+WAITLIST_POLL_SECONDS = int(os.getenv("WAITLIST_POLL_SECONDS") or 10)
 
-bot = Bot(token=TG_TOKEN)
-dp = Dispatcher(bot, storage=storage)
+SEARCH_PAGE_SIZE = 5
+# сколько id найденных книг запоминается для листания
+SEARCH_RESULT_LIMIT = 500
+
+
+class MetricsMiddleware(BaseMiddleware):
+    # время и число SQL-запросов на каждый обработчик; запросы из run_db считаются в тот же апдейт
+    async def on_process_message(self, message, data):
+        self.start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self.finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self.start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self.finish(data)
+
+    @staticmethod
+    def start(data):
+        data['metrics_handler'] = current_handler.get().__name__
+        data['metrics_started'] = time.perf_counter()
+        data['metrics_token'] = metrics.begin()
+
+    @staticmethod
+    def finish(data):
+        if 'metrics_token' not in data:
+            return
+        stats = metrics.finish(data.pop('metrics_token'))
+        metrics.record_bot_update(data['metrics_handler'], time.perf_counter() - data['metrics_started'], stats)
+
+
+dp.middleware.setup(MetricsMiddleware())
+
+
+@dp.errors_handler()
+async def count_errors(update, error):
+    # вызывается после post_process, поэтому ошибка считается отдельным счетчиком
+    data = ctx_data.get() or {}
+    metrics.registry.inc('library_bot_errors_total', (('handler', data.get('metrics_handler', 'unknown')),))
 
 
 class RegistrationState(StatesGroup):
+    # пароль спрашивается последним и сразу уходит в create_reader: в данных диалога,
+    # которые хранятся в bot_fsm_states, его не бывает
     waiting_for_name = State()
     waiting_for_username = State()
-    waiting_for_password = State()
     confirm_registration = State()
+    waiting_for_password = State()
 
 
 class LoginState(StatesGroup):
@@ -43,14 +113,100 @@ class LoginState(StatesGroup):
     waiting_for_password = State()
 
 
+# Запросы к БД выполняются через run_db в пуле потоков, каждый со своей сессией,
+# и возвращают простые значения, а не ORM-объекты
+
+def is_registered(db_sess, telegram_id):
+    return db_sess.query(User.id).filter_by(telegram_id=telegram_id).first() is not None
+
+
+def is_username_taken(db_sess, username):
+    return db_sess.query(User.id).filter_by(username=username).first() is not None
+
+
+def create_reader(db_sess, name, username, password, telegram_id):
+    # логин мог занять кто-то другой, пока шла регистрация
+    if is_username_taken(db_sess, username):
+        return False
+    db_sess.add(User(
+        name=name,
+        username=username,
+        password=password,
+        role="reader",
+        rating=100,
+        max_borrow_days=56,
+        telegram_id=telegram_id))
+    try:
+        db_sess.commit()
+    except IntegrityError:
+        db_sess.rollback()
+        return False
+    return True
+
+
+def bind_telegram_id(db_sess, username, password, telegram_id):
+    user = db_sess.query(User).filter_by(username=username, password=password).first()
+    if not user:
+        return False
+
+    user.telegram_id = telegram_id
+    db_sess.commit()
+    return True
+
+
+def unbind_telegram_id(db_sess, telegram_id):
+    user = db_sess.query(User).filter_by(telegram_id=telegram_id).first()
+    if not user:
+        return False
+
+    user.telegram_id = None
+    db_sess.commit()
+    return True
+
+
+def find_loans(db_sess, telegram_id):
+    user = db_sess.query(User.id).filter_by(telegram_id=telegram_id).first()
+    if not user:
+        return None
+    return [(book.title, borrowed_book.return_by) for borrowed_book, book in get_user_loans(db_sess, user.id)]
+
+
+def find_book_ids(db_sess, search_query, limit):
+    return [book_id for book_id, in search_books(db_sess, search_query, query=db_sess.query(Book.id)).limit(limit)]
+
+
+def get_books_page(db_sess, book_ids):
+    # страница выбирается по первичному ключу, порядок релевантности берется из списка id
+    rows = (db_sess.query(Book.id, Book.title, Book.author, Book.genre, Book.quantity)
+            .filter(Book.id.in_(book_ids)).all())
+    by_id = {row.id: tuple(row) for row in rows}
+    return [by_id[book_id] for book_id in book_ids if book_id in by_id]
+
+
+def borrow_by_telegram_id(db_sess, telegram_id, book_id):
+    user = db_sess.query(User.id, User.role, User.max_borrow_days).filter_by(telegram_id=telegram_id).first()
+    if not user:
+        return None
+    if user.role == "admin":
+        return 'admin'
+    return borrow_book(db_sess, user.id, user.max_borrow_days, book_id)
+
+
+def join_waitlist_by_telegram_id(db_sess, telegram_id, book_id):
+    user = db_sess.query(User.id).filter_by(telegram_id=telegram_id).first()
+    if not user:
+        return None
+    # роль, наличие книги и двойное нажатие проверяет join_waitlist, как и для сайта
+    return join_waitlist(db_sess, user.id, book_id)
+
+
 @dp.message_handler(commands=["start"])
 async def start(message: types.Message):
     user_id = message.from_user.id
-    db_sess = create_session()
-    user = db_sess.query(User).filter_by(telegram_id=user_id).first()
+    registered = await run_db(is_registered, user_id)
     logging.info('user start chatting')
 
-    if not user:
+    if not registered:
         await message.answer(
             "Вы не зарегистрированы в системе.\nИспользуйте /register для регистрации или /login для входа.\n"
             "Используйте /help для полного списка команд.")
@@ -83,24 +239,11 @@ async def process_username(message: types.Message, state: FSMContext):
         await message.answer("Логин не может быть пустым. Попробуйте снова.")
         return
 
-    db_sess = create_session()
-    if db_sess.query(User).filter_by(username=username).first():
+    if await run_db(is_username_taken, username):
         await message.answer("Этот логин уже занят. Попробуйте другой.")
         return
 
     await state.update_data(username=username)
-    await message.answer("Напишите свой пароль.")
-    await RegistrationState.waiting_for_password.set()
-
-
-@dp.message_handler(state=RegistrationState.waiting_for_password)
-async def process_password(message: types.Message, state: FSMContext):
-    password = message.text.strip()
-    if not password:
-        await message.answer("Пароль не может быть пустым. Попробуйте снова.")
-        return
-
-    await state.update_data(password=password)
     data = await state.get_data()
 
     keyboard = ReplyKeyboardMarkup(
@@ -111,43 +254,46 @@ async def process_password(message: types.Message, state: FSMContext):
     await message.answer(
         f"Пожалуйста, подтвердите ваши данные:\n"
         f"Имя: {data['name']}\n"
-        f"Логин: {data['username']}\n"
-        f"Пароль: {password}",
+        f"Логин: {username}",
         reply_markup=keyboard)
     await RegistrationState.confirm_registration.set()
 
 
 @dp.message_handler(state=RegistrationState.confirm_registration)
 async def confirm_registration(message: types.Message, state: FSMContext):
-    if message.text == "Подтвердить":
-        data = await state.get_data()
-        if not data:
-            await message.answer("Произошла ошибка. Попробуйте снова.", reply_markup=ReplyKeyboardRemove())
-            logging.error('problem in confirming data')
-            return
-
-        db_sess = create_session()
-        new_user = User(
-            name=data["name"],
-            username=data["username"],
-            password=data["password"],
-            role="reader",
-            rating=100,
-            max_borrow_days=56,
-            telegram_id=message.from_user.id)
-
-        db_sess.add(new_user)
-        db_sess.commit()
-
-        await message.answer(
-            "Вы успешно зарегистрировались и вошли в систему!",
-            reply_markup=ReplyKeyboardRemove())
-        logging.info('successful registration and login')
-    else:
+    if message.text != "Подтвердить":
         await message.answer(
             "Регистрация отменена. Вы можете попробовать снова (/register) или узнать больше информации (/help).",
             reply_markup=ReplyKeyboardRemove())
         logging.warning('undo registration')
+        await state.finish()
+        return
+
+    await message.answer("Напишите свой пароль.", reply_markup=ReplyKeyboardRemove())
+    await RegistrationState.waiting_for_password.set()
+
+
+@dp.message_handler(state=RegistrationState.waiting_for_password)
+async def process_password(message: types.Message, state: FSMContext):
+    password = message.text.strip()
+    if not password:
+        await message.answer("Пароль не может быть пустым. Попробуйте снова.")
+        return
+
+    data = await state.get_data()
+    if not data:
+        await message.answer("Произошла ошибка. Попробуйте снова.")
+        logging.error('problem in confirming data')
+        await state.finish()
+        return
+
+    # пользователь создается на этом шаге, пароль не попадает в данные диалога
+    if not await run_db(create_reader, data["name"], data["username"], password, message.from_user.id):
+        await message.answer("Этот логин уже занят. Начните регистрацию заново: /register.")
+        logging.info('username taken during registration')
+    else:
+        await message.answer("Вы успешно зарегистрировались и вошли в систему!")
+        logging.info('successful registration and login')
 
     await state.finish()
 
@@ -180,19 +326,12 @@ async def process_password(message: types.Message, state: FSMContext):
     data = await state.get_data()
     username = data.get("username")
 
-    db_sess = create_session()
-    user = db_sess.query(User).filter_by(username=username, password=password).first()
-
-    if not user:
+    if not await run_db(bind_telegram_id, username, password, message.from_user.id):
         await message.answer("Неверный логин или пароль!")
         logging.info('wrong login or password')
         await state.finish()
         return
 
-    user.telegram_id = message.from_user.id
-    db_sess.merge(user)
-    db_sess.commit()
-
     await message.answer("Вы успешно вошли в систему!")
     logging.info('successful login')
 
@@ -202,18 +341,12 @@ async def process_password(message: types.Message, state: FSMContext):
 @dp.message_handler(commands=["logout"])
 async def logout(message: types.Message):
     user_id = message.from_user.id
-    db_sess = create_session()
-    user = db_sess.query(User).filter_by(telegram_id=user_id).first()
     logging.info('user logging out')
 
-    if not user:
+    if not await run_db(unbind_telegram_id, user_id):
         await message.answer("Вы не вошли в систему.")
         return
 
-    user.telegram_id = None
-    db_sess.merge(user)
-    db_sess.commit()
-
     await message.answer("Вы успешно вышли из аккаунта!")
     logging.info('successful log out')
 
@@ -232,31 +365,26 @@ async def help_command(message: types.Message):
 @dp.message_handler(commands=["my_books"])
 async def my_books(message: types.Message):
     user_id = message.from_user.id
-    db_sess = create_session()
-    user = db_sess.query(User).filter_by(telegram_id=user_id).first()
+    loans = await run_db(find_loans, user_id)
 
-    if not user:
+    if loans is None:
         await message.answer("Вы не зарегистрированы в системе.")
         return
 
-    borrowed_books = db_sess.query(BorrowedBook).filter_by(user_id=user.id).all()
-
-    if not borrowed_books:
+    if not loans:
         await message.answer("Вы не взяли ни одной книги.")
         logging.info('no books')
         return
 
     message_text = "Список ваших книг:\n"
-    for book in borrowed_books:
-        book_info = db_sess.query(Book).get(book.book_id)
-        message_text += f"- {book_info.title} (до {book.return_by.strftime('%d.%m.%Y')})\n"
+    for title, return_by in loans:
+        message_text += f"- {title} (до {return_by.strftime('%d.%m.%Y')})\n"
 
     await message.answer(message_text)
 
 
 @dp.message_handler(commands=["search"])
 async def search(message: types.Message):
-    db_sess = create_session()
     search_query = " ".join(message.text.split()[1:])
     logging.info('user searching')
 
@@ -266,56 +394,154 @@ async def search(message: types.Message):
         logging.warning('wrong format')
         return
 
-    query = db_sess.query(Book).filter(
-        (Book.title.ilike(f"%{search_query.capitalize()}%")) |
-        (Book.author.ilike(f"%{search_query.capitalize()}%")))
+    book_ids = await run_db(find_book_ids, search_query, SEARCH_RESULT_LIMIT)
 
-    books = query.limit(5).all()
-
-    if not books:
+    if not book_ids:
         await message.answer("Книги не найдены.")
         logging.info('no such books')
         return
 
-    message_text = "Результаты поиска:\n"
-    for book in books:
-        message_text += f"- Название: {book.title}\n"
-        message_text += f"  Автор: {book.author}\n"
-        message_text += f"  Жанр: {book.genre}\n\n"
+    # поиск выполняется один раз, дальше страницы берутся из запомненного списка id
+    token = await run_db(save_search, message.chat.id, book_ids)
+    text, keyboard = await render_search_page(book_ids, token, 0)
+    await message.answer(text, reply_markup=keyboard)
+
+
+async def render_search_page(book_ids, token, page):
+    pages = (len(book_ids) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    start = page * SEARCH_PAGE_SIZE
+    books = await run_db(get_books_page, book_ids[start:start + SEARCH_PAGE_SIZE])
+
+    found = f"более {SEARCH_RESULT_LIMIT}" if len(book_ids) >= SEARCH_RESULT_LIMIT else len(book_ids)
+    text = f"Результаты поиска (найдено {found}, страница {page + 1} из {pages}):\n\n"
+    keyboard = InlineKeyboardMarkup()
+    for number, (book_id, title, author, genre, quantity) in enumerate(books, start=start + 1):
+        text += f"{number}. {title}\n   Автор: {author}\n   Жанр: {genre}\n   В наличии: {quantity}\n\n"
+        if quantity > 0:
+            keyboard.add(InlineKeyboardButton(f"Взять: {number}. {title[:40]}",
+                                              callback_data=f"borrow:{token}:{page}:{book_id}"))
+        else:
+            keyboard.add(InlineKeyboardButton(f"В очередь: {number}. {title[:40]}",
+                                              callback_data=f"wait:{token}:{page}:{book_id}"))
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("« Назад", callback_data=f"search:{token}:{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("Вперед »", callback_data=f"search:{token}:{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    # Telegram обрезает пробелы в конце текста, без этого сравнение в refresh_search_page не сработает
+    return text.rstrip()[:4096], keyboard
+
+
+async def cached_results(callback_query, token):
+    book_ids = await run_db(load_search, callback_query.message.chat.id, int(token))
+    if book_ids is None:
+        await callback_query.answer("Результаты поиска устарели, повторите /search.", show_alert=True)
+    return book_ids
+
+
+@dp.callback_query_handler(text_startswith="search:")
+async def search_page(callback_query: types.CallbackQuery):
+    _, token, page = callback_query.data.split(":")
+    book_ids = await cached_results(callback_query, token)
+    if book_ids is None:
+        return
 
-    max_message_length = 4096
-    for i in range(0, len(message_text), max_message_length):
-        await message.answer(message_text[i:i + max_message_length])
+    text, keyboard = await render_search_page(book_ids, int(token), int(page))
+    await callback_query.message.edit_text(text, reply_markup=keyboard)
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(text_startswith="borrow:")
+async def borrow_from_search(callback_query: types.CallbackQuery):
+    _, token, page, book_id = callback_query.data.split(":")
+    result = await run_db(borrow_by_telegram_id, callback_query.from_user.id, int(book_id))
+
+    answers = {None: "Вы не вошли в систему. Используйте /login.",
+               'admin': "Администраторы не могут брать книги!",
+               BORROWED: "Вы успешно взяли книгу!",
+               UNAVAILABLE: "Книга недоступна!"}
+    await callback_query.answer(answers.get(result, "У вас уже есть эта книга!"), show_alert=result != BORROWED)
+    await refresh_search_page(callback_query, token, page)
+
+
+@dp.callback_query_handler(text_startswith="wait:")
+async def wait_from_search(callback_query: types.CallbackQuery):
+    _, token, page, book_id = callback_query.data.split(":")
+    result = await run_db(join_waitlist_by_telegram_id, callback_query.from_user.id, int(book_id))
+
+    answers = {None: "Вы не вошли в систему. Используйте /login.",
+               NOT_ALLOWED: "Администраторы не могут брать книги!",
+               NOT_FOUND: "Книга не найдена!",
+               IN_STOCK: "Книга есть в наличии, ее можно взять сейчас!",
+               ALREADY_WAITING: "Вы уже в очереди на эту книгу.",
+               JOINED: "Вы в очереди! Бот сообщит, когда книга появится."}
+    await callback_query.answer(answers[result], show_alert=result not in (JOINED, ALREADY_WAITING))
+    if result == IN_STOCK:
+        # кнопка устарела: на странице все еще 0 экземпляров
+        await refresh_search_page(callback_query, token, page)
+
+
+async def refresh_search_page(callback_query, token, page):
+    # количество экземпляров на странице изменилось; страница перечитывается по id без нового поиска
+    book_ids = await run_db(load_search, callback_query.message.chat.id, int(token))
+    if book_ids is None:
+        return
+    text, keyboard = await render_search_page(book_ids, int(token), int(page))
+    if text != callback_query.message.text:
+        await callback_query.message.edit_text(text, reply_markup=keyboard)
 
 
 async def send_reminders(bot: Bot):
-    db_sess = create_session()
-    today = datetime.utcnow().date()
-    _3_days = today + timedelta(days=3)
-    _1_day = today + timedelta(days=1)
-
-    borrowed_books = (
-        db_sess.query(BorrowedBook)
-        .filter((BorrowedBook.return_by == _3_days) | (BorrowedBook.return_by == _1_day))
-        .all())
+    await dispatch_reminders(bot)
 
-    for borrowed_book in borrowed_books:
-        user = db_sess.query(User).get(borrowed_book.user_id)
-        book = db_sess.query(Book).get(borrowed_book.book_id)
 
-        if user and book and user.telegram_id:
-            days_left = (borrowed_book.return_by - today).days
-            message = f"Напоминание: вам нужно вернуть книгу '{book.title}' через {days_left} дней."
-            await bot.send_message(chat_id=user.telegram_id, text=message)
+async def send_availability_notices(bot: Bot):
+    await dispatch_availability_notices(bot)
 
 
 async def setup_scheduler():
     scheduler = AsyncIOScheduler()
     scheduler.add_job(send_reminders, 'cron', hour=9, minute=0, args=[bot])
+    scheduler.add_job(send_availability_notices, 'interval', seconds=WAITLIST_POLL_SECONDS, args=[bot],
+                      max_instances=1, coalesce=True)
     scheduler.start()
 
 
-async def start_bot():
-    setup_scheduler()
-    logging.info('starting bot')
-    start_polling(dp, skip_updates=True)
\ No newline at end of file
+async def on_startup(dp):
+    if BOT_METRICS_PORT:
+        metrics.start_http_server(int(BOT_METRICS_PORT))
+    await setup_scheduler()
+    logging.info(f'starting bot in {BOT_MODE} mode')
+
+
+async def on_webhook_startup(app):
+    await on_startup(dp)
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    else:
+        logging.warning('WEBHOOK_URL is not set, the webhook must be registered separately')
+
+
+async def on_webhook_shutdown(app):
+    # вебхук не снимается: пока бот перезапускается, Telegram копит апдейты и повторяет отправку
+    await storage.close()
+    await (await bot.get_session()).close()
+
+
+def start_bot():
+    if BOT_MODE == 'webhook':
+        app = make_webhook_app(dp, WEBHOOK_PATH, WEBHOOK_SECRET)
+        app.on_startup.append(on_webhook_startup)
+        app.on_shutdown.append(on_webhook_shutdown)
+        web.run_app(app, host=WEBHOOK_LISTEN_HOST, port=WEBHOOK_LISTEN_PORT, access_log=None)
+    else:
+        # start_polling снимает вебхук, так что вернуться к polling можно сменой BOT_MODE
+        start_polling(dp, skip_updates=True, on_startup=on_startup)
+
+
+if __name__ == '__main__':
+    start_bot()